@@ -0,0 +1,253 @@
+# standard library
+import heapq
+import threading
+import time
+import traceback
+
+# 3rd party libraries
+
+# project libraries
+import core
+
+class BulkActionResult(core.CoreDict):
+  """
+  The outcome of an action requested for a set of computers
+
+  Keys are computer IDs and values are True if the Manager accepted the
+  request for that computer. Each call made to the Manager is recorded in
+  .chunks
+
+  The result evaluates as True only if the action was accepted for every
+  computer so existing checks like "if mgr.scan_computers_for_malware(ids):"
+  keep working
+  """
+  def __init__(self, call=None):
+    core.CoreDict.__init__(self)
+    self.call = call
+    self.chunks = []
+
+  def __nonzero__(self): return all(self.values())
+
+  def get(self, computer_id, default=None):
+    """
+    Get the outcome for a computer. Returns default if it wasn't requested
+    """
+    return dict.get(self, computer_id, default)
+
+  @property
+  def succeeded(self): return [ computer_id for computer_id, result in self.items() if result ]
+
+  @property
+  def failed(self): return [ computer_id for computer_id, result in self.items() if not result ]
+
+  def add_chunk(self, computer_ids, status, result):
+    """
+    Record the outcome of a single call covering the specified computers
+    """
+    self.chunks.append({
+      'computer_ids': computer_ids,
+      'status': status,
+      'result': result,
+      })
+    for computer_id in computer_ids: self[computer_id] = result
+
+class ActionScheduler(object):
+  """
+  Spread an action for many computers across a window of time
+
+  Actions like a malware scan or a baseline rebuild are queued by the Manager
+  and run immediately by every agent. Requesting them for thousands of 
+  computers at once spikes CPU on every agent and on any shared hypervisors.
+  The scheduler dispatches the computers in small batches instead:
+
+    action
+      The name of a Manager() method that takes a list of computer IDs (e.g.,
+      'scan_computers_for_malware', 'rebuild_baseline') or any callable that
+      does the same
+
+    window
+      The number of seconds to spread the computers across. Ignored if rate
+      is specified
+
+    rate
+      The maximum number of computers to dispatch per second
+
+    batch_size
+      The maximum number of computers to include in a single call. A batch
+      never holds more than one second's worth of computers at the rate so
+      a small set of computers is still spread across the window one at a 
+      time
+
+    max_per_group / max_per_esx_server
+      The maximum number of computers in the same computer group or on the 
+      same ESX server that can be active at once. A computer counts as 
+      active for hold seconds after its action is dispatched. Computers 
+      that haven't been loaded by Manager.computers.get() when the scheduler
+      is created are not capped
+
+    priority
+      A dict of computer ID => priority or a callable(computer_id) returning
+      the priority. Computers with a lower priority are dispatched first
+  """
+  def __init__(self, manager, action, computer_ids, window=3600, rate=None, batch_size=10, max_per_group=None, max_per_esx_server=None, hold=300, priority=None):
+    self.manager = manager
+    self.log = self.manager.log if self.manager else None
+    self.action = action
+    self.window = window
+    self.batch_size = max(1, batch_size)
+    self.max_per_group = max_per_group
+    self.max_per_esx_server = max_per_esx_server
+    self.hold = hold
+    self.result = BulkActionResult(call=action if type(action) in [type(''), type(u'')] else getattr(action, '__name__', None))
+
+    if not type(computer_ids) == type([]): computer_ids = list(computer_ids) if hasattr(computer_ids, '__iter__') else [computer_ids]
+    self.rate = rate if rate else max(len(computer_ids), 1) / float(max(window, 1))
+    self._batch_limit = min(self.batch_size, max(1, int(self.rate)))
+
+    # computers are queued by the caps that apply to them so a blocked cap
+    # is skipped without touching its computers
+    self._queues = {} # cap keys and limits => heap of (priority, order, computer ID)
+    for i, computer_id in enumerate(computer_ids):
+      if callable(priority):
+        computer_priority = priority(computer_id)
+      elif priority:
+        computer_priority = priority.get(computer_id, 0)
+      else:
+        computer_priority = 0
+      self._queues.setdefault(tuple(self._get_cap_keys(computer_id)), []).append((computer_priority, i, computer_id))
+    for queue in self._queues.values(): heapq.heapify(queue)
+
+    self._active = {} # cap key => list of times when a dispatched computer stops counting against the cap
+    self._cancelled = threading.Event()
+    self._thread = None
+
+  @property
+  def cancelled(self): return self._cancelled.is_set()
+
+  @property
+  def pending(self): return [ computer_id for computer_priority, i, computer_id in sorted([ item for queue in self._queues.values() for item in queue ]) ]
+
+  @property
+  def _pending_count(self): return sum([ len(queue) for queue in self._queues.values() ])
+
+  @property
+  def is_running(self): return True if self._thread and self._thread.is_alive() else False
+
+  def _get_cap_keys(self, computer_id):
+    """
+    Get the cap keys and limits that apply to the specified computer
+    """
+    results = []
+    if not (self.max_per_group or self.max_per_esx_server) or not self.manager.computers.has_key(computer_id): return results
+    computer = self.manager.computers[computer_id]
+
+    if self.max_per_group and getattr(computer, 'computer_group_id', None):
+      results.append((('computer_group_id', computer.computer_group_id), self.max_per_group))
+    if self.max_per_esx_server and getattr(computer, 'esx_server_id', None):
+      results.append((('esx_server_id', computer.esx_server_id), self.max_per_esx_server))
+
+    return results
+
+  def _is_blocked(self, cap_keys):
+    return not all([ len(self._active.get(key, [])) < limit for key, limit in cap_keys ])
+
+  def _next_batch(self, now):
+    """
+    Pop the highest priority computers that aren't blocked by a cap
+    """
+    for key in self._active.keys():
+      self._active[key] = [ expires for expires in self._active[key] if expires > now ]
+      if not self._active[key]: del(self._active[key])
+
+    # merge the next computer from each queue whose caps have room
+    heads = [ (queue[0], cap_keys) for cap_keys, queue in self._queues.items() if queue and not self._is_blocked(cap_keys) ]
+    heapq.heapify(heads)
+
+    batch = []
+    while heads and len(batch) < self._batch_limit:
+      item, cap_keys = heapq.heappop(heads)
+      if self._is_blocked(cap_keys): continue # a cap shared with another queue filled up
+      queue = self._queues[cap_keys]
+      heapq.heappop(queue)
+      batch.append(item[2])
+      for key, limit in cap_keys: self._active.setdefault(key, []).append(now + self.hold)
+      if queue:
+        heapq.heappush(heads, (queue[0], cap_keys))
+      else:
+        del(self._queues[cap_keys])
+
+    return batch
+
+  def _dispatch(self, batch):
+    """
+    Run the action for a batch of computers
+    """
+    func = getattr(self.manager, self.action) if type(self.action) in [type(''), type(u'')] else self.action
+    try:
+      response = func(batch)
+    except Exception:
+      self.log("Could not run action {} for computers {}".format(self.result.call, batch), err=traceback.format_exc())
+      response = False
+
+    if isinstance(response, BulkActionResult):
+      # keep the detailed outcome of each call
+      for chunk in response.chunks: self.result.add_chunk(chunk['computer_ids'], chunk['status'], chunk['result'])
+    else:
+      self.result.add_chunk(batch, None, True if response else False)
+
+  def run(self):
+    """
+    Dispatch all of the computers, blocking until complete or cancelled
+
+    Returns a BulkActionResult with the outcome for each dispatched computer
+    """
+    interval = 1.0 / self.rate if self.rate > 0 else 0
+    total = self._pending_count
+    self.log("Scheduling {} for {} computers at {:.2f} computers per second".format(self.result.call, total, self.rate))
+
+    next_dispatch = time.time()
+    while self._queues and not self._cancelled.is_set():
+      now = time.time()
+      if now < next_dispatch:
+        self._cancelled.wait(next_dispatch - now)
+        continue
+
+      batch = self._next_batch(now)
+      if not batch:
+        # every remaining computer is blocked by a cap, wait for the next one to clear
+        next_clear = min([ min(expires) for expires in self._active.values() ]) if self._active else now + 1
+        self._cancelled.wait(max(next_clear - now, 0.1))
+        continue
+
+      self._dispatch(batch)
+      self.log("Dispatched {} for {} of {} computers".format(self.result.call, len(self.result), total), level='debug')
+      next_dispatch = max(next_dispatch, now) + interval * len(batch)
+
+    if self._cancelled.is_set():
+      self.log("Cancelled {} with {} computers not dispatched".format(self.result.call, self._pending_count))
+
+    return self.result
+
+  def start(self):
+    """
+    Run the scheduler in a background thread
+    """
+    if not self.is_running:
+      self._thread = threading.Thread(target=self.run)
+      self._thread.daemon = True
+      self._thread.start()
+
+    return self
+
+  def wait(self, timeout=None):
+    """
+    Wait for a scheduler running in the background to finish
+    """
+    if self._thread: self._thread.join(timeout)
+    return self.result
+
+  def cancel(self):
+    """
+    Stop dispatching computers. Computers not yet dispatched remain in .pending
+    """
+    self._cancelled.set()
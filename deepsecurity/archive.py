@@ -0,0 +1,525 @@
+# standard library
+import bisect
+import glob
+import heapq
+import json
+import mmap
+import os
+import re
+import struct
+import threading
+
+# 3rd party libraries
+
+# project libraries
+import core
+import enrichment
+import events
+
+MAGIC = 'DSEA\x01'
+RECORD_STRING = 'S' # adds the next string to the segment's dictionary
+RECORD_EVENT = 'E'
+SPARSE_INDEX_EVERY = 1000 # events between sparse index entries in a compacted segment
+MAX_INDEXED_HOSTS = 10000 # segments with more hosts than this aren't pruned by host
+
+# string values of these fields repeat across events and are stored once per segment
+DICTIONARY_FIELD_PATTERN = re.compile(r'(name|status|action|reason|type|direction|protocol|interface|flags|origin|severity|rank|tags?)$', re.IGNORECASE)
+MAX_DICTIONARY_VALUE_LENGTH = 256
+
+_RECORD_HEADER = struct.Struct('<cI') # record type, body length
+_EVENT_HEADER = struct.Struct('<qqI') # time (ms), event ID, host code
+_INT = struct.Struct('<q')
+_FLOAT = struct.Struct('<d')
+
+def _encode_varint(value):
+  result = []
+  while value > 0x7f:
+    result.append(chr((value & 0x7f) | 0x80))
+    value >>= 7
+  result.append(chr(value))
+  return ''.join(result)
+
+def _decode_varint(buf, offset):
+  result = 0
+  shift = 0
+  while True:
+    b = ord(buf[offset])
+    offset += 1
+    result |= (b & 0x7f) << shift
+    if not b & 0x80: return result, offset
+    shift += 7
+
+def _to_utf8(value):
+  return value.encode('utf-8') if isinstance(value, unicode) else value
+
+def _get_event_id(event):
+  """
+  Get the numeric ID of an event dict, -1 if it doesn't have one
+  """
+  for k, v in event.items():
+    if k.lower().endswith('eventid') and v is not None:
+      try:
+        return long(v)
+      except (TypeError, ValueError):
+        pass
+  return -1
+
+def _as_time(value):
+  """
+  Convert a datetime, timestamp string or epoch ms to epoch ms
+  """
+  if value is None: return None
+  return events.get_event_time({ 'time': value })
+
+class _Segment(object):
+  """
+  A single append-only segment file of one event type
+
+  Each record is a type byte, the body length and the body. String records
+  add to the segment's dictionary. Event records are a fixed header (time,
+  event ID, host) followed by the encoded fields. The header lets readers
+  skip events without decoding them
+
+  When a segment is sealed, its summary (time and ID ranges, hosts,
+  dictionary and, for segments written in time order, a sparse time index)
+  is written beside it as JSON so readers can skip the whole segment
+  """
+  def __init__(self, path):
+    self.path = path
+    self.index_path = '{}.idx'.format(path)
+    self.meta = None
+    self.strings = [None] # code 0 is reserved for None
+    self._codes = {}
+    self._fh = None
+    self._hosts = set()
+    self._sparse = []
+    self._last_time = None
+
+  @property
+  def sealed(self): return self._fh is None
+
+  @property
+  def size(self): return self.meta['bytes'] if self.meta else 0
+
+  def create(self, event_type):
+    self._fh = open(self.path, 'wb')
+    self._fh.write(MAGIC)
+    self.meta = {
+      'event_type': event_type,
+      'count': 0,
+      'bytes': len(MAGIC),
+      'min_time': None,
+      'max_time': None,
+      'min_id': None,
+      'max_id': None,
+      'sorted': True,
+      }
+    return self
+
+  def _write_record(self, record_type, body):
+    self._fh.write(_RECORD_HEADER.pack(record_type, len(body)))
+    self._fh.write(body)
+    self.meta['bytes'] += _RECORD_HEADER.size + len(body)
+
+  def _get_code(self, value):
+    value = _to_utf8(value)
+    code = self._codes.get(value)
+    if code is None:
+      code = len(self.strings)
+      self.strings.append(value)
+      self._codes[value] = code
+      self._write_record(RECORD_STRING, value)
+    return code
+
+  def _encode_value(self, key, value):
+    if value is None: return 'N'
+    if value is True: return 'T'
+    if value is False: return 'F'
+    if isinstance(value, (int, long)) and -2**63 <= value < 2**63: return 'I' + _INT.pack(value)
+    if isinstance(value, float): return 'D' + _FLOAT.pack(value)
+    if isinstance(value, basestring):
+      if len(value) <= MAX_DICTIONARY_VALUE_LENGTH and DICTIONARY_FIELD_PATTERN.search(key):
+        return 'C' + _encode_varint(self._get_code(value))
+      value = _to_utf8(value)
+      return 'S' + _encode_varint(len(value)) + value
+    value = json.dumps(value, default=str)
+    return 'J' + _encode_varint(len(value)) + value
+
+  def append(self, event):
+    """
+    Append an event dict of API keypairs
+    """
+    event_time = events.get_event_time(event)
+    event_id = _get_event_id(event)
+    host = events.get_event_host(event)
+    host_code = self._get_code(u'{}'.format(host)) if host is not None else 0
+
+    fields = [ _encode_varint(len(event)) ]
+    for key, value in event.items():
+      fields.append(_encode_varint(self._get_code(key)))
+      fields.append(self._encode_value(key, value))
+
+    offset = self.meta['bytes']
+    self._write_record(RECORD_EVENT, _EVENT_HEADER.pack(event_time if event_time is not None else -1, event_id, host_code) + ''.join(fields))
+    self._track(event_time, event_id, host_code, offset)
+
+  def _track(self, event_time, event_id, host_code, offset):
+    meta = self.meta
+    if event_time is not None:
+      if self._last_time is not None and event_time < self._last_time: meta['sorted'] = False
+      if meta['sorted'] and meta['count'] % SPARSE_INDEX_EVERY == 0: self._sparse.append([event_time, offset])
+      self._last_time = event_time
+      meta['min_time'] = event_time if meta['min_time'] is None else min(meta['min_time'], event_time)
+      meta['max_time'] = event_time if meta['max_time'] is None else max(meta['max_time'], event_time)
+    if event_id >= 0:
+      meta['min_id'] = event_id if meta['min_id'] is None else min(meta['min_id'], event_id)
+      meta['max_id'] = event_id if meta['max_id'] is None else max(meta['max_id'], event_id)
+    if host_code and self._hosts is not None:
+      self._hosts.add(host_code)
+      if len(self._hosts) > MAX_INDEXED_HOSTS: self._hosts = None
+    meta['count'] += 1
+
+  def seal(self):
+    """
+    Close the segment and write its summary
+    """
+    if self._fh:
+      self._fh.close()
+      self._fh = None
+
+    self.meta['hosts'] = sorted([ self.strings[code].decode('utf-8') for code in self._hosts ]) if self._hosts is not None else None
+    self.meta['sparse'] = self._sparse if self.meta['sorted'] else None
+    self.meta['strings'] = [ s.decode('utf-8', 'replace') for s in self.strings[1:] ]
+
+    core._atomic_write(self.index_path, lambda fh: json.dump(self.meta, fh))
+
+  def load(self):
+    """
+    Load the summary of a sealed segment, rebuilding it if the segment was
+    never sealed (e.g., the process exited while it was being written)
+    """
+    if os.path.exists(self.index_path):
+      with open(self.index_path, 'r') as fh:
+        self.meta = json.load(fh)
+      self.strings = [None] + [ _to_utf8(s) for s in self.meta['strings'] ]
+      return self
+
+    self.meta = None
+    valid_bytes = len(MAGIC)
+    with open(self.path, 'rb') as fh:
+      if fh.read(len(MAGIC)) != MAGIC: raise ValueError("[{}] is not an event archive segment".format(self.path))
+      while True:
+        header = fh.read(_RECORD_HEADER.size)
+        if len(header) < _RECORD_HEADER.size: break
+        record_type, length = _RECORD_HEADER.unpack(header)
+        body = fh.read(length)
+        if len(body) < length: break
+        if record_type == RECORD_STRING:
+          self._codes[body] = len(self.strings)
+          self.strings.append(body)
+        elif record_type == RECORD_EVENT:
+          if not self.meta:
+            self.meta = { 'event_type': None, 'count': 0, 'bytes': 0, 'min_time': None, 'max_time': None, 'min_id': None, 'max_id': None, 'sorted': True }
+          event_time, event_id, host_code = _EVENT_HEADER.unpack_from(body)
+          self._track(event_time if event_time >= 0 else None, event_id, host_code, valid_bytes)
+        valid_bytes += _RECORD_HEADER.size + length
+
+    # drop a partially written record at the end
+    if os.path.getsize(self.path) > valid_bytes:
+      with open(self.path, 'r+b') as fh: fh.truncate(valid_bytes)
+
+    if not self.meta: self.meta = { 'count': 0, 'min_time': None, 'max_time': None, 'min_id': None, 'max_id': None, 'sorted': True }
+    self.meta['event_type'] = os.path.basename(self.path).split('.')[0]
+    self.meta['bytes'] = valid_bytes
+    self.seal()
+    return self
+
+  def overlaps(self, start=None, end=None, hosts=None):
+    """
+    Whether the segment may hold events matching the query
+    """
+    if not self.meta['count']: return False
+    if start is not None and self.meta['max_time'] is not None and self.meta['max_time'] < start: return False
+    if end is not None and self.meta['min_time'] is not None and self.meta['min_time'] > end: return False
+    if hosts and self.meta.get('hosts') is not None and not set(self.meta['hosts']).intersection(hosts): return False
+    return True
+
+  def _decode_value(self, buf, offset):
+    tag = buf[offset]
+    offset += 1
+    if tag == 'N': return None, offset
+    if tag == 'T': return True, offset
+    if tag == 'F': return False, offset
+    if tag == 'I': return _INT.unpack_from(buf, offset)[0], offset + _INT.size
+    if tag == 'D': return _FLOAT.unpack_from(buf, offset)[0], offset + _FLOAT.size
+    if tag == 'C':
+      code, offset = _decode_varint(buf, offset)
+      return self.strings[code].decode('utf-8'), offset
+    length, offset = _decode_varint(buf, offset)
+    value = buf[offset:offset + length]
+    if tag == 'J': return json.loads(value), offset + length
+    return value.decode('utf-8'), offset + length
+
+  def _records(self, buf, offset, limit):
+    """
+    Yield the (time, event ID, host code, offset of the fields) of each
+    event record without decoding it
+    """
+    while offset + _RECORD_HEADER.size <= limit:
+      record_type, length = _RECORD_HEADER.unpack_from(buf, offset)
+      body = offset + _RECORD_HEADER.size
+      offset = body + length
+      if record_type != RECORD_EVENT: continue
+      event_time, event_id, host_code = _EVENT_HEADER.unpack_from(buf, body)
+      yield event_time, event_id, host_code, body + _EVENT_HEADER.size
+
+  def _decode_event(self, buf, position):
+    field_count, position = _decode_varint(buf, position)
+    event = {}
+    for i in range(field_count):
+      key_code, position = _decode_varint(buf, position)
+      event[self.strings[key_code].decode('utf-8')], position = self._decode_value(buf, position)
+    return event
+
+  def read(self, start=None, end=None, hosts=None, limit=None):
+    """
+    Yield the event dicts in the segment within the time range and from
+    the specified hosts. limit is the number of bytes of the segment to
+    read, for segments that are still being written
+    """
+    host_codes = None
+    if hosts:
+      codes = dict([ (s, code) for code, s in enumerate(self.strings) if code ])
+      host_codes = set([ codes[h] for h in [ _to_utf8(u'{}'.format(host)) for host in hosts ] if codes.has_key(h) ])
+      if not host_codes: return
+
+    with open(self.path, 'rb') as fh:
+      buf = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+      try:
+        offset = len(MAGIC)
+        if start is not None and self.meta.get('sparse'):
+          # the segment is in time order so skip straight to the first block that can match
+          times = [ entry[0] for entry in self.meta['sparse'] ]
+          i = bisect.bisect_left(times, start) - 1
+          if i >= 0: offset = self.meta['sparse'][i][1]
+
+        limit = min(len(buf), limit if limit is not None else self.meta['bytes'])
+        for event_time, event_id, host_code, position in self._records(buf, offset, limit):
+          if end is not None and event_time > end:
+            if self.meta.get('sorted'): break
+            continue
+          if start is not None and event_time < start: continue
+          if host_codes is not None and not host_code in host_codes: continue
+          yield self._decode_event(buf, position)
+      finally:
+        buf.close()
+
+  def read_sorted(self, start=None):
+    """
+    Yield (time, event ID, event dict) tuples in time order. Segments that
+    weren't written in time order are sorted by their record headers so
+    only the headers are held in memory
+    """
+    with open(self.path, 'rb') as fh:
+      buf = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+      try:
+        records = ( (event_time, event_id, position) for event_time, event_id, host_code, position in self._records(buf, len(MAGIC), min(len(buf), self.meta['bytes'])) if start is None or event_time >= start )
+        if not self.meta.get('sorted'): records = sorted(records)
+        for event_time, event_id, position in records:
+          yield event_time, event_id, self._decode_event(buf, position)
+      finally:
+        buf.close()
+
+class EventArchive(object):
+  """
+  A compact local archive of events
+
+  Events are appended to per event type segment files in a directory. A
+  segment is sealed and a new one started once it reaches
+  max_segment_bytes. Strings that repeat across events (field names,
+  computer names, rule names, statuses, etc.) are stored once per segment
+
+  .query() prunes segments by their time range and hosts, then reads the
+  remaining segments through mmap without loading them into memory.
+  .compact() merges sealed segments into larger ones in time order so time
+  range queries can seek directly to the first matching event
+
+  Event types are the names of the Manager() event collections (e.g.,
+  'firewall_events'). Events can be the dicts yielded by a collection's
+  .iterate() or the objects in the collection. Events are read back as dicts
+  of API keypairs
+  """
+  def __init__(self, path, max_segment_bytes=64 * 1024 * 1024, log_func=None):
+    self.path = path
+    self.max_segment_bytes = max_segment_bytes
+    self.log = log_func if log_func else lambda *args, **kwargs: None
+    self._segments = {} # event type => list of sealed segments
+    self._active = {} # event type => segment being written
+    self._sequence = 0
+    self._lock = threading.RLock()
+
+    if not os.path.exists(self.path): os.makedirs(self.path)
+    for segment_path in sorted(glob.glob(os.path.join(self.path, '*.seg'))):
+      try:
+        segment = _Segment(segment_path).load()
+      except Exception, err:
+        self.log("Could not load archive segment [{}]".format(segment_path), err=err)
+        continue
+      self._segments.setdefault(segment.meta['event_type'], []).append(segment)
+      self._sequence = max(self._sequence, int(segment_path.split('.')[-2]))
+
+  def __enter__(self): return self
+
+  def __exit__(self, *args): self.close()
+
+  @property
+  def event_types(self): return sorted(set(self._segments.keys() + self._active.keys()))
+
+  def _new_segment(self, event_type, suffix=''):
+    if not re.search(r'^\w+$', event_type): raise ValueError("Invalid event type [{}]".format(event_type))
+    self._sequence += 1
+    return _Segment(os.path.join(self.path, '{}.{:08d}.seg{}'.format(event_type, self._sequence, suffix))).create(event_type)
+
+  def _seal(self, event_type):
+    segment = self._active.pop(event_type, None)
+    if segment:
+      segment.seal()
+      self._segments.setdefault(event_type, []).append(segment)
+
+  def append(self, event_type, events):
+    """
+    Append events of the specified type. Returns the number appended
+    """
+    count = 0
+    with self._lock:
+      for event in events:
+        segment = self._active.get(event_type)
+        if not segment:
+          segment = self._active[event_type] = self._new_segment(event_type)
+        segment.append(enrichment._as_api_dict(event))
+        count += 1
+        if segment.size >= self.max_segment_bytes: self._seal(event_type)
+
+    return count
+
+  def close(self):
+    """
+    Seal the segments being written
+    """
+    with self._lock:
+      for event_type in self._active.keys(): self._seal(event_type)
+
+  def segments(self, event_type=None):
+    """
+    Get the summaries of the sealed segments
+    """
+    return [ dict([ (k, v) for k, v in segment.meta.items() if k not in ['strings', 'sparse'] ], path=segment.path) for t in sorted(self._segments.keys()) for segment in self._segments[t] if event_type in [None, t] ]
+
+  def query(self, event_types=None, start=None, end=None, hosts=None):
+    """
+    Read archived events
+
+    event_types
+      A list of event types to read. Defaults to all of them
+
+    start, end
+      Only read events in this time range (inclusive). Can be datetimes,
+      timestamp strings or milliseconds since the epoch
+
+    hosts
+      Only read events from these computers (by computer ID or, for events
+      without one, computer name)
+
+    Yields (event type, event dict) tuples. Events are yielded one segment
+    at a time so they're only in time order within a segment. Use
+    events.merge_events() for a single time ordered stream
+    """
+    start = _as_time(start)
+    end = _as_time(end)
+    if hosts is not None and not hasattr(hosts, '__iter__'): hosts = [hosts]
+    hosts = set([ u'{}'.format(host) for host in hosts ]) if hosts else None
+
+    # segments being written are read up to what's been written so far
+    # rather than sealed
+    with self._lock:
+      to_read = []
+      for event_type in (event_types or self.event_types):
+        segments = [ (segment, None) for segment in self._segments.get(event_type, []) ]
+        active = self._active.get(event_type)
+        if active:
+          active._fh.flush()
+          segments.append((active, active.meta['bytes']))
+        segments.sort(key=lambda s: (s[0].meta['min_time'], s[0].path))
+        to_read.append((event_type, segments))
+
+    for event_type, segments in to_read:
+      for segment, limit in segments:
+        if not segment.overlaps(start, end, hosts): continue
+        for event in segment.read(start, end, hosts, limit=limit): yield event_type, event
+
+  def compact(self, event_types=None, before=None, retain_after=None, max_segment_bytes=None):
+    """
+    Merge sealed segments into time ordered segments
+
+    before
+      Only merge segments whose newest event is older than this time.
+      Defaults to all sealed segments
+
+    retain_after
+      Drop events older than this time
+
+    max_segment_bytes
+      The size of the merged segments. Defaults to four times the archive's
+      max_segment_bytes
+
+    Duplicate events (by event ID) are dropped. Returns the number of
+    segments removed
+    """
+    before = _as_time(before)
+    retain_after = _as_time(retain_after)
+    max_segment_bytes = max_segment_bytes if max_segment_bytes else self.max_segment_bytes * 4
+    removed = 0
+
+    with self._lock:
+      self.close()
+      for event_type in (event_types or self.event_types):
+        old_segments = [ segment for segment in self._segments.get(event_type, []) if before is None or (segment.meta['max_time'] or 0) < before ]
+        if len(old_segments) < 2 and retain_after is None: continue
+
+        # stream a merge of the segments in time order. Duplicates of an
+        # event share its time so only the IDs at the current time are kept
+        merged = heapq.merge(*[ ((event_time, event_id, i, event) for event_time, event_id, event in s.read_sorted(start=retain_after)) for i, s in enumerate(old_segments) ])
+        new_segments = []
+        window_time = None
+        window_ids = set()
+        segment = None
+        for event_time, event_id, i, event in merged:
+          if event_time != window_time:
+            window_time = event_time
+            window_ids.clear()
+          if event_id >= 0:
+            if event_id in window_ids: continue
+            window_ids.add(event_id)
+          if not segment or segment.size >= max_segment_bytes:
+            if segment: segment.seal()
+            segment = self._new_segment(event_type, suffix='.tmp')
+            new_segments.append(segment)
+          segment.append(event)
+        if segment: segment.seal()
+
+        # swap the merged segments in
+        for segment in new_segments:
+          path = segment.path[:-len('.tmp')]
+          os.rename(segment.index_path, '{}.idx'.format(path))
+          os.rename(segment.path, path)
+          segment.path = path
+          segment.index_path = '{}.idx'.format(path)
+        for segment in old_segments:
+          os.remove(segment.index_path)
+          os.remove(segment.path)
+          removed += 1
+
+        self._segments[event_type] = [ s for s in self._segments.get(event_type, []) if not s in old_segments ] + new_segments
+        self.log("Compacted {} {} segments into {}".format(len(old_segments), event_type, len(new_segments)))
+
+    return removed
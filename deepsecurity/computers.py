@@ -1,19 +1,61 @@
 # standard library
+import contextlib
 import datetime
+import hashlib
+import json
+import re
+import threading
+import time
+import traceback
 
 # 3rd party libraries
 
 # project libraries
 import core
 import filters
+import translation
+
+def _as_id(value):
+  """
+  The IDs of linked objects are strings on a computer but the collections
+  are keyed by int
+  """
+  if value is not None and re.search(r'^\d+$', u'{}'.format(value).strip()): return int(value)
+  return value
 
 class Computers(core.CoreDict):
+  # fields that change on every heartbeat and shouldn't trigger a refresh in .sync()
+  SYNC_IGNORED_FIELDS = [
+    'lastSuccessfulCommunication',
+    'overallLastSuccessfulCommunication',
+    'lastAntiMalwareEvent',
+    'lastDpiEvent',
+    'lastFirewallEvent',
+    'lastIntegrityMonitoringEvent',
+    'lastLogInspectionEvent',
+    'lastWebReputationEvent',
+    ]
+
+  # relative cost of a single call and of each computer it returns, used by .get_many()
+  PLANNER_CALL_COST = 1.0
+  PLANNER_COMPUTER_COST = { 'HIGH': 0.02, 'MEDIUM': 0.01, 'LOW': 0.005 }
+  PLANNER_DEFAULT_FLEET_SIZE = 1000
+
+  # the order of the detail levels, used to tell whether a retrieval covers a pending upgrade
+  DETAIL_LEVEL_RANKS = { 'LOW': 0, 'MEDIUM': 1, 'HIGH': 2 }
+
   def __init__(self, manager=None):
     core.CoreDict.__init__(self)
     self.manager = manager
     self.log = self.manager.log if self.manager else None
+    self._fingerprints = {}
+    self._fleet_size = None
+    self._upgrades = {} # computer ID => detail level to upgrade to on access
+    self._upgrade_lock = threading.RLock()
+    self._upgrades_in_flight = {} # computer ID => threading.Event set once its upgrade call returns
+    self._local = threading.local() # .upgrading is set while this thread loads or upgrades computers
 
-  def get(self, detail_level='HIGH', computer_id=None, computer_group_id=None, policy_id=None, computer_name=None, external_id=None, external_group_id=None):
+  def get(self, detail_level='HIGH', computer_id=None, computer_group_id=None, policy_id=None, computer_name=None, external_id=None, external_group_id=None, fields=None, lazy=False, upgrade_to=None):
     """
     Get all or a filtered set of computers from Deep Security
 
@@ -34,13 +76,181 @@ class Computers(core.CoreDict):
       policy_id
 
     detail_level can be set to one of ['HIGH', 'MEDIUM', 'LOW']
+
+    fields limits the properties kept for each computer to the specified API
+    keys (e.g., ['hostname', 'overallStatus']). The rest are dropped as the
+    response is parsed
+
+    If lazy is True, each computer is held as a core.CoreProxy and the
+    Computer is only built when it's first used. len() and .find() work on
+    the raw responses
+
+    If upgrade_to is set to 'MEDIUM' or 'HIGH', the computers are loaded at 
+    detail_level (e.g., 'LOW' for a quick listing) and each one is retrieved
+    at upgrade_to the first time a property that wasn't returned is used. 
+    The other computers waiting for an upgrade in the same computer group 
+    are upgraded by the same call. Use .upgrade() to upgrade a set of 
+    computers up front
+    """
+    if upgrade_to:
+      upgrade_to = upgrade_to.upper()
+      if not upgrade_to in filters.EnumHostDetailLevel: raise ValueError("Invalid detail level [{}]. Must be one of {}".format(upgrade_to, filters.EnumHostDetailLevel))
+
+    pending = upgrade_to and self.DETAIL_LEVEL_RANKS[upgrade_to] > self.DETAIL_LEVEL_RANKS.get(detail_level.upper(), 2)
+    previous = getattr(self._local, 'upgrading', False)
+    self._local.upgrading = True # linking the computers mustn't upgrade them
+    try:
+      for api_response in self._retrieve(detail_level=detail_level, computer_id=computer_id, computer_group_id=computer_group_id, policy_id=policy_id, computer_name=computer_name, external_id=external_id, external_group_id=external_group_id, fields=fields) or []:
+        loaded_id = _as_id(api_response.get('ID'))
+        with self._upgrade_lock:
+          if pending:
+            self._upgrades[loaded_id] = upgrade_to
+          else:
+            self._upgrades.pop(loaded_id, None)
+        self._add_computer(api_response, lazy=lazy)
+    finally:
+      self._local.upgrading = previous
+
+    return len(self)
+
+  def upgrade(self, computer_ids=None, detail_level=None, max_workers=8):
+    """
+    Retrieve more detail for computers loaded with .get(upgrade_to=...)
+
+    Defaults to every computer still waiting for an upgrade, at the detail 
+    level requested when it was loaded. The calls are planned by 
+    .plan_get_many() so computers in the same group or policy are retrieved
+    together. The properties returned are merged into the existing Computer
+    objects and any other computer waiting for the same upgrade that a call
+    returns is upgraded as well
+
+    Returns a list of the IDs of the computers upgraded
+    """
+    done = threading.Event()
+    waiting = []
+    with self._upgrade_lock:
+      if computer_ids is None: computer_ids = self._upgrades.keys()
+      if not type(computer_ids) in [type([]), type(set())]: computer_ids = [computer_ids]
+
+      by_detail_level = {}
+      for computer_id in computer_ids:
+        if self._upgrades_in_flight.has_key(computer_id):
+          waiting.append(self._upgrades_in_flight[computer_id]) # another thread is already upgrading it
+          continue
+        level = detail_level or self._upgrades.get(computer_id)
+        if level:
+          by_detail_level.setdefault(level.upper(), set()).add(computer_id)
+          self._upgrades_in_flight[computer_id] = done
+
+    upgraded = set()
+    previous = getattr(self._local, 'upgrading', False)
+    self._local.upgrading = True # reading missing properties while planning mustn't start another upgrade
+    try:
+      for level, requested in by_detail_level.items():
+        # the lock isn't held while the calls are in flight
+        calls = self.plan_get_many(computer_ids=requested, detail_level=level)
+        results = core.CoreWorkerPool(max_workers=max_workers, log_func=self.log).map(lambda call: self._retrieve(**call), calls)
+
+        with self._upgrade_lock:
+          for call, api_responses, err in results:
+            for api_response in api_responses or []:
+              computer_id = _as_id(api_response.get('ID'))
+              if computer_id is None: continue
+              if not computer_id in requested and not self._upgrades.get(computer_id) == level: continue
+              if self.DETAIL_LEVEL_RANKS[level] >= self.DETAIL_LEVEL_RANKS.get(self._upgrades.get(computer_id), 0): self._upgrades.pop(computer_id, None)
+              if self.has_key(computer_id):
+                computer_obj = self[computer_id]
+                if isinstance(computer_obj, core.CoreProxy): computer_obj = computer_obj.hydrate()
+                if self.strings: self.strings.intern_record(api_response)
+                computer_obj._set_properties(api_response, self.log)
+              else:
+                self._add_computer(api_response)
+              upgraded.add(computer_id)
+
+          # don't retry computers that weren't found every time a property is read
+          for computer_id in requested:
+            if self.DETAIL_LEVEL_RANKS[level] >= self.DETAIL_LEVEL_RANKS.get(self._upgrades.get(computer_id), 0): self._upgrades.pop(computer_id, None)
+    finally:
+      self._local.upgrading = previous
+      with self._upgrade_lock:
+        for computer_id, event in self._upgrades_in_flight.items():
+          if event is done: del self._upgrades_in_flight[computer_id]
+      done.set()
+
+    for event in waiting: event.wait()
+    self.log("Upgraded {} computers".format(len(upgraded)), level='debug')
+    return sorted(upgraded)
+
+  @contextlib.contextmanager
+  def without_upgrades(self):
+    """
+    Read the computers inside the with block without upgrading any that 
+    were loaded with .get(upgrade_to=...). Missing properties read as they
+    were loaded
+
+    with mgr.computers.without_upgrades():
+      names = [ core.get_property(computer, 'name') for computer in mgr.computers.values() ]
+    """
+    previous = getattr(self._local, 'upgrading', False)
+    self._local.upgrading = True
+    try:
+      yield
+    finally:
+      self._local.upgrading = previous
+
+  def _upgrade_on_access(self, computer_id):
+    """
+    Upgrade a computer (and the others waiting for the same upgrade in its 
+    computer group) when a property it doesn't have is read. Returns True 
+    if it was upgraded
+    """
+    if getattr(self._local, 'upgrading', False): return False
+
+    with self._upgrade_lock:
+      in_flight = self._upgrades_in_flight.get(computer_id)
+      if not in_flight:
+        if not self._upgrades.has_key(computer_id): return False
+
+        self._local.upgrading = True
+        try:
+          level = self._upgrades[computer_id]
+          computer_ids = set([computer_id])
+          computer_group_id = core.get_property(self[computer_id], 'computer_group_id') if self.has_key(computer_id) else None
+          if computer_group_id:
+            for other_id, other_level in self._upgrades.items():
+              if other_level == level and not self._upgrades_in_flight.has_key(other_id) and self.has_key(other_id) and core.get_property(self[other_id], 'computer_group_id') == computer_group_id: computer_ids.add(other_id)
+        finally:
+          self._local.upgrading = False
+
+    if in_flight:
+      # another thread's call will return it
+      in_flight.wait()
+      return True
+
+    self.log("Upgrading {} computers to {} detail".format(len(computer_ids), level), level='debug')
+    return computer_id in self.upgrade(computer_ids)
+
+  def _on_missing_property(self, proxy, name):
+    """
+    Called by a lazy computer's CoreProxy when a property read from its API
+    response is missing or empty
+    """
+    if name.startswith('_') or not translation.Terms.new_to_api.has_key(name): return False
+    return self._upgrade_on_access(_as_id(proxy.raw.get('ID')))
+
+  def _retrieve(self, detail_level='HIGH', computer_id=None, computer_group_id=None, policy_id=None, computer_name=None, external_id=None, external_group_id=None, fields=None):
+    """
+    Make the call to retrieve all or a filtered set of computers
+
+    Takes the same filters as .get(). Returns a list of the API responses for
+    each computer or None if the call failed
     """
     # make sure we have a valid detail level
     detail_level = detail_level.upper()
     if not detail_level in filters.EnumHostDetailLevel: detail_level = 'HIGH'
 
     call = None
-    if external_id and external_group_id:
+    if external_id or external_group_id:
       call = self.manager._get_request_format(call='hostDetailRetrieveByExternal')
       if external_id:
         filter = filters.create_external_filter(
@@ -83,7 +293,7 @@ class Computers(core.CoreDict):
 		)
       elif policy_id:
         filter = filters.create_host_filter(
-			securityProfileID=policyId, 
+			securityProfileID=policy_id, 
 			operator='HOSTS_USING_SECURITY_PROFILE'
 		)
       else:
@@ -92,35 +302,282 @@ class Computers(core.CoreDict):
             'hostFilter': filter,
             'hostDetailLevel': detail_level
       }
+    call['fields'] = fields
     response = self.manager._request(call)
     
     if response and response['status'] == 200:
+      if not response['data']: response['data'] = []
       if not type(response['data']) == type([]): response['data'] = [response['data']]
-      for computer in response['data']:
-        computer_obj = Computer(self.manager, computer, self.log)
-        if computer_obj:
-          self[computer_obj.id] = computer_obj
-          self.log("Added Computer {}".format(computer_obj.id), level='debug')
-          
-          try:
-            # add this computer to any appropriate groups on the Manager()
-            if 'computer_group_id' in dir(computer_obj) and computer_obj.computer_group_id:
-              if self.manager.computer_groups and self.manager.computer_groups.has_key(computer_obj.computer_group_id):
-                self.manager.computer_groups[computer_obj.computer_group_id].computers[computer_obj.id] = computer_obj
-                self.log("Added Computer {} to ComputerGroup {}".format(computer_obj.id, computer_obj.computer_group_id), level='debug')
-          except Exception, hostGroupid_err:
-            self.log("Could not add Computer {} to ComputerGroup".format(computer_obj.id), err=hostGroupid_err)
-
-          try: 
-            # add this computer to any appropriate policies on the Manager()
-            if 'policy_id' in dir(computer_obj) and computer_obj.policy_id:
-              if self.manager.policies and self.manager.policies.has_key(computer_obj.policy_id):
-                self.manager.policies[computer_obj.policy_id].computers[computer_obj.id] = computer_obj
-                self.log("Added Computer {} to Policy {}".format(computer_obj.id, computer_obj.policy_id), level='debug')
-          except Exception, securityProfileid_err:
-            self.log("Could not add Computer {} to Policy".format(computer_obj.id), err=securityProfileid_err)
+      if call['call'] == 'hostDetailRetrieve' and call['data']['hostFilter']['type'] == 'ALL_HOSTS':
+        self._fleet_size = len(response['data']) # used to plan .get_many()
+      return response['data']
 
-    return len(self)
+    return None
+
+  def plan_get_many(self, computer_ids=None, computer_names=None, external_ids=None, detail_level='HIGH'):
+    """
+    Plan the cheapest set of calls to retrieve the specified computers
+
+    Names and external IDs of computers that are already loaded are resolved 
+    to computer IDs. The computer IDs are then retrieved with whichever of 
+    these is estimated to cost the least, based on the number of calls and 
+    the number of computers downloaded:
+
+      - one SPECIFIC_HOST call per computer
+      - one HOSTS_IN_GROUP call per computer group (or SPECIFIC_HOST where
+        the group is mostly computers that weren't requested)
+      - one HOSTS_USING_SECURITY_PROFILE call per policy (same as above)
+      - one ALL_HOSTS call, filtered locally
+
+    Group and policy membership and the size of the fleet come from the 
+    computers already loaded
+
+    Returns a list of the keyword arguments for each call to ._retrieve()
+    """
+    detail_level = detail_level.upper()
+    if not detail_level in filters.EnumHostDetailLevel: detail_level = 'HIGH'
+    computer_ids = set(computer_ids or [])
+    computer_names = set(computer_names or [])
+    external_ids = set(external_ids or [])
+
+    previous = getattr(self._local, 'upgrading', False)
+    self._local.upgrading = True # reading the computers to plan the calls mustn't upgrade them
+    try:
+      return self._plan_get_many(computer_ids, computer_names, external_ids, detail_level)
+    finally:
+      self._local.upgrading = previous
+
+  def _plan_get_many(self, computer_ids, computer_names, external_ids, detail_level):
+    """
+    Plan the calls for .plan_get_many(). Lazy computers are read without 
+    building them
+    """
+    call_cost = self.PLANNER_CALL_COST
+    computer_cost = self.PLANNER_COMPUTER_COST[detail_level]
+
+    # resolve names and external IDs using the computers already loaded
+    if computer_names or external_ids:
+      for computer_id, computer in self.items():
+        name = core.get_property(computer, 'name')
+        if name in computer_names:
+          computer_names.discard(name)
+          computer_ids.add(computer_id)
+        external_id = core.get_property(computer, 'external_id')
+        if external_id in external_ids:
+          external_ids.discard(external_id)
+          computer_ids.add(computer_id)
+
+    fleet_size = self._fleet_size or max(len(self), self.PLANNER_DEFAULT_FLEET_SIZE)
+    all_hosts_cost = call_cost + fleet_size * computer_cost
+    by_name_cost = (len(computer_names) + len(external_ids)) * (call_cost + computer_cost)
+
+    def plan_by(attr, filter_key):
+      """
+      Plan the calls when the requested computers are retrieved by group or policy
+      """
+      members = {}
+      for computer_id, computer in self.items():
+        value = core.get_property(computer, attr)
+        if value: members.setdefault(value, set()).add(computer_id)
+
+      calls = []
+      cost = 0
+      remaining = set(computer_ids)
+      for value, member_ids in members.items():
+        requested = member_ids & remaining
+        if not requested: continue
+        if call_cost + len(member_ids) * computer_cost < len(requested) * (call_cost + computer_cost):
+          calls.append({ filter_key: value })
+          cost += call_cost + len(member_ids) * computer_cost
+          remaining -= requested
+      for computer_id in remaining:
+        calls.append({ 'computer_id': computer_id })
+        cost += call_cost + computer_cost
+
+      return (cost, calls)
+
+    plans = [
+      (len(computer_ids) * (call_cost + computer_cost), [ { 'computer_id': computer_id } for computer_id in computer_ids ]),
+      plan_by('computer_group_id', 'computer_group_id'),
+      plan_by('security_profile_id', 'policy_id'),
+      ]
+    cost, calls = min(plans, key=lambda plan: (plan[0], len(plan[1])))
+    calls = calls + [ { 'computer_name': name } for name in computer_names ] + [ { 'external_id': external_id } for external_id in external_ids ]
+    cost += by_name_cost
+
+    if cost > all_hosts_cost:
+      calls = [{}]
+      cost = all_hosts_cost
+
+    self.log("Planned {} calls with an estimated cost of {:.2f} to retrieve {} computers".format(len(calls), cost, len(computer_ids) + len(computer_names) + len(external_ids)), level='debug')
+    return [ dict(call, detail_level=detail_level) for call in calls ]
+
+  def get_many(self, computer_ids=None, computer_names=None, external_ids=None, detail_level='HIGH', max_workers=8):
+    """
+    Get a batch of computers by ID, name and/or external ID with as few calls as possible
+
+    See .plan_get_many() for how the calls are chosen. The calls are made by 
+    up to max_workers threads. Only the computers that were requested are 
+    added, any other computers returned by a group, policy or ALL_HOSTS call
+    are discarded
+
+    Returns a list of the IDs of the requested computers that were found
+    """
+    computer_ids = set(computer_ids or [])
+    computer_names = set(computer_names or [])
+    external_ids = set(external_ids or [])
+    if not (computer_ids or computer_names or external_ids): return []
+
+    def matches(computer_obj):
+      return computer_obj.id in computer_ids or getattr(computer_obj, 'name', None) in computer_names or getattr(computer_obj, 'external_id', None) in external_ids
+
+    results = set()
+    def on_complete(call, api_responses, err):
+      for api_response in api_responses or []:
+        computer_obj = Computer(None, api_response)
+        if 'id' in dir(computer_obj) and matches(computer_obj):
+          with self._upgrade_lock:
+            if self.DETAIL_LEVEL_RANKS.get(detail_level.upper(), 2) >= self.DETAIL_LEVEL_RANKS.get(self._upgrades.get(computer_obj.id), 0): self._upgrades.pop(computer_obj.id, None)
+          self._add_computer(api_response)
+          results.add(computer_obj.id)
+
+    calls = self.plan_get_many(computer_ids=computer_ids, computer_names=computer_names, external_ids=external_ids, detail_level=detail_level)
+    core.CoreWorkerPool(max_workers=max_workers, log_func=self.log).map(lambda call: self._retrieve(**call), calls, callback=on_complete)
+
+    return sorted(results)
+
+  def _fingerprint(self, api_response, ignored_fields=None):
+    """
+    Create a fingerprint of an API response for a computer
+    """
+    ignored_fields = ignored_fields if ignored_fields is not None else self.SYNC_IGNORED_FIELDS
+    fields = dict([ (k, v) for k, v in api_response.items() if not k in ignored_fields ])
+    return hashlib.sha1(json.dumps(fields, sort_keys=True)).hexdigest()
+
+  def _remove_computer(self, computer_id):
+    """
+    Remove a computer and unlink it from its ComputerGroup and Policy
+    """
+    computer_obj = self.pop(computer_id, None)
+    self._fingerprints.pop(computer_id, None)
+    with self._upgrade_lock: self._upgrades.pop(computer_id, None)
+    if not computer_obj: return None
+
+    group_id = _as_id(core.get_property(computer_obj, 'computer_group_id'))
+    if group_id and self.manager.computer_groups and self.manager.computer_groups.has_key(group_id):
+      self.manager.computer_groups[group_id].computers.pop(computer_id, None)
+
+    policy_id = _as_id(core.get_property(computer_obj, 'security_profile_id'))
+    if policy_id and self.manager.policies and self.manager.policies.has_key(policy_id):
+      self.manager.policies[policy_id].computers.pop(computer_id, None)
+
+    self.log("Removed Computer {}".format(computer_id), level='debug')
+    return computer_obj
+
+  def sync(self, detail_level='HIGH', max_workers=8, full_refresh_ratio=0.5, ignored_fields=None):
+    """
+    Bring the computers up to date with the fewest possible downloads at detail_level
+
+    A LOW detail pass retrieves every computer and each one is fingerprinted.
+    Only computers that are new or whose fingerprint changed since the last 
+    .sync() are retrieved again at detail_level, up to max_workers at a time.
+    Computers loaded by .get() that haven't been fingerprinted yet are 
+    fingerprinted by this pass and compared from the next .sync() on.
+    If more than full_refresh_ratio of the computers need a refresh, a single
+    call retrieves all of them instead. Computers that no longer exist on the
+    Manager are removed
+
+    Fields listed in ignored_fields (default: .SYNC_IGNORED_FIELDS) are left
+    out of the fingerprint. Changes that don't appear at the LOW detail level
+    (e.g., rule assignments) are not detected, use .get() to force a full refresh
+
+    Returns a dict with the sets of 'added', 'changed' and 'removed' computer 
+    IDs or None if the LOW detail pass failed
+    """
+    low_detail = self._retrieve(detail_level='LOW')
+    if low_detail is None:
+      self.log("Could not retrieve the current list of computers to sync", level='warning')
+      return None
+
+    fingerprints = {}
+    for api_response in low_detail:
+      computer_obj = Computer(None, api_response)
+      if 'id' in dir(computer_obj): fingerprints[computer_obj.id] = self._fingerprint(api_response, ignored_fields)
+
+    results = {
+      'added': set([ computer_id for computer_id in fingerprints.keys() if not self.has_key(computer_id) ]),
+      'changed': set([ computer_id for computer_id, fingerprint in fingerprints.items() if self.has_key(computer_id) and self._fingerprints.has_key(computer_id) and self._fingerprints[computer_id] != fingerprint ]),
+      'removed': set([ computer_id for computer_id in self.keys() if not fingerprints.has_key(computer_id) ]),
+      }
+
+    # there's nothing to compare computers loaded by .get() to yet
+    for computer_id, fingerprint in fingerprints.items():
+      if self.has_key(computer_id) and not self._fingerprints.has_key(computer_id): self._fingerprints[computer_id] = fingerprint
+
+    to_refresh = results['added'] | results['changed']
+    if to_refresh and len(to_refresh) > full_refresh_ratio * len(fingerprints):
+      self.log("Refreshing all {} computers at {} detail".format(len(fingerprints), detail_level), level='debug')
+      for api_response in self._retrieve(detail_level=detail_level) or []:
+        computer_obj = self._add_computer(api_response)
+        if computer_obj and fingerprints.has_key(computer_obj.id): self._fingerprints[computer_obj.id] = fingerprints[computer_obj.id]
+    elif to_refresh:
+      self.log("Refreshing {} of {} computers at {} detail".format(len(to_refresh), len(fingerprints), detail_level), level='debug')
+      def refresh(computer_id):
+        return self._retrieve(detail_level=detail_level, computer_id=computer_id)
+
+      def on_complete(computer_id, api_responses, err):
+        for api_response in api_responses or []:
+          computer_obj = self._add_computer(api_response)
+          if computer_obj and computer_obj.id == computer_id: self._fingerprints[computer_id] = fingerprints[computer_id]
+
+      core.CoreWorkerPool(max_workers=max_workers, log_func=self.log).map(refresh, sorted(to_refresh), callback=on_complete)
+
+    for computer_id in results['removed']: self._remove_computer(computer_id)
+
+    self.log("Synced computers: {} added, {} changed, {} removed".format(len(results['added']), len(results['changed']), len(results['removed'])))
+    return results
+
+  def _create_computer(self, api_response):
+    computer_obj = Computer(self.manager, api_response, self.log)
+    if self._upgrades.has_key(computer_obj.__dict__.get('id')): computer_obj._hide_empty_properties()
+    return computer_obj
+
+  def _add_computer(self, api_response, lazy=False):
+    """
+    Convert an API response to a Computer (or a CoreProxy for one if lazy) and
+    link it to its ComputerGroup and Policy
+    """
+    if self.strings: self.strings.intern_record(api_response)
+    if lazy:
+      computer_obj = core.CoreProxy(api_response, self._create_computer, self._on_missing_property)
+    else:
+      computer_obj = self._create_computer(api_response)
+    if computer_obj:
+      computer_id = core.get_property(computer_obj, 'id')
+      self[computer_id] = computer_obj
+      self.log("Added Computer {}".format(computer_id), level='debug')
+      
+      try:
+        # add this computer to any appropriate groups on the Manager()
+        computer_group_id = _as_id(core.get_property(computer_obj, 'computer_group_id'))
+        if computer_group_id:
+          if self.manager.computer_groups and self.manager.computer_groups.has_key(computer_group_id):
+            self.manager.computer_groups[computer_group_id].computers[computer_id] = computer_obj
+            self.log("Added Computer {} to ComputerGroup {}".format(computer_id, computer_group_id), level='debug')
+      except Exception, hostGroupid_err:
+        self.log("Could not add Computer {} to ComputerGroup".format(computer_id), err=hostGroupid_err)
+
+      try: 
+        # add this computer to any appropriate policies on the Manager()
+        policy_id = _as_id(core.get_property(computer_obj, 'security_profile_id'))
+        if policy_id:
+          if self.manager.policies and self.manager.policies.has_key(policy_id):
+            self.manager.policies[policy_id].computers[computer_id] = computer_obj
+            self.log("Added Computer {} to Policy {}".format(computer_id, policy_id), level='debug')
+      except Exception, securityProfileid_err:
+        self.log("Could not add Computer {} to Policy".format(computer_id), err=securityProfileid_err)
+
+    return computer_obj
 
     def create(self, name, external=False, externalID=None, hostGroupID=None, 
 			   hostType='STANDARD', platform=None, securityProfileID=None):
@@ -211,6 +668,28 @@ class Computer(core.CoreObject):
     self.recommended_rules = None
     if api_response: self._set_properties(api_response, log_func)
 
+  def __getattr__(self, name):
+    """
+    Only called for properties that aren't set. If the computer was loaded
+    with Computers.get(upgrade_to=...), it's retrieved in more detail the 
+    first time one of its API properties is missing
+    """
+    if name.startswith('_') or not translation.Terms.new_to_api.has_key(name): raise AttributeError(name)
+    manager = self.__dict__.get('manager')
+    if manager and manager.computers._upgrade_on_access(self.__dict__.get('id')) and self.__dict__.has_key(name): return self.__dict__[name]
+    if name in self.__dict__.get('_empty_properties', ()): return None # returned empty and not upgraded
+    raise AttributeError(name)
+
+  def _hide_empty_properties(self):
+    """
+    Remove the API properties that were returned empty (xsi:nil) at a lower
+    detail level so reading one goes through __getattr__ and upgrades the
+    computer
+    """
+    empty = [ name for name, value in self.__dict__.items() if value is None and translation.Terms.new_to_api.has_key(name) ]
+    for name in empty: del self.__dict__[name]
+    self._empty_properties = set(empty)
+
   def send_events(self):
     """
     Send the latest set of events to this computer's Manager
@@ -322,12 +801,20 @@ class ComputerGroup(core.CoreObject):
     """
     return self.manager.assign_policy_to_computers(policy_id, self.computers.keys())
 
-  def get_recommended_rules(self):
+  def get_recommended_rules(self, max_workers=8):
     """
     Recommend a set of rules to apply for each computer in this group
+
+    The computers are queried concurrently by up to max_workers threads
     """
-    ids = self.computers.keys()
-    return {id:self.computers[id].get_recommended_rules() for id in ids}
+    recommendations = self.manager.get_rule_recommendations_for_computers(self.computers.keys(), max_workers=max_workers)
+
+    results = {}
+    for computer_id, computer in self.computers.items():
+      computer.recommended_rules = recommendations.get_rules_for_computer(computer_id)
+      results[computer_id] = computer.recommended_rules['total_recommedations']
+
+    return results
 
   def activate(self):
       ''' Activate all hosts in this group.
@@ -347,4 +834,332 @@ class ComputerGroup(core.CoreObject):
   def rebuild_baseline(self):
       ''' Rebuild integrity scan baselines all hosts in this group.
       '''
-      self.manager.rebuild_baseline([id for id in self.computers.keys()])
\ No newline at end of file
+      self.manager.rebuild_baseline([id for id in self.computers.keys()])
+
+class ComputerStatusFuture(core.CoreFuture):
+  """
+  The pending status of a computer being watched by a ComputerStatusWatcher
+  """
+  def __init__(self, computer_id, log_func=None):
+    core.CoreFuture.__init__(self, log_func)
+    self.computer_id = computer_id
+    self.status = None
+    self.computer = None
+    self.timed_out = False
+
+  def result(self, timeout=None):
+    """
+    Wait for the computer to reach the target status and return that status
+
+    Returns None if the wait timed out
+    """
+    self._done.wait(timeout)
+    return self.status if self.done() and not self.timed_out else None
+
+  def _resolve(self, status, computer=None, timed_out=False):
+    self.status = status
+    self.computer = computer
+    self.timed_out = timed_out
+    core.CoreFuture._resolve(self, status)
+
+class ComputerStatusWatcher(object):
+  """
+  Watch a set of computers until each reaches a target status
+
+  Each poll retrieves the computers at a low detail level with one 
+  HOSTS_IN_GROUP call per computer group instead of one call per computer. 
+  Computers that aren't in a known group are retrieved individually, or with
+  a single ALL_HOSTS call if there are more than all_hosts_threshold of them.
+  Only the status fields (.STATUS_FIELDS) of the computers being watched are
+  merged into the matching Computer in Manager.computers. Empty values are 
+  skipped so a low detail poll doesn't clear what's already loaded. Other 
+  computers returned by a group or ALL_HOSTS call are ignored
+
+  The poll interval starts at interval seconds and grows by backoff each 
+  time a poll sees no change, up to max_interval. Any change resets it
+
+  target_status is a regex matched against overall_status, a list of them, 
+  or a callable(computer) that returns True once the computer is done
+  """
+  # the API keys merged into Manager.computers from each poll
+  STATUS_FIELDS = [
+    'overallStatus',
+    'overallAntiMalwareStatus',
+    'overallDpiStatus',
+    'overallFirewallStatus',
+    'overallIntegrityMonitoringStatus',
+    'overallLogInspectionStatus',
+    'overallWebReputationStatus',
+    'overallLastSuccessfulCommunication',
+    ]
+
+  def __init__(self, manager, computer_ids, target_status=r'^Managed \(Online\)', detail_level='LOW', interval=5, max_interval=120, backoff=1.5, timeout=None, all_hosts_threshold=50):
+    self.manager = manager
+    self.log = self.manager.log if self.manager else None
+    self.target_status = target_status
+    self.detail_level = detail_level
+    self.interval = interval
+    self.max_interval = max_interval
+    self.backoff = backoff
+    self.timeout = timeout
+    self.all_hosts_threshold = all_hosts_threshold
+    self.polls = 0
+    self.calls = 0
+
+    if not type(computer_ids) == type([]): computer_ids = list(computer_ids) if hasattr(computer_ids, '__iter__') else [computer_ids]
+    self.futures = {}
+    for computer_id in computer_ids: self.futures[computer_id] = ComputerStatusFuture(computer_id, self.log)
+
+    self._last_status = {}
+    self._cancelled = threading.Event()
+    self._thread = None
+
+  @property
+  def pending(self): return [ computer_id for computer_id, future in self.futures.items() if not future.done() ]
+
+  def _is_target_status(self, computer):
+    """
+    Has the computer reached the target status?
+    """
+    if callable(self.target_status):
+      try:
+        return self.target_status(computer)
+      except Exception:
+        self.log("target_status failed for Computer {}".format(getattr(computer, 'id', None)), err=traceback.format_exc())
+        return False
+
+    status = core.get_property(computer, 'overall_status')
+    if not status: return False
+
+    targets = self.target_status if type(self.target_status) == type([]) else [self.target_status]
+    for target in targets:
+      if re.search(target, status): return True
+
+    return False
+
+  def _update_computer(self, api_response):
+    """
+    Merge the status fields of a partial API response into the matching 
+    Computer in Manager.computers
+
+    Returns the Computer (the polled one if it isn't loaded) or None if it 
+    isn't being watched
+    """
+    computer_id = _as_id(api_response.get('ID'))
+    if not computer_id in self.futures or self.futures[computer_id].done(): return None
+
+    status = dict([ (k, v) for k, v in api_response.items() if k in self.STATUS_FIELDS and core._translate_property(k, v)[1] is not None ])
+    with self.manager.computers._upgrade_lock:
+      if not self.manager.computers.has_key(computer_id): return Computer(None, api_response, self.log)
+
+      computer = self.manager.computers[computer_id]
+      if isinstance(computer, core.CoreProxy) and not computer.hydrated:
+        computer.raw.update(status)
+      else:
+        computer._set_properties(status, self.log)
+
+    return computer
+
+  def poll(self):
+    """
+    Check the status of the pending computers once
+
+    Returns the number of computers whose status changed
+    """
+    self.polls += 1
+    pending = set(self.pending)
+    if not pending: return 0
+
+    # plan the calls from what is already known about each computer
+    groups = {}
+    ungrouped = []
+    for computer_id in pending:
+      group_id = _as_id(core.get_property(self.manager.computers[computer_id], 'computer_group_id')) if self.manager.computers.has_key(computer_id) else None
+      if group_id:
+        groups.setdefault(group_id, []).append(computer_id)
+      else:
+        ungrouped.append(computer_id)
+
+    calls = []
+    for group_id, group_computer_ids in groups.items():
+      if len(group_computer_ids) > 1:
+        calls.append({ 'computer_group_id': group_id })
+      else:
+        ungrouped.extend(group_computer_ids)
+
+    if len(ungrouped) > self.all_hosts_threshold:
+      calls.append({})
+    else:
+      for computer_id in ungrouped: calls.append({ 'computer_id': computer_id })
+
+    changed = 0
+    for call in calls:
+      self.calls += 1
+      for api_response in self.manager.computers._retrieve(detail_level=self.detail_level, **call) or []:
+        computer_id = _as_id(api_response.get('ID'))
+        if not computer_id in pending: continue
+        computer = self._update_computer(api_response)
+        if not computer: continue
+
+        status = core.get_property(computer, 'overall_status')
+        if status != self._last_status.get(computer_id):
+          self._last_status[computer_id] = status
+          changed += 1
+
+        if self._is_target_status(computer) and not self.futures[computer_id].done():
+          self.futures[computer_id]._resolve(status, computer)
+          self.log("Computer {} reached status [{}]".format(computer_id, status), level='debug')
+
+    return changed
+
+  def run(self):
+    """
+    Poll until every computer reaches the target status, the watch times out or it's cancelled
+
+    Returns the dict of computer ID => ComputerStatusFuture
+    """
+    started = time.time()
+    interval = self.interval
+    while self.pending and not self._cancelled.is_set():
+      try:
+        changed = self.poll()
+      except Exception:
+        # keep watching, the next poll may succeed
+        self.log("Could not poll the status of {} computers".format(len(self.pending)), err=traceback.format_exc())
+        changed = 0
+      if not self.pending: break
+
+      if self.timeout and time.time() - started > self.timeout:
+        for computer_id in self.pending:
+          computer = self.manager.computers[computer_id] if self.manager.computers.has_key(computer_id) else None
+          self.futures[computer_id]._resolve(self._last_status.get(computer_id), computer, timed_out=True)
+        self.log("Timed out watching {} computers".format(len([ f for f in self.futures.values() if f.timed_out ])), level='warning')
+        break
+
+      interval = self.interval if changed else min(interval * self.backoff, self.max_interval)
+      self.log("Waiting on {} computers. Next poll in {:.1f}s".format(len(self.pending), interval), level='debug')
+      self._cancelled.wait(interval)
+
+    return self.futures
+
+  def start(self):
+    """
+    Run the watcher in a background thread
+    """
+    if not (self._thread and self._thread.is_alive()):
+      self._thread = threading.Thread(target=self.run)
+      self._thread.daemon = True
+      self._thread.start()
+
+    return self
+
+  def wait(self, timeout=None):
+    """
+    Wait for a watcher running in the background to finish
+    """
+    if self._thread: self._thread.join(timeout)
+    return self.futures
+
+  def cancel(self):
+    """
+    Stop polling. Futures for computers still pending are left unresolved
+    """
+    self._cancelled.set()
+
+class ComputerLoader(object):
+  """
+  Collect individual computer lookups and resolve them together
+
+  Each call to .load() returns a core.CoreFuture for the Computer. Lookups 
+  made within window seconds of each other are resolved by a single 
+  Computers.get_many() call, which picks the cheapest way to retrieve them.
+  Each computer ID is only looked up once for the life of the loader, so
+  repeated lookups are free
+
+  For example, to find the computer for a set of events;
+
+    loader = computers.ComputerLoader(mgr)
+    futures = [ loader.load(event.computer_id) for event in events ]
+    for future in futures:
+      computer = future.result()
+  """
+  def __init__(self, manager, detail_level='HIGH', window=0.05, max_batch_size=500, use_loaded=True):
+    self.manager = manager
+    self.log = self.manager.log if self.manager else None
+    self.detail_level = detail_level
+    self.window = window
+    self.max_batch_size = max_batch_size
+    self.use_loaded = use_loaded
+    self.batches = 0
+    self._memo = {}
+    self._queue = []
+    self._timer = None
+    self._lock = threading.Lock()
+
+  def load(self, computer_id):
+    """
+    Get a future for the Computer with the specified ID
+
+    The future resolves to None if the computer doesn't exist
+    """
+    with self._lock:
+      if self._memo.has_key(computer_id): return self._memo[computer_id]
+
+      future = core.CoreFuture()
+      self._memo[computer_id] = future
+      if self.use_loaded and self.manager.computers.has_key(computer_id):
+        future._resolve(self.manager.computers[computer_id])
+        return future
+
+      self._queue.append(computer_id)
+      if len(self._queue) >= self.max_batch_size:
+        thread = threading.Thread(target=self.dispatch)
+        thread.daemon = True
+        thread.start()
+      elif not self._timer:
+        self._timer = threading.Timer(self.window, self.dispatch)
+        self._timer.daemon = True
+        self._timer.start()
+
+    return future
+
+  def load_many(self, computer_ids):
+    """
+    Get the Computers with the specified IDs without waiting for the batching window
+
+    Returns a dict of computer ID => Computer (or None if it doesn't exist)
+    """
+    futures = dict([ (computer_id, self.load(computer_id)) for computer_id in computer_ids ])
+    self.dispatch()
+    return dict([ (computer_id, future.result()) for computer_id, future in futures.items() ])
+
+  def dispatch(self):
+    """
+    Resolve all of the lookups queued so far
+    """
+    with self._lock:
+      if self._timer: self._timer.cancel()
+      self._timer = None
+      batch = self._queue
+      self._queue = []
+    if not batch: return
+
+    self.batches += 1
+    self.log("Loading {} computers in one batch".format(len(batch)), level='debug')
+    err = None
+    try:
+      self.manager.computers.get_many(computer_ids=batch, detail_level=self.detail_level)
+    except Exception:
+      err = traceback.format_exc()
+      self.log("Could not load computers {}".format(batch), err=err)
+
+    for computer_id in batch:
+      computer = self.manager.computers[computer_id] if self.manager.computers.has_key(computer_id) else None
+      self._memo[computer_id]._resolve(computer, err=err)
+
+  def clear(self):
+    """
+    Forget the lookups already made so they're retrieved again
+    """
+    with self._lock:
+      self._memo = dict([ (computer_id, future) for computer_id, future in self._memo.items() if not future.done() ])
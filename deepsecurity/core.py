@@ -1,9 +1,14 @@
 # standard library
 import collections
+import contextlib
 import json
 import logging
+import os
+import Queue
 import re
 import ssl
+import sys
+import threading
 import urllib
 import urllib2
 import traceback
@@ -14,6 +19,104 @@ import libs.xmltodict as xmltodict
 # project libraries
 import translation
 
+# keys kept in every projection so records can still be identified
+PROJECTION_KEYS = re.compile(r'^(ID|eventID|\w+EventID|@xsi:nil)$')
+
+def _get_local_name(name):
+  return name.rsplit(':', 1)[-1]
+
+def _in_projection(name, fields):
+  name = _get_local_name(name)
+  return name in fields or PROJECTION_KEYS.search(name)
+
+def project(data, fields):
+  """
+  Drop the keys that aren't in fields from the records in an API response
+
+  Records are the outermost dicts with at least one projected key. The
+  dicts and lists wrapping them are kept as is
+  """
+  if isinstance(data, list): return [ project(item, fields) for item in data ]
+  if not isinstance(data, dict): return data
+  if any([ _in_projection(k, fields) for k in data.keys() ]):
+    return data.__class__([ (k, v) for k, v in data.items() if _in_projection(k, fields) ])
+  return data.__class__([ (k, project(v, fields)) for k, v in data.items() ])
+
+class _ProjectedParser(object):
+  """
+  Wraps an expat parser to drop the elements that aren't in a projection
+  before they reach xmltodict
+
+  The depth of the records is the shallowest depth a projected element is
+  seen at. From then on, other elements at that depth are skipped along with
+  everything inside of them and the attributes of the records' elements are
+  dropped (other than xsi:nil). Elements of the records before the first
+  projected one can't be recognized as they're parsed so project() is
+  still applied to the result
+  """
+  _HANDLERS = ['StartElementHandler', 'EndElementHandler', 'CharacterDataHandler']
+
+  def __init__(self, parser, fields):
+    self.__dict__['_parser'] = parser
+    self.__dict__['_fields'] = fields
+    self.__dict__['_handlers'] = {}
+    self.__dict__['_depth'] = 0
+    self.__dict__['_record_depth'] = None
+    self.__dict__['_skip_depth'] = None
+    parser.StartElementHandler = self._start
+    parser.EndElementHandler = self._end
+    parser.CharacterDataHandler = self._characters
+
+  def __getattr__(self, name): return getattr(self._parser, name)
+
+  def __setattr__(self, name, value):
+    if name in self._HANDLERS:
+      self._handlers[name] = value
+    elif name.startswith('_'):
+      self.__dict__[name] = value
+    else:
+      setattr(self._parser, name, value)
+
+  def _start(self, name, attrs):
+    self._depth += 1
+    if self._skip_depth is not None: return
+
+    if _in_projection(name, self._fields):
+      if self._record_depth is None or self._depth < self._record_depth: self._record_depth = self._depth
+    elif self._depth == self._record_depth:
+      self._skip_depth = self._depth
+      return
+
+    if attrs and self._record_depth is not None and self._depth >= self._record_depth:
+      if isinstance(attrs, dict):
+        attrs = dict([ (k, v) for k, v in attrs.items() if k == 'xsi:nil' ])
+      else:
+        attrs = [ item for i in range(0, len(attrs), 2) if attrs[i] == 'xsi:nil' for item in attrs[i:i + 2] ]
+
+    self._handlers['StartElementHandler'](name, attrs)
+
+  def _end(self, name):
+    self._depth -= 1
+    if self._skip_depth is not None:
+      if self._depth < self._skip_depth: self._skip_depth = None
+      return
+
+    self._handlers['EndElementHandler'](name)
+
+  def _characters(self, data):
+    if self._skip_depth is None: self._handlers['CharacterDataHandler'](data)
+
+class _ProjectedExpat(object):
+  """
+  Stands in for the expat module passed to xmltodict.parse() so the
+  projection is applied as the XML is parsed
+  """
+  def __init__(self, fields):
+    self.fields = fields
+
+  def ParserCreate(self, *args, **kwargs):
+    return _ProjectedParser(xmltodict.expat.ParserCreate(*args, **kwargs), self.fields)
+
 class CoreApi(object):
   def __init__(self):
     self.API_TYPE_REST = 'REST'
@@ -24,6 +127,7 @@ class CoreApi(object):
     self.ignore_ssl_validation = False
     self._log_at_level = logging.WARNING
     self.logger = self._set_logging()
+    self._projections = threading.local()
 
   # *******************************************************************
   # properties
@@ -87,6 +191,37 @@ class CoreApi(object):
       'data': None,
     }
 
+  def _get_projection(self, fields):
+    """
+    Get the set of API keys to keep for a projection. Fields can be API keys
+    (e.g., 'hostID') or property names (e.g., 'computer_id')
+    """
+    if not fields: return None
+    if type(fields) in [type(''), type(u'')]: fields = [fields]
+    projection = set()
+    for field in fields:
+      projection.add(field)
+      if translation.Terms.new_to_api.has_key(field): projection.add(translation.Terms.new_to_api[field])
+
+    return projection
+
+  @contextlib.contextmanager
+  def projection(self, fields):
+    """
+    Only keep the specified fields of the records returned by the calls made
+    by this thread inside the with block. The other fields are dropped while
+    the response is parsed
+
+    with mgr.projection(['hostID', 'sourceIP']):
+      mgr.firewall_events.get()
+    """
+    previous = getattr(self._projections, 'fields', None)
+    self._projections.fields = self._get_projection(fields)
+    try:
+      yield
+    finally:
+      self._projections.fields = previous
+
   def _request(self, request, auth_required=True):
     """
     Make an HTTP(S) request to an API endpoint based on what's specified in the 
@@ -113,11 +248,17 @@ class CoreApi(object):
       use_cookie_auth
         Whether or not to use an HTTP Cookie in lieu of a querystring for authorization
 
+      fields
+        The API keys to keep for each record in the response. Defaults to the
+        projection set with .projection(), if any
+
     ## Output
 
     Returns a dict:
       status
-        Number HTTP status code returned by the response, if any
+        Number HTTP status code returned by the response, if any. Error
+        responses (e.g., a SOAP fault) keep their status but have no raw or
+        data. None means the Manager couldn't be reached
 
       raw
         The raw contents of the response, if any
@@ -230,14 +371,16 @@ class CoreApi(object):
 
     # Make the request
     response = None
+    error_status = None
     try:
       response = url_opener.open(url_request)
-    except Exception:
+    except Exception, err:
+      if isinstance(err, urllib2.HTTPError): error_status = err.code
       self.log("Failed to make {} {} call [{}]".format(request['api'].upper(), request_type, request['call'].lstrip('/')), err=traceback.format_exc())
 
     # Convert the request from JSON
     result = {
-      'status': response.getcode() if response else None,
+      'status': response.getcode() if response else error_status,
       'raw': response.read() if response else None,
       'headers': dict(response.headers) if response else dict(),
       'data': None
@@ -245,12 +388,17 @@ class CoreApi(object):
     bytes_of_data = len(result['raw']) if result['raw'] else 0
     self.log("Call returned HTTP status {} and {} bytes of data".format(result['status'], bytes_of_data), level='debug')
 
+    fields = self._get_projection(request.get('fields')) or getattr(self._projections, 'fields', None)
+
     if response:
       if request['api'] == self.API_TYPE_SOAP:
         # XML response
         try:
           if result['raw']:
-            full_data = xmltodict.parse(result['raw'])
+            if fields:
+              full_data = xmltodict.parse(result['raw'], expat=_ProjectedExpat(fields))
+            else:
+              full_data = xmltodict.parse(result['raw'])
             if full_data.has_key('soapenv:Envelope') and full_data['soapenv:Envelope'].has_key('soapenv:Body'):
               result['data'] = full_data['soapenv:Envelope']['soapenv:Body']
               if result['data'].has_key('{}Response'.format(request['call'])):
@@ -260,6 +408,7 @@ class CoreApi(object):
                   result['data'] = result['data']['{}Response'.format(request['call'])]
             else:
               result['data'] = full_data
+            if fields: result['data'] = project(result['data'], fields)
         except Exception:
           self.log("Could not convert response from call {}".format(request['call']), err=traceback.format_exc())
       else:
@@ -268,6 +417,7 @@ class CoreApi(object):
           if result['raw'] and result['status'] != 204:
             result['type'] = result['headers']['content-type']
             result['data'] = json.loads(result['raw']) if 'json' in result['type'] else None
+            if fields: result['data'] = project(result['data'], fields)
         except Exception:
           # report the exception as 'info' because it's not fatal and the data is 
           # still captured in result['raw']
@@ -334,12 +484,266 @@ class CoreApi(object):
     except Exception:
       self.logger.critical("Could not write to log. Threw exception:\n\t{}".format(traceback.format_exc()))
 
+class CoreWorkerPool(object):
+  """
+  Run a function across a set of items using a bounded number of threads
+
+  Each call to the Manager() is independent so the pool is used to keep a 
+  fixed number of API calls in flight for fleet-wide operations
+  """
+  def __init__(self, max_workers=8, log_func=None):
+    self.max_workers = max_workers if max_workers and max_workers > 0 else 1
+    self.log = log_func
+    self._cancelled = threading.Event()
+    self._lock = threading.Lock()
+
+  @property
+  def cancelled(self): return self._cancelled.is_set()
+
+  def cancel(self):
+    """
+    Stop handing out new items. Calls already in flight are allowed to finish
+    """
+    self._cancelled.set()
+
+  def map(self, func, items, callback=None):
+    """
+    Call func(item) for each item
+
+    If specified, callback(item, result, err) is called as each item completes.
+    Callbacks are serialized so they can safely update shared state
+
+    Returns a list of (item, result, err) in the same order as items. err is 
+    None unless the call threw an exception. Items skipped due to a 
+    cancellation are not included
+    """
+    items = list(items)
+    results = [None] * len(items)
+    work = Queue.Queue()
+    for i, item in enumerate(items): work.put((i, item))
+
+    def worker():
+      while not self._cancelled.is_set():
+        try:
+          i, item = work.get_nowait()
+        except Queue.Empty:
+          return
+
+        result = None
+        err = None
+        try:
+          result = func(item)
+        except Exception:
+          err = traceback.format_exc()
+          if self.log: self.log("Worker call failed for item {}".format(item), err=err)
+
+        with self._lock:
+          results[i] = (item, result, err)
+          if callback:
+            try:
+              callback(item, result, err)
+            except Exception:
+              if self.log: self.log("Worker callback failed for item {}".format(item), err=traceback.format_exc())
+
+    threads = []
+    for i in range(min(self.max_workers, len(items))):
+      thread = threading.Thread(target=worker)
+      thread.daemon = True
+      thread.start()
+      threads.append(thread)
+
+    for thread in threads:
+      # join with a timeout so the main thread still receives KeyboardInterrupt
+      while thread.is_alive(): thread.join(1)
+
+    return [ result for result in results if result is not None ]
+
+class CoreFuture(object):
+  """
+  A value that will be available once a background call completes
+
+  Callbacks run on the thread that resolves the future. If log_func is
+  specified, a callback that throws an exception is logged instead of
+  stopping that thread
+  """
+  def __init__(self, log_func=None):
+    self.log = log_func
+    self.value = None
+    self.err = None
+    self._done = threading.Event()
+    self._callbacks = []
+    self._lock = threading.Lock()
+
+  def done(self): return self._done.is_set()
+
+  def result(self, timeout=None):
+    """
+    Wait for the value. Returns None if the wait timed out
+    """
+    self._done.wait(timeout)
+    return self.value
+
+  def add_done_callback(self, func):
+    """
+    Call func(future) once the value is available
+    """
+    with self._lock:
+      if not self.done():
+        self._callbacks.append(func)
+        return
+    func(self)
+
+  def _resolve(self, value, err=None):
+    # callbacks are taken under the lock so one added while resolving is
+    # either called here or by add_done_callback(), never both or neither
+    with self._lock:
+      self.value = value
+      self.err = err
+      self._done.set()
+      callbacks = self._callbacks
+      self._callbacks = []
+    for func in callbacks:
+      if not self.log:
+        func(self)
+        continue
+      try:
+        func(self)
+      except Exception:
+        self.log("Callback {} failed".format(getattr(func, '__name__', func)), err=traceback.format_exc())
+
+class CoreStringPool(object):
+  """
+  Share one copy of each repeated string value across a collection
+
+  Values like the platform, status, policy name and agent version repeat
+  across thousands of objects but each one is parsed into a separate 
+  string. The pool keeps the first copy of each value seen for a field and
+  swaps it in for the duplicates, so every object refers to the same 
+  string. Fields with more than max_values distinct values (names, IPs, 
+  IDs) are treated as high cardinality and left alone to keep the pool 
+  small. Values longer than max_length aren't pooled
+
+  .report() shows the memory saved
+  """
+  def __init__(self, max_values=1024, max_length=256):
+    self.max_values = max_values
+    self.max_length = max_length
+    self._values = {} # field => { value => the shared copy }
+    self._stats = {} # field => [values seen, bytes saved]
+    self._high_cardinality = set()
+    self._lock = threading.Lock()
+
+  def _intern(self, field, value):
+    if not isinstance(value, basestring) or len(value) > self.max_length or field in self._high_cardinality: return value
+
+    stats = self._stats.get(field)
+    if stats is None: stats = self._stats[field] = [0, 0]
+    stats[0] += 1
+
+    values = self._values.get(field)
+    if values is None: values = self._values[field] = {}
+    shared = values.get(value)
+    if shared is None:
+      if len(values) >= self.max_values:
+        self._high_cardinality.add(field)
+        del(self._values[field])
+      else:
+        values[value] = value
+      return value
+
+    if not type(shared) == type(value): return value # keep str and unicode apart
+    if not shared is value: stats[1] += sys.getsizeof(value)
+    return shared
+
+  def intern_record(self, api_response):
+    """
+    Swap in the shared copy of each string value of an API response, in 
+    place. Returns the response
+    """
+    with self._lock:
+      for k, v in api_response.items():
+        shared = self._intern(k, v)
+        if not shared is v: api_response[k] = shared
+
+    return api_response
+
+  def intern_object(self, obj):
+    """
+    Swap in the shared copy of each string property of an object that's 
+    already been built. Returns the object
+    """
+    with self._lock:
+      for k, v in vars(obj).items():
+        shared = self._intern(translation.Terms.new_to_api.get(k, k), v)
+        if not shared is v: obj.__dict__[k] = shared
+
+    return obj
+
+  def report(self):
+    """
+    Report the memory saved by the pool
+
+    Returns a dict with the total bytes_saved, the pool_bytes used by the 
+    pool's own lookups, the net_bytes_saved and the stats for each field;
+      values
+        The number of distinct values in the pool
+      references
+        The number of string values seen
+      bytes_saved
+        The memory no longer used by duplicate copies
+      high_cardinality
+        Whether the field has too many distinct values to be pooled
+    """
+    with self._lock:
+      fields = {}
+      for field, (references, bytes_saved) in self._stats.items():
+        fields[field] = {
+          'values': len(self._values.get(field, {})),
+          'references': references,
+          'bytes_saved': bytes_saved,
+          'high_cardinality': field in self._high_cardinality,
+          }
+      pool_bytes = sys.getsizeof(self._values) + sum([ sys.getsizeof(values) for values in self._values.values() ])
+
+    bytes_saved = sum([ stats['bytes_saved'] for stats in fields.values() ])
+    return {
+      'bytes_saved': bytes_saved,
+      'pool_bytes': pool_bytes,
+      'net_bytes_saved': bytes_saved - pool_bytes,
+      'fields': fields,
+      }
+
 class CoreDict(dict):
   def __init__(self):
     self._exempt_from_find = []
+    self.strings = None
 
   def get(self): pass
 
+  def intern_strings(self, max_values=1024, max_length=256):
+    """
+    Share one copy of each repeated, low cardinality string value across 
+    the objects in this collection (see CoreStringPool). Applies to the 
+    objects already loaded and any added later
+
+    Returns the pool. Its .report() shows the memory saved
+    """
+    if not getattr(self, 'strings', None): self.strings = CoreStringPool(max_values=max_values, max_length=max_length)
+    self._intern_items(self.strings)
+    return self.strings
+
+  def _intern_items(self, pool):
+    for item in dict.values(self):
+      if isinstance(item, CoreProxy):
+        if item.hydrated:
+          pool.intern_object(item.hydrate())
+        else:
+          pool.intern_record(item.raw)
+      elif isinstance(item, CoreObject):
+        pool.intern_object(item)
+      elif isinstance(item, CoreDict):
+        item._intern_items(pool)
+
   def find(self, **kwargs):
     """
     Find any keys where the values match the cumulative kwargs patterns
@@ -389,7 +793,9 @@ class CoreDict(dict):
 
           # does the current item have the property
           attr_to_check = None
-          if match_attr in dir(item):
+          if isinstance(item, CoreProxy) and not item.hydrated:
+            attr_to_check = item.get_raw_value(match_attr) # without building the object
+          elif match_attr in dir(item):
             attr_to_check = getattr(item, match_attr)
           elif 'has_key' in dir(item) and item.has_key(match_attr):
             attr_to_check = item[match_attr]
@@ -424,25 +830,33 @@ class CoreDict(dict):
 
     return results
 
+def _translate_property(k, v):
+  """
+  Convert an API keypair to a property name and value
+  """
+  val = v
+  if 'has_key' in dir(v) and v.has_key(u'@xsi:nil') and v[u'@xsi:nil'] == u'true':
+    val = None
+
+  new_key = translation.Terms.get(k)
+
+  # make sure any integer IDs are stored as an int
+  if new_key == 'id' and re.search('^\d+$', v.strip()): val = int(v)
+  if new_key == 'policy_id':
+    if '@xsi:nil' in "{}".format(v):
+      val = None
+    elif re.search('^\d+$', "".join(v.strip())):
+      val = int(v)
+
+  return new_key, val
+
 class CoreObject(object):
   def _set_properties(self, api_response, log_func):
     """
     Convert the API keypairs to object properties
     """
     for k, v in api_response.items():
-      val = v
-      if 'has_key' in dir(v) and v.has_key(u'@xsi:nil') and v[u'@xsi:nil'] == u'true':
-        val = None
-
-      new_key = translation.Terms.get(k)
-
-      # make sure any integer IDs are stored as an int
-      if new_key == 'id' and re.search('^\d+$', v.strip()): val = int(v)
-      if new_key == 'policy_id':
-        if '@xsi:nil' in "{}".format(v):
-          val = None
-        elif re.search('^\d+$', "".join(v.strip())):
-          val = int(v)
+      new_key, val = _translate_property(k, v)
 
       try:
         setattr(self, new_key, val)
@@ -469,6 +883,99 @@ class CoreObject(object):
 
     return result
 
+class CoreProxy(object):
+  """
+  Stands in for a CoreObject until it's used
+
+  Holds the raw API response and only builds the object (translating the
+  API keys to properties) with factory(api_response) the first time one of
+  its properties is read or set. Collections loaded with lazy=True hold
+  proxies so counting them or filtering them with .find() doesn't pay to
+  build every object
+
+  If specified, on_missing(proxy, name) is called when a property read
+  without building the object is missing or empty. If it returns True,
+  the value is read again from the (now built) object
+  """
+  __slots__ = ['_raw', '_factory', '_obj', '_on_missing']
+
+  def __init__(self, api_response, factory, on_missing=None):
+    object.__setattr__(self, '_raw', api_response)
+    object.__setattr__(self, '_factory', factory)
+    object.__setattr__(self, '_obj', None)
+    object.__setattr__(self, '_on_missing', on_missing)
+
+  @property
+  def hydrated(self): return self._obj is not None
+
+  @property
+  def raw(self):
+    """
+    The API response the object will be built from. None once it's built
+    """
+    return self._raw
+
+  def hydrate(self):
+    """
+    Build the object if it hasn't been already. Returns the object
+    """
+    if self._obj is None:
+      object.__setattr__(self, '_obj', self._factory(self._raw))
+      object.__setattr__(self, '_raw', None) # the object holds the same data now
+    return self._obj
+
+  def get_raw_value(self, name):
+    """
+    Get the value a property (e.g., 'computer_group_id') will have without
+    building the object
+    """
+    if self._obj is not None: return getattr(self._obj, name, None)
+
+    value = None
+    api_key = translation.Terms.new_to_api.get(name, name)
+    if self._raw.has_key(api_key):
+      value = _translate_property(api_key, self._raw[api_key])[1]
+    else:
+      for k, v in self._raw.items():
+        if translation.Terms.get(k) == name:
+          value = _translate_property(k, v)[1]
+          break
+
+    if value is None and self._on_missing and self._on_missing(self, name): return getattr(self.hydrate(), name, None)
+    return value
+
+  def __getattr__(self, name):
+    if name.startswith('__'): raise AttributeError(name)
+    return getattr(self.hydrate(), name)
+
+  def __setattr__(self, name, value): setattr(self.hydrate(), name, value)
+
+  def __delattr__(self, name): delattr(self.hydrate(), name)
+
+  def __dir__(self): return dir(self.hydrate())
+
+def get_property(obj, name, default=None):
+  """
+  Get a property of an object without building it if it's a CoreProxy
+  """
+  if isinstance(obj, CoreProxy) and not obj.hydrated:
+    value = obj.get_raw_value(name)
+    return default if value is None else value
+
+  return getattr(obj, name, default)
+
+def _atomic_write(path, write, mode='w'):
+  """
+  Replace the file at path with what write(fh) writes. The data is written
+  to a temporary file which then replaces the previous file in one step so
+  an interruption can't leave a partial file
+  """
+  temp_path = '{}.tmp'.format(path)
+  with open(temp_path, mode) as fh:
+    write(fh)
+  if os.path.exists(path) and os.name == 'nt': os.remove(path) # rename doesn't replace on Windows
+  os.rename(temp_path, path)
+
 class CoreList(list):
   def __init__(self, *args):
     super(CoreList, self).__init__(args)
@@ -523,7 +1030,9 @@ class CoreList(list):
 
           # does the current item have the property
           attr_to_check = None
-          if match_attr in dir(item):
+          if isinstance(item, CoreProxy) and not item.hydrated:
+            attr_to_check = item.get_raw_value(match_attr) # without building the object
+          elif match_attr in dir(item):
             attr_to_check = getattr(item, match_attr)
           elif 'has_key' in dir(item) and item.has_key(match_attr):
             attr_to_check = item[match_attr]
@@ -0,0 +1,275 @@
+# standard library
+import array
+import bisect
+import json
+import os
+import re
+import struct
+import threading
+import zlib
+
+# 3rd party libraries
+
+# project libraries
+import core
+
+MAGIC = 'DSID\x01'
+CHUNK_BITS = 16 # each container covers 2 ** 16 IDs
+CHUNK_SIZE = 1 << CHUNK_BITS
+MAX_ARRAY_SIZE = 4096 # sparse containers are converted to bitmaps past this size
+
+_HEADER = struct.Struct('<qII') # floor, number of containers, size of the non-integer IDs
+_CONTAINER = struct.Struct('<qcII') # chunk, type, count, size of the data
+
+class SeenIDSet(object):
+  """
+  A compact set of the event IDs that have already been seen
+
+  IDs are split into chunks of 65,536. Each chunk holds either a sorted
+  array of the IDs seen (when there are only a few) or a bitmap (8KB),
+  whichever is smaller. Once every ID between .floor and the end of a chunk
+  has been seen, the chunk is dropped and .floor moves past it, so memory is
+  only used for the recent, sparse part of the ID space
+
+  IDs at or below .floor count as seen. The floor starts at 0 because event
+  IDs start at 1
+  """
+  def __init__(self, floor=0):
+    self.floor = floor
+    self._chunks = {} # chunk => array('H') of the low bits or a bytearray bitmap
+    self._counts = {} # chunk => number of IDs in the chunk
+    self._others = set() # IDs that aren't integers
+    self._lock = threading.Lock()
+
+  def __len__(self): return sum(self._counts.values()) + len(self._others)
+
+  def __contains__(self, event_id):
+    event_id = self._as_int(event_id)
+    if event_id is None: return False
+    if not isinstance(event_id, (int, long)): return event_id in self._others
+    if event_id <= self.floor: return True
+
+    chunk = self._chunks.get(event_id >> CHUNK_BITS)
+    if chunk is None: return False
+    low = event_id & (CHUNK_SIZE - 1)
+    if isinstance(chunk, bytearray): return bool(chunk[low >> 3] & (1 << (low & 7)))
+    i = bisect.bisect_left(chunk, low)
+    return i < len(chunk) and chunk[i] == low
+
+  @property
+  def memory_bytes(self):
+    """
+    The approximate memory used by the containers
+    """
+    return sum([ len(chunk) if isinstance(chunk, bytearray) else chunk.itemsize * len(chunk) for chunk in self._chunks.values() ])
+
+  def _as_int(self, event_id):
+    if isinstance(event_id, (int, long)): return event_id
+    if isinstance(event_id, basestring) and re.search(r'^\d+$', event_id.strip()): return long(event_id)
+    return event_id
+
+  def add(self, event_id):
+    """
+    Add an ID. Returns True if it hadn't been seen before
+    """
+    event_id = self._as_int(event_id)
+    if event_id is None: return False
+    with self._lock:
+      if not isinstance(event_id, (int, long)):
+        if event_id in self._others: return False
+        self._others.add(event_id)
+        return True
+      if event_id <= self.floor: return False
+
+      key = event_id >> CHUNK_BITS
+      low = event_id & (CHUNK_SIZE - 1)
+      chunk = self._chunks.get(key)
+      if chunk is None:
+        chunk = self._chunks[key] = array.array('H')
+        self._counts[key] = 0
+
+      if isinstance(chunk, bytearray):
+        mask = 1 << (low & 7)
+        if chunk[low >> 3] & mask: return False
+        chunk[low >> 3] |= mask
+      else:
+        i = bisect.bisect_left(chunk, low)
+        if i < len(chunk) and chunk[i] == low: return False
+        chunk.insert(i, low)
+        if len(chunk) > MAX_ARRAY_SIZE: self._chunks[key] = self._to_bitmap(chunk)
+
+      self._counts[key] += 1
+      self._advance_floor()
+      return True
+
+  def update(self, event_ids):
+    """
+    Add several IDs. Returns the IDs that hadn't been seen before
+    """
+    return [ event_id for event_id in event_ids if self.add(event_id) ]
+
+  def _to_bitmap(self, chunk):
+    bitmap = bytearray(CHUNK_SIZE >> 3)
+    for low in chunk: bitmap[low >> 3] |= 1 << (low & 7)
+    return bitmap
+
+  def _advance_floor(self):
+    """
+    Drop the chunks just above the floor that are complete
+    """
+    while True:
+      key = (self.floor + 1) >> CHUNK_BITS
+      if not self._counts.has_key(key): return
+      chunk_end = ((key + 1) << CHUNK_BITS) - 1
+      if self._counts[key] < chunk_end - max(self.floor, (key << CHUNK_BITS) - 1): return
+      self.floor = chunk_end
+      del(self._chunks[key])
+      del(self._counts[key])
+
+  def save(self, path):
+    """
+    Save the set to the specified path
+    """
+    with self._lock:
+      others = json.dumps(sorted(self._others))
+      parts = [ _HEADER.pack(self.floor, len(self._chunks), len(others)), others ]
+      for key in sorted(self._chunks.keys()):
+        chunk = self._chunks[key]
+        data = str(chunk) if isinstance(chunk, bytearray) else chunk.tostring()
+        parts.append(_CONTAINER.pack(key, 'B' if isinstance(chunk, bytearray) else 'A', self._counts[key], len(data)))
+        parts.append(data)
+
+    data = MAGIC + zlib.compress(''.join(parts))
+    core._atomic_write(path, lambda fh: fh.write(data), mode='wb')
+
+  @classmethod
+  def load(self, path):
+    """
+    Load a set previously saved to the specified path
+    """
+    with open(path, 'rb') as fh:
+      if fh.read(len(MAGIC)) != MAGIC: raise ValueError("[{}] is not a seen ID set".format(path))
+      data = zlib.decompress(fh.read())
+
+    floor, count, others_size = _HEADER.unpack_from(data)
+    result = SeenIDSet(floor=floor)
+    offset = _HEADER.size
+    result._others = set(json.loads(data[offset:offset + others_size]))
+    offset += others_size
+    for i in range(count):
+      key, kind, chunk_count, size = _CONTAINER.unpack_from(data, offset)
+      offset += _CONTAINER.size
+      if kind == 'B':
+        chunk = bytearray(data[offset:offset + size])
+      else:
+        chunk = array.array('H')
+        chunk.fromstring(data[offset:offset + size])
+      offset += size
+      result._chunks[key] = chunk
+      result._counts[key] = chunk_count
+
+    return result
+
+class EventDeduplicator(object):
+  """
+  Drop events that have already been ingested, across runs
+
+  Keeps a SeenIDSet per event type, saved in the specified directory as
+  <event type>.seen. .filter() passes through only the events whose IDs
+  haven't been seen. Pass commit=False to hold off marking them as seen
+  until they've been delivered, then call .commit() so events that failed
+  to deliver are retried on the next run. Call .save() to persist the IDs
+  marked as seen
+
+  Can be passed to Manager.collect_events(deduplicator=...) or used to wrap
+  a handler with .wrap()
+  """
+  def __init__(self, path, log_func=None):
+    self.path = path
+    self.log = log_func if log_func else lambda *args, **kwargs: None
+    self.sets = {}
+    self.duplicates = {} # event type => number of duplicates dropped
+    self._lock = threading.Lock()
+    if not os.path.exists(self.path): os.makedirs(self.path)
+
+  def _get_path(self, event_type):
+    if not re.search(r'^\w+$', event_type): raise ValueError("Invalid event type [{}]".format(event_type))
+    return os.path.join(self.path, '{}.seen'.format(event_type))
+
+  def get_set(self, event_type):
+    """
+    Get the SeenIDSet for an event type, loading it if it was saved before
+    """
+    with self._lock:
+      if not self.sets.has_key(event_type):
+        path = self._get_path(event_type)
+        seen = None
+        if os.path.exists(path):
+          try:
+            seen = SeenIDSet.load(path)
+          except Exception, err:
+            self.log("Could not load the seen event IDs from [{}]".format(path), err=err)
+        self.sets[event_type] = seen if seen else SeenIDSet()
+        self.duplicates.setdefault(event_type, 0)
+
+    return self.sets[event_type]
+
+  def _get_id(self, event, id_key):
+    if id_key: return event.get(id_key) if isinstance(event, dict) else getattr(event, id_key, None)
+    if isinstance(event, dict):
+      for k, v in event.items():
+        if k.lower().endswith('eventid'): return v
+      return None
+    return getattr(event, 'id', None) or getattr(event, 'event_id', None)
+
+  def filter(self, event_type, events, id_key=None, commit=True):
+    """
+    Get the events of the specified type that haven't been seen before.
+    Events without an ID are always passed through. id_key is the key
+    holding each event's ID, found automatically if not specified
+
+    If commit is True, the events returned are marked as seen right away.
+    Otherwise, they're only marked by a call to .commit()
+    """
+    seen = self.get_set(event_type)
+    batch = set() # IDs repeated within the events
+    results = []
+    for event in events:
+      event_id = self._get_id(event, id_key)
+      if event_id is None:
+        results.append(event)
+      elif event_id in seen or event_id in batch:
+        self.duplicates[event_type] += 1
+      else:
+        batch.add(event_id)
+        results.append(event)
+
+    if commit: self.commit(event_type, results, id_key=id_key)
+    return results
+
+  def commit(self, event_type, events, id_key=None):
+    """
+    Mark events as seen once they've been delivered
+    """
+    seen = self.get_set(event_type)
+    for event in events:
+      event_id = self._get_id(event, id_key)
+      if event_id is not None: seen.add(event_id)
+
+  def wrap(self, handler):
+    """
+    Wrap a handler(event_type, events) so it only receives new events
+    """
+    def deduplicated_handler(event_type, events):
+      events = self.filter(event_type, events, commit=False)
+      if not events: return None
+      result = handler(event_type, events)
+      self.commit(event_type, events) # only once the handler succeeded
+      return result
+    return deduplicated_handler
+
+  def save(self):
+    """
+    Save the seen IDs of every event type
+    """
+    for event_type, seen in self.sets.items(): seen.save(self._get_path(event_type))
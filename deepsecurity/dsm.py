@@ -1,16 +1,21 @@
 # standard library
 import datetime
+import inspect
 import os
 import re
+import threading
+import time
 
 # 3rd party libraries
 
 # project libraries
+import actions
 import core
 import computers
 import environments
 import events
 import policies
+import recommendations
 import translation
 import traceback
 
@@ -34,6 +39,11 @@ class Manager(core.CoreApi):
     self.ignore_ssl_validation = ignore_ssl_validation
     self.hostname = hostname
 
+    # actions on many computers are split into chunks of hostIDs
+    self.bulk_action_chunk_size = 250
+    self.bulk_action_min_chunk_size = 10
+    self.bulk_action_max_workers = 4
+
     self._get_local_config_file()
 
     # allow for explicit override
@@ -291,6 +301,98 @@ class Manager(core.CoreApi):
     response = self._request(rest_call, auth_required=False)
     return True if response and response['status'] == 200 else False
 
+  def collect_events(self, event_types=None, time_filter=None, host_filter=None, id_filter=None, rest_filter=None, max_workers=8, handlers=None, store=True, deduplicator=None):
+    """
+    Retrieve several types of events concurrently
+
+    event_types
+      A list of the event collections to retrieve, by property name (e.g., 
+      ['firewall_events', 'intrusionprevention_events']). Defaults to all of them
+
+    time_filter, host_filter, id_filter, rest_filter
+      Filters shared by every call. Each collection is only passed the 
+      filters it supports (e.g., application_control_events only takes the 
+      rest_filter)
+
+    handlers
+      A callable(event_type, events) or a dict of event type => callable that
+      receives the raw events for each type as soon as they arrive
+
+    store
+      If True, the events are also added to their collection as if .get() 
+      had been called
+
+    deduplicator
+      A dedupe.EventDeduplicator. Events already ingested by a previous call
+      are dropped before they're stored or passed to the handlers. The IDs
+      of each type are only marked as seen once they've been stored and 
+      handled without an error and are saved once all of the types are 
+      collected
+
+    Returns a summary dict of event type => { 'count', 'seconds', 'error', 'duplicates' } 
+    with the overall 'total' and 'seconds'
+    """
+    all_event_types = [
+      'system_events',
+      'antimalware_events',
+      'webreputation_events',
+      'firewall_events',
+      'intrusionprevention_events',
+      'integritymonitoring_events',
+      'loginspection_events',
+      'application_control_events',
+      ]
+    if not event_types: event_types = all_event_types
+    filters_to_share = {
+      'time_filter': time_filter,
+      'host_filter': host_filter,
+      'id_filter': id_filter,
+      'rest_filter': rest_filter,
+      }
+
+    summary = { 'total': 0, 'seconds': 0 }
+    started = time.time()
+
+    def retrieve(event_type):
+      collection = getattr(self, event_type)
+      supported = inspect.getargspec(collection._retrieve).args
+      kwargs = dict([ (k, v) for k, v in filters_to_share.items() if v is not None and k in supported ])
+      call_started = time.time()
+      id_key, events = collection._retrieve(**kwargs)
+      return (id_key, events, time.time() - call_started)
+
+    def on_complete(event_type, result, err):
+      summary[event_type] = { 'count': 0, 'seconds': None, 'error': err, 'duplicates': 0 }
+      if err: return
+
+      id_key, events, seconds = result
+      if deduplicator:
+        new_events = deduplicator.filter(event_type, events, id_key=id_key, commit=False)
+        summary[event_type]['duplicates'] = len(events) - len(new_events)
+        events = new_events
+      summary[event_type]['count'] = len(events)
+      summary[event_type]['seconds'] = seconds
+      summary['total'] += len(events)
+
+      try:
+        if store: getattr(self, event_type)._add_events(id_key, events)
+        handler = handlers.get(event_type) if isinstance(handlers, dict) else handlers
+        if handler: handler(event_type, events)
+      except Exception:
+        summary[event_type]['error'] = traceback.format_exc()
+        self.log("Storing or handling {} failed".format(event_type), err=summary[event_type]['error'])
+        return
+
+      # only mark the events as seen once they've been delivered
+      if deduplicator: deduplicator.commit(event_type, events, id_key=id_key)
+
+    core.CoreWorkerPool(max_workers=max_workers, log_func=self.log).map(retrieve, event_types, callback=on_complete)
+
+    if deduplicator: deduplicator.save()
+    summary['seconds'] = time.time() - started
+    self.log("Collected {} events of {} types in {:.1f}s".format(summary['total'], len(event_types), summary['seconds']))
+    return summary
+
   # *******************************************************************
   # mirrored on the computers.Computer and computers.ComputerGroup 
   # objects
@@ -310,91 +412,137 @@ class Manager(core.CoreApi):
     
     return result
 
-  def clear_alerts_and_warnings_from_computers(self, computer_ids):
-    """
-    Clear any alerts or warnings for the specified computers
+  def _request_for_computers(self, call, computer_ids, data=None):
     """
-    result = False
+    Make a SOAP call that applies to a list of hostIDs
+
+    Large lists of computers are split into chunks of .bulk_action_chunk_size
+    and up to .bulk_action_max_workers chunks are sent concurrently. A chunk 
+    the Manager rejects (e.g., with a SOAP fault) is split in half and 
+    retried until the chunks reach .bulk_action_min_chunk_size. This keeps a
+    single envelope from timing out and isolates the computers the Manager 
+    rejects. If the Manager can't be reached, the remaining chunks are 
+    failed without being sent
 
+    Returns an actions.BulkActionResult with the outcome for each computer
+    """
     if not type(computer_ids) == type([]): computer_ids = [computer_ids]
 
-    soap_call = self._get_request_format(call='hostClearWarningsErrors')
-    soap_call['data'] = {
-      'hostIDs': computer_ids
-      }
-    response = self._request(soap_call)
-    if response and response['status'] == 200: result = True
-    
+    result = actions.BulkActionResult(call=call)
+    if not computer_ids: return result
+
+    lock = threading.Lock()
+    chunk_size = max(1, self.bulk_action_chunk_size)
+    min_chunk_size = max(1, self.bulk_action_min_chunk_size)
+
+    pool = core.CoreWorkerPool(max_workers=self.bulk_action_max_workers, log_func=self.log)
+
+    def request_chunk(chunk):
+      soap_call = self._get_request_format(call=call)
+      soap_call['data'] = {
+        'hostIDs': chunk
+        }
+      if data: soap_call['data'].update(data)
+      response = self._request(soap_call)
+      status = response['status'] if response else None
+      chunk_result = True if status == 200 else False
+      with lock:
+        result.add_chunk(chunk, status, chunk_result)
+
+      if status is None:
+        # smaller chunks won't reach the Manager either
+        if not pool.cancelled: self.log("Call {} could not reach the Manager. Failing the remaining computers".format(call), level='warning')
+        pool.cancel()
+      elif not chunk_result and len(chunk) > min_chunk_size and not pool.cancelled:
+        self.log("Call {} failed for {} computers. Retrying in smaller chunks".format(call, len(chunk)), level='warning')
+        half = len(chunk) // 2
+        request_chunk(chunk[:half])
+        request_chunk(chunk[half:])
+
+    chunks = [ computer_ids[i:i + chunk_size] for i in range(0, len(computer_ids), chunk_size) ]
+    if len(chunks) > 1:
+      self.log("Splitting call {} for {} computers into {} chunks".format(call, len(computer_ids), len(chunks)), level='debug')
+    completed = pool.map(request_chunk, chunks)
+    if pool.cancelled:
+      sent = set([ id(chunk) for chunk, chunk_result, err in completed ])
+      for chunk in chunks:
+        if not id(chunk) in sent: result.add_chunk(chunk, None, False)
+
     return result
 
+  def clear_alerts_and_warnings_from_computers(self, computer_ids):
+    """
+    Clear any alerts or warnings for the specified computers
+    """
+    return self._request_for_computers('hostClearWarningsErrors', computer_ids)
+
   def scan_computers_for_malware(self, computer_ids):
     """
     Request a malware scan be run on the specified computers
     """
-    result = False
-
-    if not type(computer_ids) == type([]): computer_ids = [computer_ids]
-
-    soap_call = self._get_request_format(call='hostAntiMalwareScan')
-    soap_call['data'] = {
-      'hostIDs': computer_ids
-      }
-    response = self._request(soap_call)
-    if response and response['status'] == 200: result = True
-    
-    return result
+    return self._request_for_computers('hostAntiMalwareScan', computer_ids)
 
   def scan_computers_for_integrity(self, computer_ids):
     """
     Request an integrity scan be run on the specified computers
     """
-    result = False
-
-    if not type(computer_ids) == type([]): computer_ids = [computer_ids]
-
-    soap_call = self._get_request_format(call='hostIntegrityScan')
-    soap_call['data'] = {
-      'hostIDs': computer_ids
-      }
-    response = self._request(soap_call)
-    if response and response['status'] == 200: result = True
-    
-    return result
+    return self._request_for_computers('hostIntegrityScan', computer_ids)
 
   def scan_computers_for_recommendations(self, computer_ids):
     """
     Request a recommendation scan be run on the specified computers
     """
-    result = False
-
-    if not type(computer_ids) == type([]): computer_ids = [computer_ids]
-
-    soap_call = self._get_request_format(call='hostRecommendationScan')
-    soap_call['data'] = {
-      'hostIDs': computer_ids
-      }
-    response = self._request(soap_call)
-    if response and response['status'] == 200: result = True
-    
-    return result 
+    return self._request_for_computers('hostRecommendationScan', computer_ids)
 
   def assign_policy_to_computers(self, policy_id, computer_ids):
     """   
     Assign the specified policy to the specified computers
     """
-    result = False
+    return self._request_for_computers('securityProfileAssignToHost', computer_ids, data={ 'securityProfileID': policy_id })
 
-    if not type(computer_ids) == type([]): computer_ids = [computer_ids]
+  def _get_rule_recommendation_types(self):
+    """
+    Get the key used for each type of rule recommendation and the matching
+    rule type ENUM value
+    """
+    rules_types = { # values align with rule type ENUM
+      'DPIRuleRetrieveAll': 2,
+      'firewallRuleRetrieveAll': 3,
+      'integrityRuleRetrieveAll': 4,
+      'logInspectionRuleRetrieveAll': 5,
+      'applicationTypeRetrieveAll': 1,
+      }
 
-    soap_call = self._get_request_format(call='securityProfileAssignToHost')
+    results = {}
+    for rule_type, type_enum_val in rules_types.items():
+      rule_key = translation.Terms.get(rule_type).replace('_retrieve_all', '').replace('_rule', '')
+      results[rule_key] = type_enum_val
+
+    return results
+
+  def _get_rule_recommendation_ids(self, computer_id, type_enum_val):
+    """
+    Get the IDs of the recommended rules of one type for the specified computer
+
+    Returns None if the call failed
+    """
+    results = None
+
+    soap_call = self._get_request_format(call='hostRecommendationRuleIDsRetrieve')
     soap_call['data'] = {
-      'hostIDs': computer_ids,
-      'securityProfileID': policy_id,
+      'hostID': computer_id,
+      'type': type_enum_val,
+      'onlyunassigned': False,
       }
     response = self._request(soap_call)
-    if response and response['status'] == 200: result = True
-    
-    return result
+    if response and response['status'] == 200:
+      results = []
+      # response contains the internal rule ID
+      for internal_rule_id in response['data']:
+        if internal_rule_id == u'@xmlns': continue
+        results.append(internal_rule_id)
+
+    return results
 
   def get_rule_recommendations_for_computer(self, computer_id):
     """
@@ -404,91 +552,86 @@ class Manager(core.CoreApi):
       'total_recommedations': 0
       }
 
-    rules_types = { # values align with rule type ENUM
-      'DPIRuleRetrieveAll': 2,
-      'firewallRuleRetrieveAll': 3,
-      'integrityRuleRetrieveAll': 4,
-      'logInspectionRuleRetrieveAll': 5,
-      'applicationTypeRetrieveAll': 1,
-      }
+    for rule_key, type_enum_val in self._get_rule_recommendation_types().items():
+      results[rule_key] = self._get_rule_recommendation_ids(computer_id, type_enum_val) or []
+      results['total_recommedations'] += len(results[rule_key])
 
-    for rule_type, type_enum_val in rules_types.items():
-      rule_key = translation.Terms.get(rule_type).replace('_retrieve_all', '').replace('_rule', '')
-      results[rule_key] = []
+    return results
 
-      soap_call = self._get_request_format(call='hostRecommendationRuleIDsRetrieve')
-      soap_call['data'] = {
-        'hostID': computer_id,
-        'type': type_enum_val,
-        'onlyunassigned': False,
+  def schedule_action(self, action, computer_ids, **kwargs):
+    """
+    Spread an action for many computers across a window of time instead of
+    requesting it for all of them at once
+
+    The scheduler runs in the background. Call .wait() on the returned 
+    actions.ActionScheduler for the results or .cancel() to stop it. See 
+    actions.ActionScheduler for the supported options
+    """
+    return actions.ActionScheduler(self, action, computer_ids, **kwargs).start()
+
+  def watch_computers(self, computer_ids, **kwargs):
+    """
+    Watch the specified computers in the background until each reaches a
+    target status (e.g., after .activate(), .update() or a scan)
+
+    Returns a computers.ComputerStatusWatcher. Its .futures resolve as each
+    computer reaches the target status. See computers.ComputerStatusWatcher 
+    for the supported options
+    """
+    return computers.ComputerStatusWatcher(self, computer_ids, **kwargs).start()
+
+  def get_rule_recommendations_for_computers(self, computer_ids, max_workers=8, state_path=None, progress_callback=None):
+    """
+    Get the recommended rule sets (applied or not) for a set of computers
+
+    The per computer, per rule type calls are run concurrently by up to 
+    max_workers threads. If state_path is specified, progress is saved there
+    and a later call with the same state_path skips the work already done. 
+    progress_callback(completed, total) is called as each call finishes
+
+    Returns a recommendations.RuleRecommendations sparse computer x rule matrix
+    """
+    harvester = recommendations.RuleRecommendationHarvester(self, max_workers=max_workers, state_path=state_path, progress_callback=progress_callback)
+    return harvester.harvest(computer_ids)
+
+  def _request_for_computers_sp(self, call, ids_key, computer_ids):
+    """
+    Make a SOAP call that takes the computer IDs wrapped in an 'sp' structure
+
+    These calls do not return anything so the result is True if the Manager
+    accepted the request
+    """
+    if not isinstance(computer_ids, list): computer_ids = [computer_ids]
+
+    soap_call = self._get_request_format(call=call)
+    soap_call['data'] = {
+      'sp': {
+        ids_key: computer_ids
         }
-      response = self._request(soap_call)
-      if response and response['status'] == 200:
-        # response contains the internal rule ID
-        for internal_rule_id in response['data']:
-          if internal_rule_id == u'@xmlns': continue
-          results[rule_key].append(internal_rule_id)
-          results['total_recommedations'] += 1
+      }
+    response = self._request(soap_call)
+    return True if response and response['status'] == 200 else False
 
-    return results
+  def activate(self, ids):
+    """
+    Activate the specified computers
+    """
+    return self._request_for_computers_sp('hostAgentActivate', 'ids', ids)
 
-    def activate(self, ids):
-        ''' Activate hosts.
-        '''
-        if not isinstance(ids, list):
-            ids = [ids]
-        call = self._get_request_format(call='hostAgentActivate')
-        call['data'] = { 
-			'sp': 
-			{
-				'ids': ids
-			}
-		}
-		# The call does not return anything
-        self._request(call)
-
-    def deactivate(self, ids):
-        ''' Deactivate hosts.
-        '''
-        if not isinstance(ids, list):
-            ids = [ids]
-        call = self._get_request_format(call='hostAgentDeactivate')
-        call['data'] = { 
-			'sp': 
-			{
-				'ids': ids
-			}
-		}
-		# The call does not return anything
-        self._request(call)
-
-    def update(self, ids):
-        ''' Initiate the update of host(s) specified by ID(s).
-        '''
-        if not isinstance(ids, list):
-            ids = [ids]
-        call = self._get_request_format(call='hostUpdateNow')
-        call['data'] = {
-			'sp':
-			{
-				'hostIDs': ids
-			}
-		}
-        # The call does not return anything
-        self._request(call)
-
-    def rebuild_baseline(self, ids):
-        ''' Initiate the integrity scan baseline rebuild of host(s)
-            specified by ID(s).
-        '''
-        if not isinstance(ids, list):
-            ids = [ids]
-        call = self._get_request_format(call='hostRebuildBaseline')
-        call['data'] = {
-			'sp':
-			{
-				'hostIDs': ids
-			}
-		}
-        # The call does not return anything
-        self._request(call)
\ No newline at end of file
+  def deactivate(self, ids):
+    """
+    Deactivate the specified computers
+    """
+    return self._request_for_computers_sp('hostAgentDeactivate', 'ids', ids)
+
+  def update(self, ids):
+    """
+    Initiate an update of the specified computers
+    """
+    return self._request_for_computers_sp('hostUpdateNow', 'hostIDs', ids)
+
+  def rebuild_baseline(self, ids):
+    """
+    Initiate an integrity scan baseline rebuild of the specified computers
+    """
+    return self._request_for_computers_sp('hostRebuildBaseline', 'hostIDs', ids)
@@ -0,0 +1,164 @@
+# standard library
+import itertools
+import re
+
+# 3rd party libraries
+
+# project libraries
+import core
+import translation
+
+# event fields that hold a rule ID and the call used to retrieve that type of rule
+RULE_ID_FIELDS = {
+  'DPIRuleID': 'DPIRuleRetrieveAll',
+  'integrityRuleID': 'integrityRuleRetrieveAll',
+  'logInspectionRuleID': 'logInspectionRuleRetrieveAll',
+  }
+
+def _as_id(value):
+  """
+  Normalize an ID that may have been returned as a string
+  """
+  if type(value) in [type(''), type(u'')] and re.search(r'^\d+$', value.strip()): return int(value)
+  return value
+
+def _as_api_dict(event):
+  """
+  Get the API keypairs for an event that's either a dict (as yielded by
+  .iterate()) or an object from an events collection
+  """
+  if isinstance(event, core.CoreProxy): event = event.raw if not event.hydrated else event.hydrate()
+  if isinstance(event, dict): return dict(event)
+
+  result = {}
+  for k, v in vars(event).items():
+    if k in ['manager', 'log'] or k.startswith('_'): continue
+    result[translation.Terms.get_reverse(k)] = v
+
+  return result
+
+class InventoryIndex(object):
+  """
+  Hash indexes of the inventory already loaded on a Manager()
+
+  Built once from Manager.computers, .computer_groups, .policies and .rules
+  so that joining an event to its computer, group, policy and rule is a
+  dict lookup. Call .refresh() after reloading the inventory
+  """
+  def __init__(self, manager=None):
+    self.computers = {} # computer ID => dict of computer fields
+    self.computer_ids_by_name = {}
+    self.computer_groups = {} # computer group ID => name
+    self.policies = {} # policy ID => name
+    self.rules = {} # (rule type, rule ID) => name
+    self.rule_keys = {} # event field => rule type
+    if manager: self.refresh(manager)
+
+  def refresh(self, manager):
+    """
+    Rebuild the indexes from the inventory loaded on the Manager()
+    """
+    self.computers = {}
+    self.computer_ids_by_name = {}
+    with manager.computers.without_upgrades():
+      # lazy computers and rules are read without building them
+      for computer_id, computer in manager.computers.items():
+        computer_id = _as_id(computer_id)
+        self.computers[computer_id] = {
+          'hostName': core.get_property(computer, 'name'),
+          'displayName': core.get_property(computer, 'display_name'),
+          'hostGroupID': _as_id(core.get_property(computer, 'computer_group_id')),
+          'securityProfileID': _as_id(core.get_property(computer, 'security_profile_id')),
+          }
+        if self.computers[computer_id]['hostName']: self.computer_ids_by_name[self.computers[computer_id]['hostName']] = computer_id
+
+    self.computer_groups = dict([ (_as_id(group_id), core.get_property(group, 'name')) for group_id, group in manager.computer_groups.items() ])
+    self.policies = dict([ (_as_id(policy_id), core.get_property(policy, 'name')) for policy_id, policy in manager.policies.items() ])
+
+    self.rules = {}
+    for rule_key, rules in manager.rules.items():
+      for rule_id, rule in rules.items():
+        self.rules[(rule_key, _as_id(rule_id))] = core.get_property(rule, 'name')
+
+    # match the keys used by Rules.get()
+    self.rule_keys = {}
+    for field, call in RULE_ID_FIELDS.items():
+      self.rule_keys[field] = translation.Terms.get(call).replace('_retrieve_all', '').replace('_rule', '')
+
+  def get_computer(self, computer_id=None, computer_name=None):
+    """
+    Get the joined fields for a computer by ID, falling back to its name
+    """
+    computer_id = _as_id(computer_id)
+    if computer_id is None and computer_name: computer_id = self.computer_ids_by_name.get(computer_name)
+    computer = self.computers.get(computer_id)
+    if not computer: return None
+
+    result = dict(computer)
+    result['hostID'] = computer_id
+    result['hostGroupName'] = self.computer_groups.get(computer['hostGroupID'])
+    result['securityProfileName'] = self.policies.get(computer['securityProfileID'])
+
+    return result
+
+class EventEnricher(object):
+  """
+  Join streamed events against an InventoryIndex
+
+  Events can be the dicts yielded by an events collection's .iterate() or
+  the objects in the collection. Each enriched record is a dict of the
+  event's API keypairs plus hostName, displayName, hostGroupID,
+  hostGroupName, securityProfileID, securityProfileName and ruleName where
+  they can be resolved. Fields already on the event are not overwritten
+
+  Events are processed in batches of batch_size. The computers and rules
+  referenced in a batch are resolved once each and shared by every event
+  in the batch. No calls are made to the Manager()
+  """
+  def __init__(self, manager=None, index=None, batch_size=1000):
+    self.index = index if index else InventoryIndex(manager)
+    self.batch_size = batch_size
+    self.enriched = 0
+    self.unmatched = 0
+
+  def enrich_batch(self, events):
+    """
+    Enrich a list of events. Returns a list of enriched records
+    """
+    records = [ _as_api_dict(event) for event in events ]
+
+    computers = {}
+    rules = {}
+    for record in records:
+      computer_key = (record.get('hostID'), record.get('hostName'))
+      if not computers.has_key(computer_key):
+        computers[computer_key] = self.index.get_computer(computer_id=computer_key[0], computer_name=computer_key[1])
+      for field, rule_key in self.index.rule_keys.items():
+        if record.get(field) is not None:
+          rule = (rule_key, _as_id(record[field]))
+          if not rules.has_key(rule): rules[rule] = self.index.rules.get(rule)
+
+    for record in records:
+      computer = computers[(record.get('hostID'), record.get('hostName'))]
+      if computer:
+        for k, v in computer.items():
+          if record.get(k) is None: record[k] = v
+      else:
+        self.unmatched += 1
+
+      for field, rule_key in self.index.rule_keys.items():
+        if record.get(field) is not None and record.get('ruleName') is None:
+          record['ruleName'] = rules.get((rule_key, _as_id(record[field])))
+
+    self.enriched += len(records)
+    return records
+
+  def enrich(self, events):
+    """
+    Enrich a stream of events. Yields enriched records
+    """
+    events = iter(events)
+    while True:
+      batch = list(itertools.islice(events, self.batch_size))
+      if not batch: break
+      for record in self.enrich_batch(batch): yield record
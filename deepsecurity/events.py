@@ -16,8 +16,17 @@
 	to a FilterTransport object.
 '''
 
+import calendar
+import collections
+import datetime
+import heapq
+import inspect
+import re
+import time
+
 import core
 import filters
+import translation
 
 
 def _build_call_parms(time_filter=None, host_filter=None, id_filter=None,
@@ -51,12 +60,12 @@ def _make_call(entrypoint, manager, call_data=None, call_query=None,
 		formatted and what type of authentication is used.
 
 		Request format is a dictionary with the following key/value pairs:
-		{
-			'api': 'REST' or 'SOAP',
-			'call': <API Entrypoint>,
-			'use_cookie_auth': BOOL,
-			'query': None,
-			'data': None,
+		{
+			'api': 'REST' or 'SOAP',
+			'call': <API Entrypoint>,
+			'use_cookie_auth': BOOL,
+			'query': None,
+			'data': None,
 		}
 	'''
 	_core = core.CoreApi()
@@ -73,14 +82,598 @@ def _make_call(entrypoint, manager, call_data=None, call_query=None,
 	return resp
 
 
-class _Event(core.CoreObject):
-	''' Convert the API keypairs to object properties.
-	'''
-	def __init__(self, event, log_func):
+def _get_events(response, *keys):
+	''' Pull the list of events out of an API response by following the
+		specified keys. SOAP responses wrap lists in an 'item' element and
+		return a single event as a dictionary rather than a list. Returns an
+		empty list if the call failed or there are no events.
+	'''
+	if not response or response['status'] != 200 or not response['data']:
+		return []
+	data = response['data'][0]
+	for key in keys:
+		if not isinstance(data, dict) or not data.get(key):
+			return []
+		data = data[key]
+	if isinstance(data, dict) and 'item' in data:
+		data = data['item']
+	if isinstance(data, dict):
+		data = [data]
+	return data
+
+
+# the cost of leaving each kind of query predicate to be applied locally
+# when choosing between the SOAP and REST API
+_PUSHDOWN_WEIGHTS = {
+	'computer_ids': 4,
+	'computer_group_ids': 4,
+	'policy_ids': 4,
+	'start': 2,
+	'end': 2,
+	'event_ids': 1,
+	'min_event_id': 1,
+	'max_event_id': 1,
+}
+_DEFAULT_QUERY_DAYS = 7
+# the number of events asked for by each REST call made by iterate()
+PAGE_SIZE = 1000
+
+
+def _as_list(value):
+	if value is None:
+		return []
+	if isinstance(value, (list, tuple, set, frozenset)):
+		return list(value)
+	return [value]
+
+
+def _as_id(value):
+	if isinstance(value, basestring) and re.search(r'^\d+$', value.strip()):
+		return long(value)
+	return value
+
+
+def _as_soap_time(millis):
+	dt = datetime.datetime.utcfromtimestamp(millis // 1000)
+	return '{}.{:03d}Z'.format(dt.strftime('%Y-%m-%dT%H:%M:%S'), millis % 1000)
+
+
+EnumEvictionPolicy = [
+	'FIFO',  # first added, first evicted
+	'LRU',  # least recently accessed
+	'EVENT_ID',  # lowest event ID
+	'EVENT_TIME'  # oldest event time
+]
+
+
+class _Event(core.CoreObject):
+	''' Convert the API keypairs to object properties.
+	'''
+	def __init__(self, event, log_func):
 		self._set_properties(event, log_func)
 
 
-class SystemEvents(core.CoreDict):
+# the properties of integrity events that are only returned with the
+# extended description. Others seen in the descriptions are added as
+# they're loaded
+INTEGRITY_DETAIL_FIELDS = ['extendedDescription']
+
+
+class _SummaryIntegrityEvent(_Event):
+	''' An integrity monitoring event retrieved without its extended
+		description. Reading one of the properties that only come with the
+		extended description (see INTEGRITY_DETAIL_FIELDS) loads it for
+		this event. To load the descriptions of
+		many events in as few calls as possible, use
+		IntegrityMonitoringEvents.load_details() instead.
+	'''
+	def __init__(self, event, log_func, collection, event_id):
+		_Event.__init__(self, event, log_func)
+		self._collection = collection
+		self._event_id = event_id
+		self._details_loaded = False
+
+	@property
+	def details_loaded(self):
+		return self._details_loaded
+
+	def load_details(self):
+		self._collection.load_details([self._event_id])
+		return self
+
+	def __getattr__(self, name):
+		# only called for properties that haven't been set. Other missing
+		# properties don't trigger a call so probing for optional fields
+		# stays cheap
+		if name.startswith('_') or self.__dict__.get('_details_loaded', True):
+			raise AttributeError(name)
+		if not name in self.__dict__['_collection']._detail_properties:
+			raise AttributeError(name)
+		self.load_details()
+		if name in self.__dict__:
+			return self.__dict__[name]
+		raise AttributeError(name)
+
+
+class _Events(core.CoreDict):
+	''' Base class for the event collections. Subclasses implement
+		_retrieve(), which takes the arguments documented in the subclass
+		usage and returns the API key of the event ID and a list of the raw
+		events.
+	'''
+	def __init__(self, manager=None):
+		core.CoreDict.__init__(self)
+		self.manager = manager
+		self.log = self.manager.log if self.manager else None
+		self.evicted = 0
+		self._capacity = None
+
+	def _retrieve(self, *args, **kwargs):
+		return None, []
+
+	def set_capacity(self, max_events=None, max_bytes=None, policy='FIFO',
+					 on_evict=None):
+		''' Bound the memory used by the collection. Once the collection
+			holds more than max_events events or more than (approximately)
+			max_bytes of event data, events are evicted until it's back
+			under the limit. Passing neither limit makes the collection
+			unbounded again.
+
+			max_events - int - The maximum number of events to keep
+			max_bytes - int - The maximum size of the event data to keep,
+							  estimated from the length of each value
+			policy - EnumEvictionPolicy - Which events to evict first
+			on_evict - A callable(event ID, event) called for each event
+					   evicted
+		'''
+		policy = filters._format_and_validate_operator(policy, EnumEvictionPolicy)
+		if not max_events and not max_bytes:
+			self._capacity = None
+			return
+
+		self._capacity = {
+			'max_events': max_events,
+			'max_bytes': max_bytes,
+			'policy': policy,
+			'on_evict': on_evict,
+		}
+		self._sizes = collections.OrderedDict()  # in eviction order for FIFO and LRU
+		self._priorities = {}
+		self._heap = []  # eviction order for EVENT_ID and EVENT_TIME
+		self._bytes = 0
+		for event_id, event in dict.items(self):
+			self._track(event_id, event)
+		self._evict()
+
+	@property
+	def size_in_bytes(self):
+		''' The estimated size of the event data when the collection is
+			bounded by max_bytes.
+		'''
+		return self._bytes if self._capacity else None
+
+	def _estimate_size(self, event):
+		size = 64
+		if isinstance(event, core.CoreProxy):
+			values = event.raw.values() if not event.hydrated else vars(event.hydrate()).values()
+		else:
+			values = vars(event).values()
+		for value in values:
+			if isinstance(value, basestring):
+				size += len(value)
+			elif value is not None and not callable(value):
+				size += 8
+		return size
+
+	def _track(self, event_id, event):
+		self._untrack(event_id)
+		size = self._estimate_size(event) if self._capacity['max_bytes'] else 0
+		self._sizes[event_id] = size
+		self._bytes += size
+		if self._capacity['policy'] == 'EVENT_ID':
+			priority = long(event_id) if re.search(r'^\d+$', '{}'.format(event_id)) else event_id
+		elif self._capacity['policy'] == 'EVENT_TIME':
+			priority = get_event_time(event) or 0
+		else:
+			return
+		self._priorities[event_id] = priority
+		heapq.heappush(self._heap, (priority, event_id))
+
+	def _untrack(self, event_id):
+		if event_id in self._sizes:
+			self._bytes -= self._sizes.pop(event_id)
+			if self._priorities.pop(event_id, None) is not None and len(self._heap) > 2 * len(self._priorities):
+				# more stale entries than live ones, rebuild the heap from the live priorities
+				self._heap = [ (priority, key) for key, priority in self._priorities.items() ]
+				heapq.heapify(self._heap)
+
+	def _evict(self):
+		max_events = self._capacity['max_events']
+		max_bytes = self._capacity['max_bytes']
+		while len(self) and ((max_events and len(self) > max_events) or
+							 (max_bytes and self._bytes > max_bytes)):
+			if self._capacity['policy'] in ['FIFO', 'LRU']:
+				event_id = next(iter(self._sizes))
+			else:
+				priority, event_id = heapq.heappop(self._heap)
+				if self._priorities.get(event_id) != priority:
+					continue  # stale entry from an event that was replaced or removed
+			event = dict.pop(self, event_id)
+			self._untrack(event_id)
+			self.evicted += 1
+			if self._capacity['on_evict']:
+				self._capacity['on_evict'](event_id, event)
+
+	def __setitem__(self, event_id, event):
+		core.CoreDict.__setitem__(self, event_id, event)
+		if self._capacity:
+			self._track(event_id, event)
+			self._evict()
+
+	def __getitem__(self, event_id):
+		event = core.CoreDict.__getitem__(self, event_id)
+		if self._capacity and self._capacity['policy'] == 'LRU':
+			self._sizes[event_id] = self._sizes.pop(event_id)
+		return event
+
+	def __delitem__(self, event_id):
+		core.CoreDict.__delitem__(self, event_id)
+		if self._capacity:
+			self._untrack(event_id)
+
+	def pop(self, event_id, *default):
+		if self._capacity:
+			self._untrack(event_id)
+		return core.CoreDict.pop(self, event_id, *default)
+
+	def clear(self):
+		core.CoreDict.clear(self)
+		if self._capacity:
+			self.set_capacity(**dict([(k, v) for k, v in self._capacity.items()]))
+
+	def _retrieve_projected(self, fields, *args, **kwargs):
+		''' Call _retrieve(), keeping only the specified fields (and the ID)
+			of each event as the response is parsed.
+		'''
+		if not fields or not self.manager:
+			return self._retrieve(*args, **kwargs)
+		with self.manager.projection(fields):
+			return self._retrieve(*args, **kwargs)
+
+	def get(self, *args, **kwargs):
+		''' Retrieve events and add them to the collection. Returns the
+			number of events in the collection.
+
+			Pass fields (a list of API keys, e.g., ['hostID', 'sourceIP'])
+			to only keep those fields of each event. The others are dropped
+			as the response is parsed.
+
+			Pass lazy=True to hold each event as a core.CoreProxy that only
+			builds the event object when it's first used.
+		'''
+		fields = kwargs.pop('fields', None)
+		lazy = kwargs.pop('lazy', False)
+		id_key, events = self._retrieve_projected(fields, *args, **kwargs)
+		self._add_events(id_key, events, lazy=lazy)
+		return len(self)
+
+	def _create_event(self, event):
+		return _Event(event, self.log)
+
+	def _add_events(self, id_key, events, lazy=False):
+		''' Convert raw events to event objects (or proxies for them if
+			lazy) and add them to the collection.
+		'''
+		for event in events:
+			if self.strings:
+				self.strings.intern_record(event)
+			self[event[id_key]] = core.CoreProxy(event, self._create_event) if lazy else self._create_event(event)
+
+	def _iterate_pages(self, fields, page_size, *args, **kwargs):
+		''' Call _retrieve() repeatedly, asking each time for the events
+			after the highest event ID seen so far, and yield (API key of the
+			event ID, list of events) for each page. Only one page is held
+			at a time.
+
+			REST calls ask for at most page_size events (a maxItems in the
+			rest_filter caps the total). SOAP calls can't set a page size so
+			each page is as many events as the Manager returns for one call
+			(see the maximum number of items retrieved from the database).
+			Events are paged by an event ID GREATER_THAN (SOAP) or GT (REST)
+			filter, so calls whose ID filter is another comparison are made
+			once.
+		'''
+		supported = inspect.getargspec(self._retrieve).args[1:]
+		kwargs.update(dict(zip(supported, args)))
+		rest = kwargs.get('REST_API') or ('rest_filter' in supported and not 'time_filter' in supported)
+
+		remaining = None
+		if rest:
+			rest_filter = dict(kwargs.get('rest_filter') or filters.create_rest_event_filter(eventId=0, eventIdOp='GT'))
+			pageable = rest_filter.get('eventIdOp') in [None, 'GT', 'GE']
+			remaining = rest_filter.get('maxItems')
+		else:
+			id_filter = kwargs.get('id_filter')
+			pageable = not id_filter or id_filter.get('operator') == 'GREATER_THAN'
+
+		last_id = None
+		while True:
+			limit = None
+			if rest:
+				limit = min(page_size, remaining) if remaining else page_size
+				rest_filter['maxItems'] = limit
+				if last_id is not None:
+					rest_filter.update({'eventId': last_id, 'eventIdOp': 'GT'})
+				kwargs['rest_filter'] = dict(rest_filter)
+			elif last_id is not None:
+				kwargs['id_filter'] = filters.create_id_filter(last_id, operator='GREATER_THAN')
+
+			id_key, events = self._retrieve_projected(fields, **kwargs)
+			if events:
+				yield id_key, events
+			if not events or not pageable or (limit and len(events) < limit):
+				break
+			if remaining:
+				remaining -= len(events)
+				if remaining <= 0:
+					break
+
+			page_last_id = max([_as_id(event.get(id_key)) for event in events])
+			if not isinstance(page_last_id, (int, long)) or (last_id is not None and page_last_id <= last_id):
+				break  # the IDs can't be paged past
+			last_id = page_last_id
+
+	def iterate(self, *args, **kwargs):
+		''' Retrieve events and yield each one as a dictionary of API
+			keypairs without creating event objects or adding them to the
+			collection. Takes the same fields projection as get().
+
+			The events are retrieved a page at a time (see _iterate_pages)
+			so only one page is held in memory. Pass page_size to change
+			the number of events asked for by each REST call (default:
+			PAGE_SIZE).
+		'''
+		fields = kwargs.pop('fields', None)
+		page_size = kwargs.pop('page_size', PAGE_SIZE)
+		for id_key, events in self._iterate_pages(fields, page_size, *args, **kwargs):
+			for event in events:
+				yield event
+
+	def plan_query(self, computer_ids=None, computer_names=None,
+				   computer_group_ids=None, policy_ids=None, start=None,
+				   end=None, event_ids=None, min_event_id=None,
+				   max_event_id=None, include_subgroups=False, api=None,
+				   max_host_calls=10):
+		''' Plan the calls for a query, pushing as many of the predicates
+			as possible down to the Manager.
+
+			The SOAP API can filter by one host predicate (up to
+			max_host_calls computers, computer groups or policies, one call
+			each), a time range and one event ID comparison. The REST API
+			can only filter by a start time and one event ID comparison, but
+			can bound a range of event IDs with maxItems. The API that leaves
+			the least to be applied locally is used (SOAP if they're equal)
+			unless api is 'SOAP' or 'REST'. Predicates that can't be pushed
+			down are applied locally.
+
+			Names of computers that are already loaded are resolved to
+			computer IDs. Group and policy predicates that are applied
+			locally use the computers (and computer groups) already loaded.
+
+			Returns a dictionary of the 'api', the keyword arguments for each
+			call to ._retrieve() as 'calls', the predicates 'pushed' down,
+			the predicates applied 'local'ly (of which the 'bounded' ones
+			limit the number of events downloaded) and the normalized
+			'predicates'.
+		'''
+		api = api.upper() if api else None
+		computer_ids = set([_as_id(computer_id) for computer_id in _as_list(computer_ids)])
+		computer_names = set(_as_list(computer_names))
+		if computer_names and self.manager:
+			for computer_id, computer in self.manager.computers.items():
+				name = core.get_property(computer, 'name')
+				if name in computer_names:
+					computer_names.discard(name)
+					computer_ids.add(computer_id)
+		computer_group_ids = set([_as_id(group_id) for group_id in _as_list(computer_group_ids)])
+		if include_subgroups and computer_group_ids and self.manager:
+			# add the descendants of the groups so they can be matched locally
+			parents = dict([(group_id, _as_id(getattr(group, 'parent_group_id', None))) for group_id, group in self.manager.computer_groups.items()])
+			for group_id in parents.keys():
+				ancestor = parents.get(group_id)
+				while ancestor is not None and not group_id in computer_group_ids:
+					if ancestor in computer_group_ids:
+						computer_group_ids.add(group_id)
+					ancestor = parents.get(ancestor)
+
+		end = get_event_time({'time': end}) if end is not None else None
+		start = get_event_time({'time': start}) if start is not None else None
+		if start is None:
+			start = (end or long(time.time() * 1000)) - _DEFAULT_QUERY_DAYS * 24 * 60 * 60 * 1000
+
+		predicates = {
+			'computer_ids': computer_ids,
+			'computer_names': computer_names,
+			'computer_group_ids': computer_group_ids,
+			'policy_ids': set([_as_id(policy_id) for policy_id in _as_list(policy_ids)]),
+			'start': start,
+			'end': end,
+			'event_ids': set([long(event_id) for event_id in _as_list(event_ids)]),
+			'min_event_id': long(min_event_id) if min_event_id is not None else None,
+			'max_event_id': long(max_event_id) if max_event_id is not None else None,
+		}
+		wanted = [k for k, v in predicates.items() if k != 'computer_names' and (v or v == 0)]
+
+		supported = inspect.getargspec(self._retrieve).args
+		plans = []
+		if 'time_filter' in supported and api in [None, 'SOAP']:
+			plans.append(self._plan_soap_query(predicates, include_subgroups, max_host_calls))
+		if 'rest_filter' in supported and api in [None, 'REST']:
+			plans.append(self._plan_rest_query(predicates, 'REST_API' in supported))
+		if not plans:
+			raise ValueError('{} does not support the {} API'.format(self.__class__.__name__, api))
+
+		# score each plan by what it leaves to be filtered locally without
+		# the Manager bounding the download. The first plan (SOAP) wins a tie
+		plan = min(plans, key=lambda p: sum([_PUSHDOWN_WEIGHTS.get(k, 0) for k in wanted if not k in p['pushed'] + p['bounded']]))
+		plan['local'] = [k for k in sorted(wanted) if not k in plan['pushed']]
+		if predicates['computer_names']:
+			plan['local'].append('computer_names')
+			if 'computer_ids' in plan['pushed']:
+				plan['local'].append('computer_ids')
+		plan['predicates'] = predicates
+		return plan
+
+	def _plan_soap_query(self, predicates, include_subgroups, max_host_calls):
+		pushed = []
+		host_filters = [None]
+		if predicates['computer_ids'] and not predicates['computer_names'] and len(predicates['computer_ids']) <= max_host_calls:
+			host_filters = [filters.create_host_filter(hostID=computer_id, operator='SPECIFIC_HOST') for computer_id in sorted(predicates['computer_ids'])]
+			pushed.append('computer_ids')
+		elif predicates['computer_group_ids'] and len(predicates['computer_group_ids']) <= max_host_calls:
+			operator = 'HOSTS_IN_GROUP_AND_ALL_SUBGROUPS' if include_subgroups else 'HOSTS_IN_GROUP'
+			host_filters = [filters.create_host_filter(hostGroupID=group_id, operator=operator) for group_id in sorted(predicates['computer_group_ids'])]
+			pushed.append('computer_group_ids')
+		elif predicates['policy_ids'] and len(predicates['policy_ids']) <= max_host_calls:
+			host_filters = [filters.create_host_filter(securityProfileID=policy_id, operator='HOSTS_USING_SECURITY_PROFILE') for policy_id in sorted(predicates['policy_ids'])]
+			pushed.append('policy_ids')
+
+		time_filter = filters.create_time_filter(
+			rangeFrom=_as_soap_time(predicates['start']),
+			rangeTo=_as_soap_time(predicates['end'] if predicates['end'] is not None else long(time.time() * 1000)),
+			operator='CUSTOM_RANGE'
+		)
+		pushed.extend(['start', 'end'])
+
+		id_filter = None
+		if len(predicates['event_ids']) == 1:
+			id_filter = filters.create_id_filter(list(predicates['event_ids'])[0], operator='EQUAL')
+			pushed.append('event_ids')
+		elif predicates['event_ids']:
+			id_filter = filters.create_id_filter(min(predicates['event_ids']) - 1, operator='GREATER_THAN')
+		elif predicates['min_event_id'] is not None:
+			id_filter = filters.create_id_filter(predicates['min_event_id'], operator='GREATER_THAN')
+			pushed.append('min_event_id')
+		elif predicates['max_event_id'] is not None:
+			id_filter = filters.create_id_filter(predicates['max_event_id'], operator='LESS_THAN')
+			pushed.append('max_event_id')
+
+		calls = [{'time_filter': time_filter, 'host_filter': host_filter, 'id_filter': id_filter} for host_filter in host_filters]
+		return {'api': 'SOAP', 'calls': calls, 'pushed': pushed, 'bounded': []}
+
+	def _plan_rest_query(self, predicates, use_rest_api_flag):
+		pushed = ['start']
+		bounded = []  # the number of events is bounded but they're still filtered locally
+		rest_filter = filters.create_rest_event_filter(eventTime=predicates['start'], eventTimeOp='GE', eventIdOp=None)
+		if len(predicates['event_ids']) == 1:
+			rest_filter.update({'eventId': list(predicates['event_ids'])[0], 'eventIdOp': 'EQ'})
+			pushed.append('event_ids')
+		elif predicates['event_ids']:
+			rest_filter.update({'eventId': min(predicates['event_ids']), 'eventIdOp': 'GE', 'maxItems': max(predicates['event_ids']) - min(predicates['event_ids']) + 1})
+			bounded.append('event_ids')
+		elif predicates['min_event_id'] is not None:
+			rest_filter.update({'eventId': predicates['min_event_id'], 'eventIdOp': 'GT'})
+			pushed.append('min_event_id')
+			if predicates['max_event_id'] is not None:
+				# there are at most this many events with IDs in the range
+				rest_filter['maxItems'] = max(predicates['max_event_id'] - predicates['min_event_id'] - 1, 1)
+				bounded.append('max_event_id')
+		elif predicates['max_event_id'] is not None:
+			rest_filter.update({'eventId': predicates['max_event_id'], 'eventIdOp': 'LT'})
+			pushed.append('max_event_id')
+
+		call = {'rest_filter': rest_filter}
+		if use_rest_api_flag:
+			call['REST_API'] = True
+		return {'api': 'REST', 'calls': [call], 'pushed': pushed, 'bounded': bounded}
+
+	def _get_query_computer(self, event):
+		computer_id = _as_id(_get_event_value(event, ['hostID', 'computer_id']))
+		if self.manager and computer_id is not None and self.manager.computers.has_key(computer_id):
+			return computer_id, self.manager.computers[computer_id]
+		return computer_id, None
+
+	def _matches_query(self, event, plan):
+		''' Apply the predicates that couldn't be pushed down to an event
+		'''
+		predicates = plan['predicates']
+		for predicate in plan['local']:
+			if predicate in ['computer_ids', 'computer_names']:
+				computer_id, computer = self._get_query_computer(event)
+				if not computer_id in predicates['computer_ids'] and not _get_event_value(event, ['hostName', 'computer_name']) in predicates['computer_names']:
+					return False
+			elif predicate == 'computer_group_ids':
+				computer_id, computer = self._get_query_computer(event)
+				if not computer or not _as_id(core.get_property(computer, 'computer_group_id')) in predicates['computer_group_ids']:
+					return False
+			elif predicate == 'policy_ids':
+				computer_id, computer = self._get_query_computer(event)
+				if not computer or not _as_id(core.get_property(computer, 'security_profile_id')) in predicates['policy_ids']:
+					return False
+			elif predicate in ['start', 'end']:
+				event_time = get_event_time(event)
+				if event_time is None or event_time < predicates['start'] or (predicates['end'] is not None and event_time > predicates['end']):
+					return False
+			else:
+				event_id = _as_id(_get_event_value(event, [key for key in event.keys() if key.lower().endswith('eventid')]))
+				if predicates['event_ids'] and not event_id in predicates['event_ids']:
+					return False
+				if predicates['min_event_id'] is not None and not event_id > predicates['min_event_id']:
+					return False
+				if predicates['max_event_id'] is not None and not event_id < predicates['max_event_id']:
+					return False
+		return True
+
+	def _run_query(self, plan, where=None, fields=None):
+		if fields:
+			# keep the fields needed to apply the local predicates
+			fields = list(fields)
+			if [predicate for predicate in plan['local'] if predicate.startswith('computer_') or predicate == 'policy_ids']:
+				fields.extend(['hostID', 'hostName'])
+			if 'start' in plan['local'] or 'end' in plan['local']:
+				fields.extend(_EVENT_TIME_KEYS)
+		seen = set()
+		for call in plan['calls']:
+			for id_key, events in self._iterate_pages(fields, PAGE_SIZE, **call):
+				for event in events:
+					if len(plan['calls']) > 1:
+						if event.get(id_key) in seen:
+							continue
+						seen.add(event.get(id_key))
+					if self._matches_query(event, plan) and (not where or where(event)):
+						yield id_key, event
+
+	def iterate_query(self, where=None, fields=None, **predicates):
+		''' Run a query (see plan_query for the predicates) and yield each
+			matching event as a dictionary of API keypairs without adding it
+			to the collection. where is an optional callable(event) applied
+			after the other predicates. fields is an optional projection
+			(see get()).
+		'''
+		for id_key, event in self._run_query(self.plan_query(**predicates), where, fields):
+			yield event
+
+	def query(self, where=None, fields=None, **predicates):
+		''' Run a query (see plan_query for the predicates) and add the
+			matching events to the collection. Returns the IDs of the
+			matching events.
+
+			Example:
+				mgr.firewall_events.query(computer_names='web01',
+					start=datetime.datetime(2016, 8, 1))
+		'''
+		plan = self.plan_query(**predicates)
+		if self.log:
+			self.log('Querying {} via {} with {} pushed down and {} applied locally'.format(
+				self.__class__.__name__, plan['api'], plan['pushed'], plan['local']), level='debug')
+		results = []
+		for id_key, event in self._run_query(plan, where, fields):
+			self._add_events(id_key, [event])
+			results.append(event[id_key])
+		return results
+
+
+class SystemEvents(_Events):
 	''' Retrieve System Events from the Deep Security Manager. Events can only
 		be retrieved via the SOAP API.
 
@@ -90,12 +683,7 @@ class SystemEvents(core.CoreDict):
 			id_filter - If None, all events greater than 0 will be retrieved.
 			includeNonHostevents - Boolean to specify retrieval non-host events
 	'''
-	def __init__(self, manager=None):
-		core.CoreDict.__init__(self)
-		self.manager = manager
-		self.log = self.manager.log if self.manager else None
-
-	def get(self, time_filter=None, host_filter=None, id_filter=None, 
+	def _retrieve(self, time_filter=None, host_filter=None, id_filter=None, 
 			includeNonHostevents=True):
 		response = _make_call(
 			'systemEventRetrieve2', 
@@ -109,12 +697,10 @@ class SystemEvents(core.CoreDict):
 				}
 			)
 		)
-		for event in response['data'][0]['systemEvents']:
-			self[event['systemEventID']] = _Event(event, self.log)
-		return len(self)
+		return 'systemEventID', _get_events(response, 'systemEvents')
 
 
-class AntiMalwareEvents(core.CoreDict):
+class AntiMalwareEvents(_Events):
 	''' Retrieve AntiMalware Events from the Deep Security Manager. Events can
 		be retrieved via either the SOAP or REST API methods.
 
@@ -126,12 +712,7 @@ class AntiMalwareEvents(core.CoreDict):
 		Usage - REST:
 			rest_filter - If None, all available events will be retrieved.
 	'''
-	def __init__(self, manager=None):
-		core.CoreDict.__init__(self)
-		self.manager = manager
-		self.log = self.manager.log if self.manager else None
-
-	def get(self, time_filter=None, host_filter=None, id_filter=None, 
+	def _retrieve(self, time_filter=None, host_filter=None, id_filter=None, 
 			rest_filter=None, REST_API=False):
 		if REST_API:
 			response = _make_call(
@@ -144,7 +725,8 @@ class AntiMalwareEvents(core.CoreDict):
 				REST_API=REST_API, 
 				cookieAuth=False
 			)
-			events = response['data'][0]['antiMalwareEventListing']['events']
+			return 'antiMalwareEventID', _get_events(
+				response, 'antiMalwareEventListing', 'events')
 		else:
 			response = _make_call(
 				'antiMalwareEventRetrieve2', 
@@ -155,13 +737,11 @@ class AntiMalwareEvents(core.CoreDict):
 					id_filter
 				)
 			)
-			events = response['data'][0]['antiMalwareEvents']
-		for event in events:
-			self[event['antiMalwareEventID']] = _Event(event, self.log)
-		return len(self)
+			return 'antiMalwareEventID', _get_events(
+				response, 'antiMalwareEvents')
 
 
-class WebReputationEvents(core.CoreDict):
+class WebReputationEvents(_Events):
 	''' Retrieve Web Reputation Events from the Deep Security Manager. Events 
 		can be retrieved via either the SOAP or REST API methods.
 
@@ -173,12 +753,7 @@ class WebReputationEvents(core.CoreDict):
 		Usage - REST:
 			rest_filter - If None, all available events will be retrieved.
 	'''
-	def __init__(self, manager=None):
-		core.CoreDict.__init__(self)
-		self.manager = manager
-		self.log = self.manager.log if self.manager else None
-
-	def get(self, time_filter=None, host_filter=None, id_filter=None, 
+	def _retrieve(self, time_filter=None, host_filter=None, id_filter=None, 
 			rest_filter=None, REST_API=False):
 		if REST_API:
 			response = _make_call(
@@ -191,7 +766,8 @@ class WebReputationEvents(core.CoreDict):
 				REST_API=REST_API, 
 				cookieAuth=False
 			)
-			events = response['data'][0]['WebReputationEventListing']['WebReputationEvent']
+			return 'webReputationEventID', _get_events(
+				response, 'WebReputationEventListing', 'WebReputationEvent')
 		else:
 			response = _make_call(
 				'webReputationEventRetrieve2', 
@@ -202,13 +778,11 @@ class WebReputationEvents(core.CoreDict):
 					id_filter
 				)
 			)
-			events = response['data'][0]['webReputationEvents']
-		for event in events:
-			self[event['webReputationEventID']] = _Event(event, self.log)
-		return len(self)
+			return 'webReputationEventID', _get_events(
+				response, 'webReputationEvents')
 
 
-class FirewallEvents(core.CoreDict):
+class FirewallEvents(_Events):
 	''' Retrieve Firewall Events from the Deep Security Manager. Events
 		can only be retrieved via the SOAP API.
 
@@ -217,12 +791,7 @@ class FirewallEvents(core.CoreDict):
 			host_filter - If None, events for all hosts will be retrieived.
 			id_filter - If None, all events greater than 0 will be retrieved.
 	'''
-	def __init__(self, manager=None):
-		core.CoreDict.__init__(self)
-		self.manager = manager
-		self.log = self.manager.log if self.manager else None
-
-	def get(self, time_filter=None, host_filter=None, id_filter=None):
+	def _retrieve(self, time_filter=None, host_filter=None, id_filter=None):
 		response = _make_call(
 			'firewallEventRetrieve2', 
 			self.manager, 
@@ -232,12 +801,10 @@ class FirewallEvents(core.CoreDict):
 				id_filter
 			)
 		)
-		for event in response['data'][0]['firewallEvents']:
-			self[event['firewallEventID']] = _Event(event, self.log)
-		return len(self)
+		return 'firewallEventID', _get_events(response, 'firewallEvents')
 
 
-class IntrusionPreventionEvents(core.CoreDict):
+class IntrusionPreventionEvents(_Events):
 	''' Retrieve Intrusion Prevention Events from the Deep Security Manager. 
 		Events can only be retrieved via the SOAP API.
 
@@ -246,12 +813,7 @@ class IntrusionPreventionEvents(core.CoreDict):
 			host_filter - If None, events for all hosts will be retrieived.
 			id_filter - If None, all events greater than 0 will be retrieved.
 	'''
-	def __init__(self, manager=None):
-		core.CoreDict.__init__(self)
-		self.manager = manager
-		self.log = self.manager.log if self.manager else None
-
-	def get(self, time_filter=None, host_filter=None, id_filter=None):
+	def _retrieve(self, time_filter=None, host_filter=None, id_filter=None):
 		response = _make_call(
 			'DPIEventRetrieve2', 
 			self.manager, 
@@ -261,12 +823,10 @@ class IntrusionPreventionEvents(core.CoreDict):
 				id_filter
 			)
 		)
-		for event in response['data'][0]['DPIEvents']:
-			self[event['intrusionEventID']] = _Event(event, self.log)
-		return len(self)
+		return 'intrusionEventID', _get_events(response, 'DPIEvents')
 
 
-class IntegrityMonitoringEvents(core.CoreDict):
+class IntegrityMonitoringEvents(_Events):
 	''' Retrieve Integrity Monitoring Events from the Deep Security Manager. 
 		Events can be retrieved via either the SOAP or REST API methods.
 
@@ -284,11 +844,11 @@ class IntegrityMonitoringEvents(core.CoreDict):
 						   filter is defaulted to True.
 	'''
 	def __init__(self, manager=None):
-		core.CoreDict.__init__(self)
-		self.manager = manager
-		self.log = self.manager.log if self.manager else None
+		_Events.__init__(self, manager)
+		self._summary_fields = set()  # API keys returned without the description
+		self._detail_properties = set([translation.Terms.get(field) for field in INTEGRITY_DETAIL_FIELDS])
 
-	def get(self, time_filter=None, host_filter=None, id_filter=None, 
+	def _retrieve(self, time_filter=None, host_filter=None, id_filter=None, 
 			rest_filter=None, extendedDesc=True, REST_API=False):
 		if REST_API:
 			response = _make_call(
@@ -298,12 +858,13 @@ class IntegrityMonitoringEvents(core.CoreDict):
 					rest_filter=rest_filter, 
 					ext_parms={
 						'extendedDesc': extendedDesc
-					}
+					},
+					REST_API=REST_API
 				), 
 				REST_API=REST_API
 			)
-			for event in response['data'][0]['ListEventsResponse']['events']:
-				self[event['eventID']] = _Event(event, self.log)
+			return 'eventID', _get_events(
+				response, 'ListEventsResponse', 'events')
 		else:
 			response = _make_call(
 				'IntegrityEventRetrieve2', 
@@ -314,13 +875,81 @@ class IntegrityMonitoringEvents(core.CoreDict):
 					id_filter
 				)
 			)
-			data = response['data'][0]['integrityEventRetrieve2Return']
-			for event in data['integrityEvents']:
-				self[event['integrityEventID']] = _Event(event, self.log)
+			return 'integrityEventID', _get_events(
+				response, 'integrityEventRetrieve2Return', 'integrityEvents')
+
+	def get_summaries(self, rest_filter=None):
+		''' Retrieve events without their extended descriptions via the REST
+			API. Integrity events are usually the largest events by far and
+			most of the size is the extended description, so this is much
+			faster when most events are discarded after a look at the
+			summary (e.g., after .find(key=...)). The extended descriptions
+			of the events that are kept can be loaded with load_details().
+			Returns the number of events in the collection.
+		'''
+		id_key, events = self._retrieve(rest_filter=rest_filter, extendedDesc=False, REST_API=True)
+		for event in events:
+			self._summary_fields.update(event.keys())
+			self[event[id_key]] = _SummaryIntegrityEvent(event, self.log, self, event[id_key])
 		return len(self)
 
+	def retrieve_details(self, event_ids, max_span=500, max_gap=16):
+		''' Retrieve the events with the specified IDs with their extended
+			descriptions. IDs are grouped into runs that span at most
+			max_span IDs with at most max_gap IDs between consecutive
+			wanted IDs, so sparse IDs don't download the events in between.
+			Each run is retrieved with a single REST call. Returns a
+			dictionary of event ID => event as API keypairs.
+		'''
+		wanted = set(['{}'.format(event_id) for event_id in event_ids])
+		ids = sorted(set([long(event_id) for event_id in wanted]))
+		runs = []
+		for event_id in ids:
+			if runs and event_id - runs[-1][0] < max_span and event_id - runs[-1][1] <= max_gap:
+				runs[-1][1] = event_id
+			else:
+				runs.append([event_id, event_id])
 
-class LogInspectionEvents(core.CoreDict):
+		results = {}
+		for first, last in runs:
+			rest_filter = filters.create_rest_event_filter(eventId=first, eventIdOp='GE', maxItems=last - first + 1)
+			id_key, events = self._retrieve(rest_filter=rest_filter, extendedDesc=True, REST_API=True)
+			for event in events:
+				event_id = '{}'.format(event.get(id_key))
+				if event_id in wanted:
+					results[event_id] = event
+		return results
+
+	def load_details(self, event_ids=None, max_span=500, max_gap=16):
+		''' Load the extended descriptions of events retrieved with
+			get_summaries(). Defaults to every event in the collection whose
+			description hasn't been loaded. Returns the number of events
+			updated.
+		'''
+		if event_ids is None:
+			event_ids = [event_id for event_id, event in self.items() if isinstance(event, _SummaryIntegrityEvent) and not event.details_loaded]
+		keys = dict([('{}'.format(key), key) for key in self.keys()])
+		summaries = dict([('{}'.format(event_id), dict.get(self, keys.get('{}'.format(event_id)))) for event_id in event_ids])
+		summaries = dict([(k, v) for k, v in summaries.items() if isinstance(v, _SummaryIntegrityEvent)])
+		if not summaries:
+			return 0
+
+		details = self.retrieve_details(summaries.keys(), max_span=max_span, max_gap=max_gap)
+		for event_id, event in summaries.items():
+			if event_id in details:
+				# learn which properties only come with the description
+				for field in details[event_id].keys():
+					if not field in self._summary_fields:
+						self._detail_properties.add(translation.Terms.get(field))
+				event._set_properties(details[event_id], self.log)
+			elif self.log:
+				self.log('Could not retrieve the extended description for integrity event {}'.format(event_id), level='warning')
+			# don't try again for events that weren't returned
+			event._details_loaded = True
+		return len(details)
+
+
+class LogInspectionEvents(_Events):
 	''' Retrieve Log Inspection Events from the Deep Security Manager. Events can 
 		be retrieved via either the SOAP or REST API methods.
 
@@ -332,12 +961,7 @@ class LogInspectionEvents(core.CoreDict):
 		Usage - REST:
 			rest_filter - If None, all available events will be retrieved.
 	'''
-	def __init__(self, manager=None):
-		core.CoreDict.__init__(self)
-		self.manager = manager
-		self.log = self.manager.log if self.manager else None
-
-	def get(self, time_filter=None, host_filter=None, id_filter=None, 
+	def _retrieve(self, time_filter=None, host_filter=None, id_filter=None, 
 			rest_filter=None, REST_API=False):
 		if REST_API:
 			response = _make_call(
@@ -349,8 +973,8 @@ class LogInspectionEvents(core.CoreDict):
 				), 
 				REST_API=REST_API
 			)
-			for event in response['data'][0]['ListEventsResponse']['events']:
-				self[event['eventID']] = _Event(event, self.log)
+			return 'eventID', _get_events(
+				response, 'ListEventsResponse', 'events')
 		else:
 			response = _make_call(
 				'logInspectionEventRetrieve2', 
@@ -361,24 +985,18 @@ class LogInspectionEvents(core.CoreDict):
 					id_filter
 				)
 			)
-			for event in response['data'][0]['logInspectionEvents']:
-				self[event['logInspectionEventID']] = _Event(event, self.log)
-		return len(self)
+			return 'logInspectionEventID', _get_events(
+				response, 'logInspectionEvents')
 
 
-class ApplicationControlEvents(core.CoreDict):
+class ApplicationControlEvents(_Events):
 	''' Retrieve Application Control Events from the Deep Security Manager.
 		Events can only be retrieved via the REST API.
 
 		Usage:
 			rest_filter - If None, all available events will be retrieved.
 	'''
-	def __init__(self, manager=None):
-		core.CoreDict.__init__(self)
-		self.manager = manager
-		self.log = self.manager.log if self.manager else None
-
-	def get(self, rest_filter=None):
+	def _retrieve(self, rest_filter=None):
 		response = _make_call(
 			'events/appcontrol', 
 			self.manager, 
@@ -388,6 +1006,164 @@ class ApplicationControlEvents(core.CoreDict):
 			), 
 			REST_API=True
 		)
-		for event in response['data'][0]['ListEventsResponse']['events']:
-			self[event['eventID']] = _Event(event, self.log)
-		return len(self)
+		return 'eventID', _get_events(
+			response, 'ListEventsResponse', 'events')
+
+
+# fields that hold the time of an event, as API keys and object properties
+_EVENT_TIME_KEYS = ['logDate', 'log_date', 'eventTime', 'event_time', 'time']
+# fields that identify the computer an event came from
+_EVENT_HOST_KEYS = ['hostID', 'computer_id', 'hostName', 'computer_name']
+
+
+def _get_event_value(event, keys):
+	''' Return the first of the keys present on an event. Events can be
+		dictionaries (as yielded by iterate()) or event objects.
+	'''
+	if isinstance(event, core.CoreProxy):
+		event = event.raw if not event.hydrated else event.hydrate()
+	if not isinstance(event, dict):
+		# read the properties directly so objects that load missing
+		# properties on access (see _SummaryIntegrityEvent) don't make a
+		# call for every key probed
+		event = getattr(event, '__dict__', {})
+	for key in keys:
+		value = event.get(key)
+		if value is not None:
+			return value
+	return None
+
+
+def get_event_time(event):
+	''' Return the time of an event as milliseconds since the epoch (UTC).
+		Handles SOAP dateTime strings (e.g., 2016-08-01T12:34:56.789Z),
+		REST millisecond timestamps and datetime objects. Returns None if the
+		event has no time that can be parsed.
+	'''
+	value = _get_event_value(event, _EVENT_TIME_KEYS)
+	if value is None:
+		return None
+	if isinstance(value, datetime.datetime):
+		return calendar.timegm(value.utctimetuple()) * 1000 + value.microsecond // 1000
+	if isinstance(value, (int, long, float)):
+		return value
+	value = value.strip()
+	if re.search(r'^\d+$', value):
+		return long(value)
+	m = re.search(r'^(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(?:\.(\d+))?(Z|[+-]\d\d:?\d\d)?$', value)
+	if not m:
+		return None
+	parts = [int(part) for part in m.groups()[:6]]
+	millis = int((m.group(7) or '0')[:3].ljust(3, '0'))
+	result = calendar.timegm(parts) * 1000 + millis
+	if m.group(8) and m.group(8) != 'Z':
+		offset = m.group(8).replace(':', '')
+		minutes = int(offset[1:3]) * 60 + int(offset[3:5])
+		result -= (1 if offset[0] == '+' else -1) * minutes * 60 * 1000
+	return result
+
+
+def get_event_host(event):
+	''' Return the ID (or name if there's no ID) of the computer an event
+		came from.
+	'''
+	return _get_event_value(event, _EVENT_HOST_KEYS)
+
+
+# the number of events each stream passed to merge_events may be out of order by
+DEFAULT_REORDER_WINDOW = 1000
+
+
+def _reorder(events, window):
+	''' Yield events in time order when they're at most window events out
+		of order. Uses a heap of at most window events.
+	'''
+	heap = []
+	for i, event in enumerate(events):
+		heapq.heappush(heap, (get_event_time(event) or 0, i, event))
+		if len(heap) > window:
+			yield heapq.heappop(heap)[2]
+	while heap:
+		yield heapq.heappop(heap)[2]
+
+
+def merge_events(streams, reorder_window=DEFAULT_REORDER_WINDOW):
+	''' Merge several event streams into a single stream ordered by event
+		time.
+
+		streams - A dictionary of event type => iterable of events (e.g.,
+				  {'firewall': mgr.firewall_events.iterate(), ...}) or a
+				  list of iterables, in which case the event type is the
+				  position in the list.
+		reorder_window - int - The number of events each stream may be out
+						 of order by. Each stream is passed through a heap of
+						 this size before it's merged.
+
+		The Manager doesn't guarantee that events are returned in time
+		order (iterate() pages through them by event ID), so each stream is
+		reordered within reorder_window events. An event that arrives
+		further out of order than that is yielded late. With
+		reorder_window=0 the streams must already be in time order or the
+		output will silently be out of order.
+
+		Yields (event type, event) tuples. Each stream holds its pending
+		event and reorder window in memory, plus the page of events its
+		iterate() is working through (see _Events.iterate). Events without a
+		time are treated as the oldest.
+	'''
+	if not isinstance(streams, dict):
+		streams = dict(enumerate(streams))
+
+	heap = []
+	iterators = {}
+	for event_type, stream in streams.items():
+		iterator = iter(_reorder(stream, reorder_window) if reorder_window else stream)
+		iterators[event_type] = iterator
+		for event in iterator:
+			heap.append((get_event_time(event) or 0, len(heap), event_type, event))
+			break
+	heapq.heapify(heap)
+
+	sequence = len(heap)
+	while heap:
+		event_time, i, event_type, event = heap[0]
+		yield event_type, event
+		for next_event in iterators[event_type]:
+			sequence += 1
+			heapq.heapreplace(heap, (get_event_time(next_event) or 0, sequence, event_type, next_event))
+			break
+		else:
+			heapq.heappop(heap)
+
+
+def correlate_events(merged, window=300, key=get_event_host):
+	''' Group a time ordered stream (as yielded by merge_events) into
+		bursts of related activity.
+
+		Events with the same key (by default, the computer they came from)
+		are added to the same group as long as each arrives within window
+		seconds of the previous one. Once a group goes quiet for longer than
+		window, it's yielded as (key, [(event type, event), ...]). Only the
+		open groups are held in memory.
+	'''
+	window_ms = window * 1000
+	groups = {}
+	last_seen = {}
+	expiry = []  # heap of (last seen, key), stale entries are skipped
+	for event_type, event in merged:
+		event_time = get_event_time(event) or 0
+
+		# close any groups that can no longer receive events
+		while expiry and event_time - expiry[0][0] > window_ms:
+			seen, expired_key = heapq.heappop(expiry)
+			if last_seen.get(expired_key) == seen:
+				del last_seen[expired_key]
+				yield expired_key, groups.pop(expired_key)
+
+		event_key = key(event)
+		groups.setdefault(event_key, []).append((event_type, event))
+		last_seen[event_key] = event_time
+		heapq.heappush(expiry, (event_time, event_key))
+
+	for event_key in sorted(groups.keys(), key=lambda k: last_seen[k]):
+		yield event_key, groups[event_key]
@@ -185,13 +185,14 @@ def create_rest_event_filter(eventId=None, eventIdOp='EQ', eventTime=None,
 							   Default is 'eq'.
 		maxItems - int - The maximum events to return. 1 is minimum valid value
 	'''
-	maxItems = int(maxItems)
+	if maxItems is not None:
+		maxItems = max(int(maxItems), 1)
 	filter = {
 		'eventId': eventId,
 		'eventIdOp': None,
 		'eventTime': eventTime,
 		'eventTimeOp': None,
-		'maxItems': maxItems if maxItems >= 1 else 1 
+		'maxItems': maxItems
 	}
 	if eventIdOp:
 		op = _format_and_validate_operator(eventIdOp, RestEnumOperator)
@@ -0,0 +1,352 @@
+# standard library
+import collections
+import datetime
+import socket
+import ssl
+import threading
+import time
+import traceback
+
+# 3rd party libraries
+
+# project libraries
+import enrichment
+import events
+
+PROTOCOLS = ['UDP', 'TCP', 'TLS']
+MESSAGE_FORMATS = ['CEF', 'LEEF']
+QUEUE_POLICIES = ['BLOCK', 'DROP']
+
+# syslog facility local0 and the severity used for every message
+SYSLOG_FACILITY = 16
+SYSLOG_SEVERITY = 5
+SEND_CHUNK_BYTES = 64 * 1024 # the most written to a TCP or TLS connection per call
+
+# event fields with a standard key in each format, other fields are added under their API key
+CEF_FIELDS = {
+  'hostName': 'dvchost',
+  'sourceIP': 'src',
+  'sourcePort': 'spt',
+  'sourceMAC': 'smac',
+  'destinationIP': 'dst',
+  'destinationPort': 'dpt',
+  'destinationMAC': 'dmac',
+  'protocol': 'proto',
+  'action': 'act',
+  'reason': 'reason',
+  'packetSize': 'in',
+  'logDate': 'rt',
+  }
+LEEF_FIELDS = {
+  'hostName': 'identHostName',
+  'sourceIP': 'src',
+  'sourcePort': 'srcPort',
+  'sourceMAC': 'srcMAC',
+  'destinationIP': 'dst',
+  'destinationPort': 'dstPort',
+  'destinationMAC': 'dstMAC',
+  'protocol': 'proto',
+  'action': 'act',
+  'packetSize': 'srcBytes',
+  'logDate': 'devTime',
+  }
+
+# the fields that identify the rule (or type of event) for the signature ID, in order of preference
+SIGNATURE_FIELDS = ['DPIRuleID', 'integrityRuleID', 'logInspectionRuleID', 'firewallRuleID', 'eventID', 'malwareType', 'reason']
+
+def _escape_cef_header(value):
+  return u'{}'.format(value).replace(u'\\', u'\\\\').replace(u'|', u'\\|')
+
+def _escape_cef_value(value):
+  return u'{}'.format(value).replace(u'\\', u'\\\\').replace(u'=', u'\\=').replace(u'\r', u'\\r').replace(u'\n', u'\\n')
+
+def _escape_leef_value(value):
+  return u'{}'.format(value).replace(u'\t', u' ').replace(u'\r', u' ').replace(u'\n', u' ')
+
+def _get_fields(event):
+  """
+  Get the fields of an event as API keypairs, skipping empty values
+  """
+  if not isinstance(event, dict): event = enrichment._as_api_dict(event)
+  return [ (k, v) for k, v in sorted(event.items()) if v is not None and v != u'' and not isinstance(v, (dict, list)) ]
+
+def _get_signature(event_type, fields):
+  values = dict(fields)
+  for field in SIGNATURE_FIELDS:
+    if values.get(field) is not None: return values[field]
+  return event_type or 'event'
+
+def _get_severity(fields):
+  values = dict(fields)
+  for field in ['severity', 'rank']:
+    try:
+      return max(0, min(10, int(values[field])))
+    except (KeyError, TypeError, ValueError):
+      pass
+  return 3
+
+def format_cef(event, event_type=None, vendor='Trend Micro', product='Deep Security Manager', version='1.0'):
+  """
+  Format an event as a CEF message (without the syslog header)
+  """
+  fields = _get_fields(event)
+  extension = []
+  for k, v in fields:
+    if k == 'logDate':
+      v = events.get_event_time({ k: v }) or v
+    extension.append(u'{}={}'.format(CEF_FIELDS.get(k, k), _escape_cef_value(v)))
+  if event_type: extension.append(u'cat={}'.format(_escape_cef_value(event_type)))
+
+  return u'CEF:0|{}|{}|{}|{}|{}|{}|{}'.format(
+    _escape_cef_header(vendor),
+    _escape_cef_header(product),
+    _escape_cef_header(version),
+    _escape_cef_header(_get_signature(event_type, fields)),
+    _escape_cef_header(event_type or 'event'),
+    _get_severity(fields),
+    u' '.join(extension),
+    )
+
+def format_leef(event, event_type=None, vendor='Trend Micro', product='Deep Security Manager', version='1.0'):
+  """
+  Format an event as a LEEF 1.0 message (without the syslog header)
+  """
+  fields = _get_fields(event)
+  attributes = [ u'sev={}'.format(_get_severity(fields)) ]
+  for k, v in fields:
+    if k == 'logDate':
+      v = events.get_event_time({ k: v }) or v
+    attributes.append(u'{}={}'.format(LEEF_FIELDS.get(k, k), _escape_leef_value(v)))
+  if event_type: attributes.append(u'cat={}'.format(_escape_leef_value(event_type)))
+
+  return u'LEEF:1.0|{}|{}|{}|{}|{}'.format(
+    _escape_cef_header(vendor),
+    _escape_cef_header(product),
+    _escape_cef_header(version),
+    _escape_cef_header(_get_signature(event_type, fields)),
+    u'\t'.join(attributes),
+    )
+
+class SyslogForwarder(object):
+  """
+  Forward events to a syslog server as CEF or LEEF messages
+
+  Events are added to a bounded queue by .send() (or .handler(), which can
+  be passed to Manager.collect_events()) and delivered by a sender thread
+  in batches of up to batch_size over a single reused connection. TCP and
+  TLS batches are written with a single call using octet counting framing
+  (RFC 6587) unless framing is 'NEWLINE'
+
+  Once max_queue events are waiting, queue_policy decides whether .send()
+  blocks until there's room ('BLOCK') or the new events are dropped
+  ('DROP'). If a batch can't be delivered, the connection is reopened and
+  the batch retried up to max_retries times before it's counted as failed
+
+  Counters for the events queued, sent, dropped and failed are in .stats
+  """
+  def __init__(self, host, port=514, protocol='UDP', message_format='CEF', framing='OCTET', batch_size=500, max_queue=10000, queue_policy='BLOCK', max_retries=3, timeout=10, ca_file=None, verify=True, hostname=None, log_func=None):
+    self.host = host
+    self.port = port
+    self.protocol = protocol.upper()
+    self.message_format = message_format.upper()
+    self.queue_policy = queue_policy.upper()
+    if not self.protocol in PROTOCOLS: raise ValueError("Invalid protocol [{}]. Must be one of {}".format(protocol, PROTOCOLS))
+    if not self.message_format in MESSAGE_FORMATS: raise ValueError("Invalid message format [{}]. Must be one of {}".format(message_format, MESSAGE_FORMATS))
+    if not self.queue_policy in QUEUE_POLICIES: raise ValueError("Invalid queue policy [{}]. Must be one of {}".format(queue_policy, QUEUE_POLICIES))
+    self.framing = framing.upper()
+    self.batch_size = max(1, batch_size)
+    self.max_queue = max(1, max_queue)
+    self.max_retries = max_retries
+    self.timeout = timeout
+    self.ca_file = ca_file
+    self.verify = verify
+    self.hostname = hostname if hostname else socket.gethostname()
+    self.log = log_func if log_func else lambda *args, **kwargs: None
+    self.formatter = format_cef if self.message_format == 'CEF' else format_leef
+
+    self.stats = {
+      'queued': 0,
+      'sent': 0,
+      'dropped': 0,
+      'failed': 0,
+      'bytes': 0,
+      'connections': 0,
+      'started': time.time(),
+      }
+
+    self._queue = collections.deque()
+    self._in_flight = 0
+    self._condition = threading.Condition()
+    self._closed = False
+    self._sock = None
+    self._thread = None
+
+  def __enter__(self): return self
+
+  def __exit__(self, *args): self.close()
+
+  @property
+  def events_per_second(self):
+    seconds = time.time() - self.stats['started']
+    return self.stats['sent'] / seconds if seconds > 0 else 0.0
+
+  def _connect(self):
+    if self.protocol == 'UDP':
+      self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+      self._sock.connect((self.host, self.port))
+    else:
+      sock = socket.create_connection((self.host, self.port), self.timeout)
+      if self.protocol == 'TLS':
+        context = ssl.create_default_context(cafile=self.ca_file)
+        if not self.verify:
+          context.check_hostname = False
+          context.verify_mode = ssl.CERT_NONE
+        sock = context.wrap_socket(sock, server_hostname=self.host)
+      self._sock = sock
+    self.stats['connections'] += 1
+
+  def _disconnect(self):
+    if self._sock:
+      try:
+        self._sock.close()
+      except Exception: pass
+      self._sock = None
+
+  def _format(self, event_type, event):
+    timestamp = datetime.datetime.utcnow().strftime('%b %d %H:%M:%S')
+    message = u'<{}>{} {} {}'.format(SYSLOG_FACILITY * 8 + SYSLOG_SEVERITY, timestamp, self.hostname, self.formatter(event, event_type=event_type))
+    return message.encode('utf-8')
+
+  def _frame(self, message):
+    if self.protocol == 'UDP': return message
+    if self.framing == 'NEWLINE': return '{}\n'.format(message)
+    return '{} {}'.format(len(message), message)
+
+  def _transmit(self, frames):
+    """
+    Write a deque of framed messages, removing each once it's been written
+    in full. If the connection fails, the deque is left holding the
+    messages still to send, so a retry doesn't resend what was delivered.
+    A message cut off part way is resent whole over the new connection
+    """
+    if not self._sock: self._connect()
+    if self.protocol == 'UDP':
+      while frames:
+        self._sock.send(frames[0])
+        frames.popleft()
+      return
+
+    data = ''.join(frames)
+    offset = 0
+    removed = 0 # bytes of the frames removed so far
+    while offset < len(data):
+      offset += self._sock.send(data[offset:offset + SEND_CHUNK_BYTES])
+      while frames and offset - removed >= len(frames[0]): removed += len(frames.popleft())
+
+  def _sender(self):
+    while True:
+      with self._condition:
+        while not self._queue and not self._closed: self._condition.wait(1)
+        if not self._queue and self._closed: return
+        batch = [ self._queue.popleft() for i in range(min(self.batch_size, len(self._queue))) ]
+        self._in_flight = len(batch)
+        self._condition.notify_all()
+
+      messages = []
+      for event_type, event in batch:
+        try:
+          messages.append(self._format(event_type, event))
+        except Exception:
+          self.stats['failed'] += 1
+          self.log("Could not format event for syslog", err=traceback.format_exc())
+
+      frames = collections.deque([ self._frame(message) for message in messages ])
+      total_bytes = sum([ len(frame) for frame in frames ])
+      for attempt in range(self.max_retries + 1):
+        try:
+          self._transmit(frames)
+          break
+        except Exception:
+          self._disconnect()
+          if attempt == self.max_retries:
+            self.stats['failed'] += len(frames)
+            self.log("Could not forward {} events to {}:{}".format(len(frames), self.host, self.port), err=traceback.format_exc())
+          else:
+            time.sleep(min(2 ** attempt, 30))
+      self.stats['sent'] += len(messages) - len(frames)
+      self.stats['bytes'] += total_bytes - sum([ len(frame) for frame in frames ])
+
+      with self._condition:
+        self._in_flight = 0
+        self._condition.notify_all()
+
+  def send(self, events, event_type=None):
+    """
+    Queue a stream of events to forward. Returns the number queued
+    """
+    if self._closed: raise IOError("The forwarder is closed")
+    if not self._thread:
+      self._thread = threading.Thread(target=self._sender)
+      self._thread.daemon = True
+      self._thread.start()
+
+    # the caller's events are read outside the lock (they may be a
+    # generator making API calls) and queued a batch at a time
+    count = 0
+    batch = []
+    for event in events:
+      batch.append((event_type, event))
+      if len(batch) >= self.batch_size:
+        count += self._enqueue(batch)
+        batch = []
+    if batch: count += self._enqueue(batch)
+
+    return count
+
+  def _enqueue(self, items):
+    count = 0
+    with self._condition:
+      for item in items:
+        if len(self._queue) >= self.max_queue:
+          if self.queue_policy == 'DROP':
+            self.stats['dropped'] += 1
+            continue
+          self._condition.notify_all()
+          while len(self._queue) >= self.max_queue: self._condition.wait(1)
+        self._queue.append(item)
+        count += 1
+      self.stats['queued'] += count
+      self._condition.notify_all()
+
+    return count
+
+  def handler(self, event_type, events):
+    """
+    Forward events as they're retrieved. Can be passed as a handler to
+    Manager.collect_events()
+    """
+    return self.send(events, event_type=event_type)
+
+  def flush(self, timeout=None):
+    """
+    Wait for the queued events to be delivered. Returns True if the queue
+    was emptied before the timeout
+    """
+    expires = time.time() + timeout if timeout is not None else None
+    with self._condition:
+      while self._queue or self._in_flight:
+        if expires and time.time() >= expires: return False
+        self._condition.wait(1 if not expires else max(0.01, min(1, expires - time.time())))
+    return True
+
+  def close(self, timeout=None):
+    """
+    Deliver the queued events and close the connection
+    """
+    with self._condition:
+      self._closed = True
+      self._condition.notify_all()
+    if self._thread:
+      self._thread.join(timeout)
+      self._thread = None
+    self._disconnect()
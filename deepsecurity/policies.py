@@ -1,4 +1,5 @@
 # standard library
+import bisect
 import datetime
 
 # 3rd party libraries
@@ -159,9 +160,16 @@ class Rules(core.CoreDict):
     self.manager = manager
     self.log = self.manager.log if self.manager else None
 
-  def get(self, intrusion_prevention=True, firewall=True, integrity_monitoring=True, log_inspection=True, web_reputation=True, application_types=True):
+  def get(self, intrusion_prevention=True, firewall=True, integrity_monitoring=True, log_inspection=True, web_reputation=True, application_types=True, fields=None, lazy=False):
     """
     Get all of the rules from Deep Security
+
+    fields limits the properties kept for each rule to the specified API keys
+    (e.g., ['name', 'identifier', 'cvssScore']). The rest, including the
+    rule XML, are dropped as the response is parsed
+
+    If lazy is True, each rule is held as a core.CoreProxy and the Rule is
+    only built when it's first used
     """
     # determine which rules to get from the Manager()
     rules_to_get = {
@@ -178,31 +186,41 @@ class Rules(core.CoreDict):
 
       if get:
         soap_call = self.manager._get_request_format(call=call)
+        soap_call['fields'] = fields
         if call == 'DPIRuleRetrieveAll':
           self.log("Calling {}. This may take 15-30 seconds as the call returns a substantial amount of data".format(call), level='warning')
 
         response = self.manager._request(soap_call)
         if response and response['status'] == 200:
           if not type(response['data']) == type([]): response['data'] = [response['data']]
+          factory = lambda api_response, rule_type=rule_key: self._create_rule(api_response, rule_type)
           for i, rule in enumerate(response['data']):
-            rule_obj = Rule(self.manager, rule, self.log, rule_type=rule_key)
+            if self.strings: self.strings.intern_record(rule)
+            rule_obj = core.CoreProxy(rule, factory) if lazy else factory(rule)
             if rule_obj:
-              if rule_key == 'intrusion_prevention' and rule_obj.cve_numbers:
-                rule_obj.cve_numbers = rule_obj.cve_numbers.split(', ')
-                if type(rule_obj.cve_numbers) in [type(''), type(u'')]: rule_obj.cve_numbers = [ rule_obj.cve_numbers ]
-                
               rule_id = '{}-{: >10}'.format(rule_key, i)
-              if 'id' in dir(rule_obj): rule_id = rule_obj.id
+              if lazy:
+                rule_id = core.get_property(rule_obj, 'id') or core.get_property(rule_obj, 'tbuid') or rule_id
+              elif 'id' in dir(rule_obj): rule_id = rule_obj.id
               elif 'tbuid' in dir(rule_obj): rule_id = rule_obj.tbuid
               self[rule_key][rule_id] = rule_obj
               self.log("Added Rule {} from call {}".format(rule_id, call), level='debug')
 
     return len(self)
 
+  def _create_rule(self, api_response, rule_type):
+    rule_obj = Rule(self.manager, api_response, self.log, rule_type=rule_type)
+    if rule_type == 'intrusion_prevention' and getattr(rule_obj, 'cve_numbers', None):
+      rule_obj.cve_numbers = rule_obj.cve_numbers.split(', ')
+      if type(rule_obj.cve_numbers) in [type(''), type(u'')]: rule_obj.cve_numbers = [ rule_obj.cve_numbers ]
+
+    return rule_obj
+
 class IPLists(core.CoreDict):
   def __init__(self, manager=None):
     core.CoreDict.__init__(self)
     self.manager = manager
+    self._index = None
     self.log = self.manager.log if self.manager else None
 
   def get(self):
@@ -215,9 +233,35 @@ class IPLists(core.CoreDict):
       for ip_list in response['data']:
         ip_list_obj = IPList(self.manager, ip_list, self.log)
         self[ip_list_obj.id] = ip_list_obj
+      self._index = None # the lists have changed, rebuild the index on next use
     
     return len(self)
 
+  def get_index(self):
+    """
+    Get an IPListIndex covering all of the IP Lists currently loaded
+
+    The index is built on first use and cached until the next call to .get()
+    """
+    if not getattr(self, '_index', None) or self._index.size != len(self):
+      self._index = IPListIndex(self.values(), log_func=self.log)
+
+    return self._index
+
+  def find_lists_containing(self, addresses):
+    """
+    Find the IP Lists that contain each of the specified addresses
+
+    Returns a dict of address => list of IP List IDs. Addresses that can't be
+    parsed or aren't in any IP List map to an empty list
+    """
+    if type(addresses) in [type(''), type(u'')]: addresses = [addresses]
+    results = {}
+    for address, ip_list_ids in self.get_index().lookup_many(addresses).items():
+      results[address] = sorted(ip_list_ids)
+
+    return results
+
 class Policy(core.CoreObject):
   def __init__(self, manager=None, api_response=None, log_func=None):
     self.manager = manager
@@ -303,12 +347,194 @@ class Rule(core.CoreObject):
     self.policies = core.CoreDict()
     if api_response: self._set_properties(api_response, log_func)  
 
+class IPListIndex(object):
+  """
+  An interval index across a set of IP Lists
+
+  Every single address, CIDR block and range from the IP Lists is flattened
+  into a sorted set of non-overlapping segments (one set per IP version). Each 
+  segment records which IP Lists cover it so a lookup is a binary search 
+  instead of a scan of every entry in every list
+  """
+  def __init__(self, ip_lists=None, log_func=None):
+    self.size = 0
+    self._boundaries = { 4: [], 6: [] }
+    self._segments = { 4: [], 6: [] }
+    if ip_lists: self._build(ip_lists, log_func)
+
+  def _build(self, ip_lists, log_func=None):
+    """
+    Flatten the ranges of all of the IP Lists into segments
+    """
+    changes = { 4: {}, 6: {} }
+    for ip_list in ip_lists:
+      self.size += 1
+      for version, start, end in getattr(ip_list, 'ranges', []):
+        changes[version].setdefault(start, []).append((1, ip_list.id))
+        changes[version].setdefault(end + 1, []).append((-1, ip_list.id))
+
+    shared_segments = {} # identical sets of IP Lists share a single frozenset
+    for version, points in changes.items():
+      active = {}
+      for point in sorted(points.keys()):
+        for delta, ip_list_id in points[point]:
+          active[ip_list_id] = active.get(ip_list_id, 0) + delta
+          if not active[ip_list_id]: del(active[ip_list_id])
+
+        segment = frozenset(active.keys())
+        segment = shared_segments.setdefault(segment, segment)
+        if self._segments[version] and self._segments[version][-1] is segment: continue # merge adjacent segments
+        self._boundaries[version].append(point)
+        self._segments[version].append(segment)
+
+    if log_func: log_func("Indexed {} IP Lists into {} segments".format(self.size, len(self._segments[4]) + len(self._segments[6])), level='debug')
+
+  def lookup(self, address):
+    """
+    Return a frozenset of the IDs of the IP Lists that contain the specified address
+    """
+    parsed = _parse_address(address)
+    if not parsed: return frozenset()
+
+    version, value = parsed
+    i = bisect.bisect_right(self._boundaries[version], value) - 1
+    return self._segments[version][i] if i >= 0 else frozenset()
+
+  def lookup_many(self, addresses):
+    """
+    Return a dict of address => frozenset of the IDs of the IP Lists that contain it
+
+    Duplicate addresses are only resolved once and the unique addresses are
+    resolved in sorted order so each binary search starts where the last one
+    finished
+    """
+    results = {}
+    parsed = { 4: [], 6: [] }
+    for address in set(addresses):
+      version_and_value = _parse_address(address)
+      if version_and_value:
+        parsed[version_and_value[0]].append((version_and_value[1], address))
+      else:
+        results[address] = frozenset()
+
+    for version, values in parsed.items():
+      boundaries = self._boundaries[version]
+      segments = self._segments[version]
+      lo = 0
+      for value, address in sorted(values):
+        lo = bisect.bisect_right(boundaries, value, lo)
+        results[address] = segments[lo - 1] if lo > 0 else frozenset()
+
+    return results
+
+def _parse_ipv4(address):
+  """
+  Convert a dotted quad IPv4 address to an integer
+  """
+  octets = address.split('.')
+  if len(octets) != 4: return None
+
+  value = 0
+  for octet in octets:
+    if not octet.isdigit() or int(octet) > 255: return None
+    value = (value << 8) | int(octet)
+
+  return value
+
+def _parse_ipv6(address):
+  """
+  Convert an IPv6 address (including :: compression and an embedded IPv4 
+  tail) to an integer
+  """
+  if address.count('::') > 1: return None
+
+  head, compressed, tail = address.partition('::')
+  head = head.split(':') if head else []
+  tail = tail.split(':') if tail else []
+
+  # an embedded IPv4 address counts as two groups
+  groups = head + tail
+  if groups and '.' in groups[-1]:
+    ipv4 = _parse_ipv4(groups[-1])
+    if ipv4 is None: return None
+    embedded = ['{:x}'.format(ipv4 >> 16), '{:x}'.format(ipv4 & 0xffff)]
+    if tail: tail = tail[:-1] + embedded
+    else: head = head[:-1] + embedded
+
+  missing = 8 - len(head) - len(tail)
+  if (compressed and missing < 1) or (not compressed and missing != 0): return None
+
+  value = 0
+  for group in head + ['0'] * missing + tail:
+    if not group or len(group) > 4: return None
+    try:
+      value = (value << 16) | int(group, 16)
+    except ValueError:
+      return None
+
+  return value
+
+def _parse_address(address):
+  """
+  Convert an IP address string to a tuple of (IP version, integer value)
+
+  Returns None if the address can't be parsed
+  """
+  if not type(address) in [type(''), type(u'')]: return None
+  address = address.strip()
+  if ':' in address:
+    value = _parse_ipv6(address.split('%')[0]) # drop any zone index
+    return (6, value) if value is not None else None
+  else:
+    value = _parse_ipv4(address)
+    return (4, value) if value is not None else None
+
+def _parse_ip_list_entry(entry):
+  """
+  Convert a single IP List entry to a tuple of (IP version, first address, last address)
+
+  Supports single addresses, CIDR blocks (10.0.0.0/8 or 10.0.0.0/255.0.0.0)
+  and ranges (10.0.0.1-10.0.0.50) for both IPv4 and IPv6. Returns None if the 
+  entry can't be parsed or its netmask isn't contiguous
+  """
+  entry = entry.split('#')[0].strip() # drop any comment
+  if not entry: return None
+
+  if '-' in entry:
+    first, last = [ _parse_address(address) for address in entry.split('-', 1) ]
+    if not first or not last or first[0] != last[0] or first[1] > last[1]: return None
+    return (first[0], first[1], last[1])
+  elif '/' in entry:
+    address, mask = entry.split('/', 1)
+    parsed = _parse_address(address)
+    if not parsed: return None
+    version, value = parsed
+    bits = 32 if version == 4 else 128
+    if mask.strip().isdigit():
+      prefix_length = int(mask)
+    else:
+      # IPv4 dotted netmask
+      netmask = _parse_ipv4(mask.strip()) if version == 4 else None
+      if netmask is None: return None
+      host_bits = ~netmask & 0xffffffff
+      if host_bits & (host_bits + 1): return None # not contiguous (e.g., 255.0.255.0)
+      prefix_length = 32 - bin(host_bits).count('1')
+    if prefix_length > bits: return None
+    host_mask = (1 << (bits - prefix_length)) - 1
+    return (version, value & ~host_mask, value | host_mask)
+  else:
+    parsed = _parse_address(entry)
+    if not parsed: return None
+    return (parsed[0], parsed[1], parsed[1])
+
 class IPList(core.CoreObject):
   def __init__(self, manager=None, api_response=None, log_func=None):
     self.manager = manager
     self.addresses = []
+    self.ranges = []
     if api_response: self._set_properties(api_response, log_func)
     self._split_items()
+    self._parse_ranges(log_func)
 
   def _split_items(self):
     """
@@ -317,4 +543,29 @@ class IPList(core.CoreObject):
     if getattr(self, 'items') and "\n" in self.items:
       self.addresses = self.items.split('\n')
     else:
-      self.addresses.append(self.items.strip())
\ No newline at end of file
+      self.addresses.append(self.items.strip())
+
+  def _parse_ranges(self, log_func=None):
+    """
+    Parse the individual entries in an IP List into (IP version, first address, last address) ranges
+    """
+    for address in self.addresses:
+      if not address or not address.split('#')[0].strip(): continue
+      parsed = _parse_ip_list_entry(address)
+      if parsed:
+        self.ranges.append(parsed)
+      elif log_func:
+        log_func("Could not parse entry [{}] in IP List {}".format(address, getattr(self, 'id', None)), level='debug')
+
+  def contains(self, address):
+    """
+    Does this IP List contain the specified address?
+    """
+    parsed = _parse_address(address)
+    if not parsed: return False
+
+    version, value = parsed
+    for range_version, first, last in self.ranges:
+      if range_version == version and first <= value <= last: return True
+
+    return False
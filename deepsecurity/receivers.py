@@ -0,0 +1,429 @@
+# standard library
+import collections
+import datetime
+import re
+import socket
+import threading
+import time
+import traceback
+
+# 3rd party libraries
+
+# project libraries
+import events
+import forwarders
+
+# the CEF cat (or LEEF category) of each type of event pushed by the Manager. The
+# event types used by forwarders.SyslogForwarder are recognized as well
+EVENT_CATEGORIES = {
+  'system': 'system_events',
+  'anti-malware': 'antimalware_events',
+  'web reputation': 'webreputation_events',
+  'firewall': 'firewall_events',
+  'intrusion prevention': 'intrusionprevention_events',
+  'deep packet inspection': 'intrusionprevention_events',
+  'integrity monitor': 'integritymonitoring_events',
+  'integrity monitoring': 'integritymonitoring_events',
+  'log inspection': 'loginspection_events',
+  'application control': 'application_control_events',
+  }
+
+# the signature ID ranges of the events pushed by Agents, for events
+# without a category: (first, last, event type)
+AGENT_SIGNATURE_RANGES = [
+  (20, 21, 'firewall_events'), # firewall rule log and deny
+  (100, 7499, 'firewall_events'), # out of connection, invalid flags, etc.
+  (1000000, 1999999, 'intrusionprevention_events'),
+  (2000000, 2999999, 'integritymonitoring_events'),
+  (3000000, 3999999, 'loginspection_events'),
+  (4000000, 4999999, 'antimalware_events'),
+  (5000000, 5999999, 'webreputation_events'),
+  (6000000, 6999999, 'application_control_events'),
+  ]
+AGENT_PRODUCT = 'deep security agent'
+MIN_RULE_SIGNATURE_ID = 1000000 # signature IDs from here up are rule IDs, unique to one event type
+
+# the field the signature ID is stored in for each type of event
+SIGNATURE_FIELDS = {
+  'system_events': 'eventID',
+  'intrusionprevention_events': 'DPIRuleID',
+  'integritymonitoring_events': 'integrityRuleID',
+  'loginspection_events': 'logInspectionRuleID',
+  }
+
+# the labels of the custom string/number fields (cs1Label=Host ID, etc.) the Manager uses
+LABEL_FIELDS = {
+  'host id': 'hostID',
+  'host name': 'hostName',
+  'tenant id': 'tenantID',
+  'tenant': 'tenantName',
+  'rule id': 'ruleID',
+  'event id': 'eventID',
+  'target': 'target',
+  'description': 'description',
+  }
+
+# the CEF and LEEF keys mapped back to the API keys, other keys are used as is
+CEF_KEYS = dict([ (v, k) for k, v in forwarders.CEF_FIELDS.items() ])
+CEF_KEYS.update({ 'dvc': 'hostIP', 'msg': 'description' })
+LEEF_KEYS = dict([ (v, k) for k, v in forwarders.LEEF_FIELDS.items() ])
+
+_CEF_KEY = re.compile(r'(?:^|(?<=\s))([\w.\[\]-]+)=')
+_CEF_ESCAPE = re.compile(r'\\(.)')
+_CUSTOM_FIELD = re.compile(r'^(cs|cn|cfp|flex\w*)\d+$')
+_OCTET_COUNT = re.compile(r'(\d+) ')
+
+def _split_header(message, count):
+  """
+  Split the first count fields of a pipe delimited header, honouring \| and
+  \\ escapes. Returns the fields and the remainder of the message
+  """
+  parts = message.split('|', count)
+  if len(parts) > count and not '\\' in message[:len(message) - len(parts[-1])]: return parts[:count], parts[count]
+
+  # slow path for headers with escapes
+  fields = []
+  current = []
+  i = 0
+  while i < len(message) and len(fields) < count:
+    c = message[i]
+    if c == '\\' and i + 1 < len(message) and message[i + 1] in '|\\':
+      current.append(message[i + 1])
+      i += 2
+      continue
+    if c == '|':
+      fields.append(''.join(current))
+      current = []
+    else:
+      current.append(c)
+    i += 1
+
+  if len(fields) < count: return None, None
+  return fields, message[i:]
+
+def _unescape_cef_value(value):
+  if not '\\' in value: return value
+  return _CEF_ESCAPE.sub(lambda m: { 'n': '\n', 'r': '\r' }.get(m.group(1), m.group(1)), value)
+
+def _as_log_date(value):
+  """
+  Convert a CEF/LEEF timestamp (ms since the epoch or a formatted date) to
+  the dateTime format used by the SOAP API
+  """
+  if re.search(r'^\d+$', value):
+    dt = datetime.datetime.utcfromtimestamp(long(value) / 1000.0)
+  else:
+    for fmt in ['%b %d %Y %H:%M:%S', '%b %d %H:%M:%S', '%Y-%m-%dT%H:%M:%S']:
+      try:
+        dt = datetime.datetime.strptime(value[:len(time.strftime(fmt))], fmt)
+        if dt.year == 1900: dt = dt.replace(year=datetime.datetime.utcnow().year)
+        break
+      except ValueError:
+        dt = None
+    if not dt: return value
+  return '{}.{:03d}Z'.format(dt.strftime('%Y-%m-%dT%H:%M:%S'), dt.microsecond // 1000)
+
+def _get_event_type(category, product, signature=None):
+  """
+  Get the event type from the category or, for events without one, the
+  product and signature ID. Rule IDs identify the type of an Agent event
+  on their own, lower signature IDs only when the product is the Agent
+  """
+  if category:
+    category = category.strip()
+    if category in EVENT_CATEGORIES.values(): return category
+    event_type = EVENT_CATEGORIES.get(category.lower())
+    if event_type: return event_type
+  product = product.strip().lower() if product else ''
+  if 'manager' in product: return 'system_events'
+  if signature and re.search(r'^\d+$', signature.strip()):
+    signature_id = long(signature)
+    if product == AGENT_PRODUCT or signature_id >= MIN_RULE_SIGNATURE_ID:
+      for first, last, event_type in AGENT_SIGNATURE_RANGES:
+        if first <= signature_id <= last: return event_type
+  return None
+
+def _apply_labels(event):
+  """
+  Replace CEF custom fields (cs1=x cs1Label=Host ID) with named fields
+  """
+  for key in [ k for k in event.keys() if _CUSTOM_FIELD.search(k) ]:
+    label = event.pop('{}Label'.format(key), None)
+    if label is None: continue
+    field = LABEL_FIELDS.get(label.strip().lower(), re.sub(r'\W', '', label))
+    event[field] = event.pop(key)
+
+def parse_cef(message):
+  """
+  Parse a CEF message (with or without its syslog header) into
+  (event type, event dict of API keypairs). Returns (None, None) if the
+  message isn't CEF
+  """
+  start = message.find('CEF:')
+  if start < 0: return None, None
+
+  header, extension = _split_header(message[start + 4:], 7)
+  if not header: return None, None
+  version, vendor, product, product_version, signature, name, severity = header
+
+  event = {}
+  keys = list(_CEF_KEY.finditer(extension))
+  for i, m in enumerate(keys):
+    end = keys[i + 1].start() if i + 1 < len(keys) else len(extension)
+    event[CEF_KEYS.get(m.group(1), m.group(1))] = _unescape_cef_value(extension[m.end():end].rstrip())
+  if 'Label=' in extension: _apply_labels(event)
+
+  event_type = _get_event_type(event.pop('cat', None), product, signature)
+  return event_type, _finish_event(event, event_type, signature, name, severity)
+
+def parse_leef(message):
+  """
+  Parse a LEEF 1.0 message (with or without its syslog header) into
+  (event type, event dict of API keypairs). Returns (None, None) if the
+  message isn't LEEF
+  """
+  start = message.find('LEEF:')
+  if start < 0: return None, None
+
+  header, attributes = _split_header(message[start + 5:], 5)
+  if not header: return None, None
+  version, vendor, product, product_version, signature = header
+
+  event = {}
+  for attribute in attributes.split('\t'):
+    if '=' in attribute:
+      k, v = attribute.split('=', 1)
+      event[LEEF_KEYS.get(k, k)] = v
+
+  event_type = _get_event_type(event.pop('cat', None), product, signature)
+  return event_type, _finish_event(event, event_type, signature, None, event.pop('sev', None))
+
+def _finish_event(event, event_type, signature, name, severity):
+  if event.has_key('logDate'): event['logDate'] = _as_log_date(event['logDate'])
+  signature_field = SIGNATURE_FIELDS.get(event_type)
+  if signature_field and not event.has_key(signature_field) and re.search(r'^\d+$', signature or ''): event[signature_field] = signature
+  if name and not event.has_key('reason') and name != event_type: event['reason'] = name
+  if severity is not None and not event.has_key('rank') and not event.has_key('severity'): event['severity'] = severity
+  return event
+
+def parse_message(message):
+  """
+  Parse a syslog message holding a CEF or LEEF event. Returns
+  (event type, event dict) or (None, None)
+  """
+  if isinstance(message, str): message = message.decode('utf-8', 'replace')
+  message = message.strip()
+  if 'CEF:' in message: return parse_cef(message)
+  return parse_leef(message)
+
+class SyslogReceiver(object):
+  """
+  Receive events pushed by the Manager as syslog
+
+  Listens for CEF or LEEF messages over UDP and/or TCP (newline or octet
+  counting framing). Each message is parsed into an event dict with the
+  same API keys as the events retrieved by the events collections (e.g.,
+  hostName, sourceIP, DPIRuleID, logDate) and its event type (e.g.,
+  'firewall_events')
+
+  Parsed events are handed to handler(event_type, events) in batches of up
+  to batch_size, at least every batch_interval seconds. The handler has
+  the same signature as the handlers for Manager.collect_events() so the
+  same sinks, forwarders and enrichers can be used. If objects is True,
+  the events are passed as event objects instead of dicts
+
+  If the handler falls behind, up to max_queue events are held before new
+  events are dropped. Counters for the messages received, parsed, failed
+  and dropped are in .stats
+  """
+  def __init__(self, handler, host='0.0.0.0', udp_port=514, tcp_port=None, batch_size=500, batch_interval=1.0, max_queue=100000, objects=False, log_func=None):
+    self.handler = handler
+    self.host = host
+    self.udp_port = udp_port
+    self.tcp_port = tcp_port
+    self.batch_size = max(1, batch_size)
+    self.batch_interval = batch_interval
+    self.max_queue = max(1, max_queue)
+    self.objects = objects
+    self.log = log_func if log_func else lambda *args, **kwargs: None
+
+    self.stats = {
+      'received': 0,
+      'parsed': 0,
+      'failed': 0,
+      'dropped': 0,
+      'delivered': 0,
+      'bytes': 0,
+      'started': None,
+      }
+
+    self._queue = collections.deque()
+    self._condition = threading.Condition()
+    self._stopped = threading.Event()
+    self._sockets = []
+    self._threads = []
+
+  def __enter__(self): return self.start()
+
+  def __exit__(self, *args): self.stop()
+
+  @property
+  def messages_per_second(self):
+    seconds = time.time() - self.stats['started'] if self.stats['started'] else 0
+    return self.stats['parsed'] / seconds if seconds > 0 else 0.0
+
+  @property
+  def addresses(self):
+    """
+    The (protocol, host, port) each listener is bound to. Useful when
+    listening on port 0
+    """
+    return [ ('UDP' if sock.type == socket.SOCK_DGRAM else 'TCP',) + sock.getsockname()[:2] for sock in self._sockets ]
+
+  def _start_thread(self, target, *args):
+    thread = threading.Thread(target=target, args=args)
+    thread.daemon = True
+    thread.start()
+    self._threads.append(thread)
+
+  def start(self):
+    """
+    Start listening
+    """
+    self._stopped.clear()
+    self.stats['started'] = time.time()
+    if self.udp_port is not None:
+      sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+      sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+      sock.bind((self.host, self.udp_port))
+      sock.settimeout(0.5)
+      self._sockets.append(sock)
+      self._start_thread(self._listen_udp, sock)
+    if self.tcp_port is not None:
+      sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+      sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+      sock.bind((self.host, self.tcp_port))
+      sock.listen(32)
+      sock.settimeout(0.5)
+      self._sockets.append(sock)
+      self._start_thread(self._listen_tcp, sock)
+    self._start_thread(self._dispatch)
+
+    return self
+
+  def stop(self):
+    """
+    Stop listening and deliver the events already received
+    """
+    self._stopped.set()
+    with self._condition: self._condition.notify_all()
+    for thread in self._threads: thread.join()
+    self._threads = []
+    for sock in self._sockets: sock.close()
+    self._sockets = []
+
+  def _receive(self, messages):
+    # messages are received on several threads so the counters are only
+    # updated under the condition's lock
+    parsed = []
+    received_bytes = 0
+    failed = 0
+    for message in messages:
+      received_bytes += len(message)
+      try:
+        event_type, event = parse_message(message)
+      except Exception:
+        event_type, event = None, None
+      if event is None:
+        failed += 1
+        continue
+      parsed.append((event_type, event))
+
+    with self._condition:
+      self.stats['received'] += len(messages)
+      self.stats['bytes'] += received_bytes
+      self.stats['failed'] += failed
+      room = self.max_queue - len(self._queue)
+      if len(parsed) > room:
+        self.stats['dropped'] += len(parsed) - max(room, 0)
+        parsed = parsed[:max(room, 0)]
+      self.stats['parsed'] += len(parsed)
+      self._queue.extend(parsed)
+      if len(self._queue) >= self.batch_size: self._condition.notify_all()
+
+  def _listen_udp(self, sock):
+    while not self._stopped.is_set():
+      try:
+        data = sock.recv(65535)
+      except socket.timeout:
+        continue
+      except socket.error:
+        if not self._stopped.is_set(): self.log("UDP syslog listener failed", err=traceback.format_exc())
+        return
+      self._receive([ line for line in data.split('\n') if line.strip() ])
+
+  def _listen_tcp(self, sock):
+    while not self._stopped.is_set():
+      try:
+        connection, address = sock.accept()
+      except socket.timeout:
+        continue
+      except socket.error:
+        if not self._stopped.is_set(): self.log("TCP syslog listener failed", err=traceback.format_exc())
+        return
+      self._start_thread(self._read_connection, connection)
+
+  def _read_connection(self, connection):
+    """
+    Read messages from a TCP stream, handling both octet counting
+    (RFC 6587) and newline framing
+    """
+    connection.settimeout(0.5)
+    buf = ''
+    try:
+      while not self._stopped.is_set():
+        try:
+          data = connection.recv(256 * 1024)
+        except socket.timeout:
+          continue
+        if not data: break
+        buf += data
+
+        messages = []
+        position = 0
+        while position < len(buf):
+          m = _OCTET_COUNT.match(buf, position)
+          if m:
+            end = m.end() + int(m.group(1))
+            if len(buf) < end: break
+            messages.append(buf[m.end():end])
+            position = end
+          else:
+            end = buf.find('\n', position)
+            if end < 0: break
+            messages.append(buf[position:end])
+            position = end + 1
+        buf = buf[position:]
+        if messages: self._receive([ message for message in messages if message.strip() ])
+      if buf.strip(): self._receive([buf])
+    finally:
+      connection.close()
+
+  def _dispatch(self):
+    while True:
+      with self._condition:
+        deadline = time.time() + self.batch_interval
+        while len(self._queue) < self.batch_size and not self._stopped.is_set() and time.time() < deadline:
+          self._condition.wait(max(0.01, deadline - time.time()))
+        batch = [ self._queue.popleft() for i in range(min(self.batch_size, len(self._queue))) ]
+        if not batch and self._stopped.is_set(): return
+
+      by_type = collections.OrderedDict()
+      for event_type, event in batch: by_type.setdefault(event_type, []).append(event)
+      for event_type, items in by_type.items():
+        if self.objects: items = [ events._Event(event, self.log) for event in items ]
+        try:
+          self.handler(event_type, items)
+          with self._condition: self.stats['delivered'] += len(items)
+        except Exception:
+          self.log("Syslog event handler failed for {} {}".format(len(items), event_type), err=traceback.format_exc())
@@ -0,0 +1,226 @@
+# standard library
+import array
+import json
+import os
+import time
+import traceback
+
+# 3rd party libraries
+
+# project libraries
+import core
+
+class RuleRecommendations(object):
+  """
+  A sparse computer x rule matrix of recommended rules
+
+  Each unique (rule type, rule ID) pair is stored once and assigned a column
+  number. Each computer's row is a compact array of the column numbers of the
+  rules recommended for it
+  """
+  def __init__(self, rule_keys=None):
+    self.rule_keys = set(rule_keys) if rule_keys else set()
+    self.columns = [] # (rule_key, rule_id) for each column
+    self.rows = {} # computer_id => array of column numbers
+    self.completed = set() # (computer_id, rule_key) pairs that have been retrieved
+    self.failed = set() # (computer_id, rule_key) pairs that could not be retrieved
+    self._column_numbers = {}
+
+  def __len__(self): return len(self.rows)
+
+  @property
+  def total(self): return sum([ len(row) for row in self.rows.values() ])
+
+  def add(self, computer_id, rule_key, rule_ids):
+    """
+    Add the recommended rules of one type for the specified computer
+    """
+    self.rule_keys.add(rule_key)
+    row = self.rows.setdefault(computer_id, array.array('l'))
+    for rule_id in rule_ids:
+      column = self._column_numbers.get((rule_key, rule_id))
+      if column is None:
+        column = len(self.columns)
+        self.columns.append((rule_key, rule_id))
+        self._column_numbers[(rule_key, rule_id)] = column
+      row.append(column)
+
+    self.completed.add((computer_id, rule_key))
+    self.failed.discard((computer_id, rule_key))
+
+  def get_rules_for_computer(self, computer_id):
+    """
+    Get the recommended rules for the specified computer in the same format
+    as Manager.get_rule_recommendations_for_computer()
+    """
+    results = { 'total_recommedations': 0 }
+    for rule_key in self.rule_keys: results[rule_key] = []
+
+    for column in self.rows.get(computer_id, []):
+      rule_key, rule_id = self.columns[column]
+      results[rule_key].append(rule_id)
+      results['total_recommedations'] += 1
+
+    return results
+
+  def get_computers_for_rule(self, rule_key, rule_id):
+    """
+    Get the IDs of the computers the specified rule is recommended for
+    """
+    column = self._column_numbers.get((rule_key, rule_id))
+    if column is None: return []
+
+    return [ computer_id for computer_id, row in self.rows.items() if column in row ]
+
+  def get_rule_counts(self):
+    """
+    Get the number of computers each rule is recommended for as a dict of
+    (rule_key, rule_id) => count
+    """
+    counts = [0] * len(self.columns)
+    for row in self.rows.values():
+      for column in row: counts[column] += 1
+
+    return dict(zip(self.columns, counts))
+
+  def retain(self, computer_ids):
+    """
+    Drop the computers that aren't in computer_ids and any rules that are 
+    no longer recommended for one of the computers kept
+    """
+    computer_ids = set(computer_ids)
+    rows = dict([ (computer_id, row) for computer_id, row in self.rows.items() if computer_id in computer_ids ])
+    used = sorted(set([ column for row in rows.values() for column in row ]))
+    renumbered = dict([ (column, i) for i, column in enumerate(used) ])
+
+    self.columns = [ self.columns[column] for column in used ]
+    self._column_numbers = dict([ (rule, i) for i, rule in enumerate(self.columns) ])
+    self.rows = dict([ (computer_id, array.array('l', [ renumbered[column] for column in row ])) for computer_id, row in rows.items() ])
+    self.completed = set([ pair for pair in self.completed if pair[0] in computer_ids ])
+    self.failed = set([ pair for pair in self.failed if pair[0] in computer_ids ])
+
+  def to_dict(self):
+    """
+    Convert the matrix to a dict that can be serialized as JSON
+    """
+    return {
+      'rule_keys': sorted(self.rule_keys),
+      'columns': self.columns,
+      'rows': [ [computer_id, row.tolist()] for computer_id, row in self.rows.items() ],
+      'completed': [ list(pair) for pair in self.completed ],
+      'failed': [ list(pair) for pair in self.failed ],
+      }
+
+  @classmethod
+  def from_dict(self, d):
+    """
+    Create a matrix from the output of .to_dict()
+    """
+    result = RuleRecommendations(rule_keys=d.get('rule_keys'))
+    for rule_key, rule_id in d.get('columns', []):
+      result._column_numbers[(rule_key, rule_id)] = len(result.columns)
+      result.columns.append((rule_key, rule_id))
+    for computer_id, row in d.get('rows', []):
+      result.rows[computer_id] = array.array('l', row)
+    for computer_id, rule_key in d.get('completed', []):
+      result.completed.add((computer_id, rule_key))
+    for computer_id, rule_key in d.get('failed', []):
+      result.failed.add((computer_id, rule_key))
+
+    return result
+
+  def save(self, path):
+    """
+    Save the matrix to the specified path
+    """
+    d = self.to_dict()
+    core._atomic_write(path, lambda fh: json.dump(d, fh))
+
+  @classmethod
+  def load(self, path):
+    """
+    Load a matrix previously saved to the specified path
+    """
+    with open(path, 'r') as fh:
+      return RuleRecommendations.from_dict(json.load(fh))
+
+class RuleRecommendationHarvester(object):
+  """
+  Retrieve the recommended rules for a fleet of computers
+
+  Every computer needs one hostRecommendationRuleIDsRetrieve call per rule
+  type. Those calls are run through a bounded pool of workers and the results
+  are collected into a shared RuleRecommendations matrix. If a state_path is
+  specified, the matrix is saved as work completes so an interrupted harvest
+  can be resumed
+  """
+  def __init__(self, manager, max_workers=8, state_path=None, progress_callback=None, checkpoint_every=250):
+    self.manager = manager
+    self.log = self.manager.log if self.manager else None
+    self.max_workers = max_workers
+    self.state_path = state_path
+    self.progress_callback = progress_callback
+    self.checkpoint_every = checkpoint_every
+    self._pool = None
+
+  def cancel(self):
+    """
+    Stop the current harvest once the calls in flight complete
+    """
+    if self._pool: self._pool.cancel()
+
+  def harvest(self, computer_ids):
+    """
+    Get the recommended rules for the specified computers
+
+    When resuming from the state_path, the calls that failed are retried and
+    only the computers requested are kept
+
+    Returns a RuleRecommendations matrix
+    """
+    if not type(computer_ids) == type([]): computer_ids = list(computer_ids) if hasattr(computer_ids, '__iter__') else [computer_ids]
+    rule_types = self.manager._get_rule_recommendation_types()
+
+    recommendations = None
+    if self.state_path and os.path.exists(self.state_path):
+      try:
+        recommendations = RuleRecommendations.load(self.state_path)
+        recommendations.retain(computer_ids)
+        self.log("Resuming rule recommendations from [{}] with {} calls already complete and {} failed".format(self.state_path, len(recommendations.completed), len(recommendations.failed)))
+      except Exception:
+        self.log("Could not load the previous rule recommendation state from [{}]".format(self.state_path), err=traceback.format_exc())
+    if not recommendations: recommendations = RuleRecommendations()
+    recommendations.rule_keys.update(rule_types.keys())
+
+    work = []
+    for computer_id in computer_ids:
+      for rule_key in sorted(rule_types.keys()):
+        if not (computer_id, rule_key) in recommendations.completed: work.append((computer_id, rule_key))
+
+    progress = { 'completed': 0, 'total': len(work), 'started': time.time() }
+    self.log("Requesting rule recommendations for {} computers ({} calls)".format(len(computer_ids), len(work)))
+
+    def retrieve(work_item):
+      computer_id, rule_key = work_item
+      return self.manager._get_rule_recommendation_ids(computer_id, rule_types[rule_key])
+
+    def on_complete(work_item, rule_ids, err):
+      computer_id, rule_key = work_item
+      if rule_ids is None:
+        recommendations.failed.add(work_item)
+      else:
+        recommendations.add(computer_id, rule_key, rule_ids)
+
+      progress['completed'] += 1
+      if self.progress_callback: self.progress_callback(progress['completed'], progress['total'])
+      if progress['completed'] % self.checkpoint_every == 0:
+        self.log("Completed {} of {} rule recommendation calls".format(progress['completed'], progress['total']))
+        if self.state_path: recommendations.save(self.state_path)
+
+    self._pool = core.CoreWorkerPool(max_workers=self.max_workers, log_func=self.log)
+    self._pool.map(retrieve, work, callback=on_complete)
+
+    if self.state_path: recommendations.save(self.state_path)
+    self.log("Retrieved {} rule recommendations across {} computers in {:.1f}s ({} calls failed)".format(recommendations.total, len(recommendations), time.time() - progress['started'], len(recommendations.failed)))
+
+    return recommendations
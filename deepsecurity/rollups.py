@@ -0,0 +1,226 @@
+# standard library
+import heapq
+import json
+import threading
+
+# 3rd party libraries
+
+# project libraries
+import core
+import events
+
+GRANULARITIES = {
+  'minute': 60 * 1000,
+  'hour': 60 * 60 * 1000,
+  'day': 24 * 60 * 60 * 1000,
+  }
+
+# the fields that identify the rule behind an event, in order of preference
+RULE_FIELDS = ['DPIRuleID', 'firewallRuleID', 'integrityRuleID', 'logInspectionRuleID', 'malwareName', 'reason']
+
+def get_event_rule(event):
+  """
+  Get the ID (or name) of the rule behind an event
+  """
+  return events._get_event_value(event, RULE_FIELDS)
+
+DEFAULT_DIMENSIONS = {
+  'host': events.get_event_host,
+  'rule': get_event_rule,
+  }
+
+def _merge_stats(stats, count, first, last):
+  """
+  Combine [count, first seen, last seen] stats in place
+  """
+  stats[0] += count
+  if first is not None and (stats[1] is None or first < stats[1]): stats[1] = first
+  if last is not None and (stats[2] is None or last > stats[2]): stats[2] = last
+
+class EventRollup(object):
+  """
+  Incrementally maintained event counts by time bucket
+
+  For each event type and granularity (e.g., 'hour' and 'day'), events are
+  counted into time buckets. Each bucket keeps the total count, first and
+  last seen times and the same stats per value of each dimension (by
+  default, the host and the rule behind the event)
+
+  Events can be added as they stream in from the event collections,
+  .iterate(), a SyslogReceiver or Manager.collect_events() (pass .handler).
+  Queries only touch the buckets in range, not the events. Rollups built by
+  separate workers can be combined with .merge()
+
+  dimensions is a dict of name => callable(event) returning the value to
+  count the event under (or None to skip it)
+  """
+  def __init__(self, granularities=None, dimensions=None):
+    self.granularities = list(granularities) if granularities else ['hour', 'day']
+    for granularity in self.granularities:
+      if not GRANULARITIES.has_key(granularity): raise ValueError("Invalid granularity [{}]. Must be one of {}".format(granularity, sorted(GRANULARITIES.keys())))
+    self.dimensions = dimensions if dimensions is not None else dict(DEFAULT_DIMENSIONS)
+    self.buckets = {} # (event type, granularity, bucket start) => { 'stats': [count, first, last], dimension => { value => [count, first, last] } }
+    self.skipped = 0 # events without a time
+    self._lock = threading.Lock()
+
+  def __len__(self): return len(self.buckets)
+
+  def add(self, event_type, event):
+    """
+    Add a single event
+    """
+    self.add_many(event_type, [event])
+
+  def add_many(self, event_type, events_to_add):
+    """
+    Add a stream of events of the same type. Returns the number added
+    """
+    count = 0
+    with self._lock:
+      for event in events_to_add:
+        event_time = events.get_event_time(event)
+        if event_time is None:
+          self.skipped += 1
+          continue
+        values = [ (name, func(event)) for name, func in self.dimensions.items() ]
+        for granularity in self.granularities:
+          size = GRANULARITIES[granularity]
+          key = (event_type, granularity, event_time - event_time % size)
+          bucket = self.buckets.get(key)
+          if bucket is None:
+            bucket = self.buckets[key] = { 'stats': [0, None, None] }
+          _merge_stats(bucket['stats'], 1, event_time, event_time)
+          for name, value in values:
+            if value is None: continue
+            stats = bucket.setdefault(name, {}).get(value)
+            if stats is None:
+              bucket[name][value] = [1, event_time, event_time]
+            else:
+              _merge_stats(stats, 1, event_time, event_time)
+        count += 1
+
+    return count
+
+  def handler(self, event_type, events_to_add):
+    """
+    Add events as they're retrieved. Can be passed as a handler to
+    Manager.collect_events()
+    """
+    return self.add_many(event_type, events_to_add)
+
+  def _get_buckets(self, event_type=None, granularity='hour', start=None, end=None):
+    start = events.get_event_time({ 'time': start }) if start is not None else None
+    end = events.get_event_time({ 'time': end }) if end is not None else None
+    for (bucket_type, bucket_granularity, bucket_start), bucket in self.buckets.items():
+      if bucket_granularity != granularity: continue
+      if event_type is not None and bucket_type != event_type: continue
+      if start is not None and bucket_start + GRANULARITIES[granularity] <= start: continue
+      if end is not None and bucket_start > end: continue
+      yield (bucket_type, bucket_start), bucket
+
+  def get_series(self, event_type=None, granularity='hour', start=None, end=None, dimension=None, value=None):
+    """
+    Get the stats for each bucket in the time range
+
+    If dimension and value are specified, only events with that value
+    (e.g., dimension='host', value=42) are counted. Buckets overlapping
+    start or end are included in full
+
+    Returns a sorted list of (bucket start in ms, count, first seen, last
+    seen). Event types are combined unless event_type is specified
+    """
+    series = {}
+    for (bucket_type, bucket_start), bucket in self._get_buckets(event_type, granularity, start, end):
+      stats = bucket['stats'] if dimension is None else bucket.get(dimension, {}).get(value)
+      if stats: _merge_stats(series.setdefault(bucket_start, [0, None, None]), *stats)
+
+    return [ (bucket_start,) + tuple(series[bucket_start]) for bucket_start in sorted(series.keys()) ]
+
+  def get_counts(self, dimension, event_type=None, granularity='hour', start=None, end=None):
+    """
+    Get the stats of each value of a dimension across the time range as a
+    dict of value => (count, first seen, last seen)
+    """
+    totals = {}
+    for key, bucket in self._get_buckets(event_type, granularity, start, end):
+      for value, stats in bucket.get(dimension, {}).items():
+        _merge_stats(totals.setdefault(value, [0, None, None]), *stats)
+
+    return dict([ (value, tuple(stats)) for value, stats in totals.items() ])
+
+  def top(self, dimension, n=10, event_type=None, granularity='hour', start=None, end=None):
+    """
+    Get the n values of a dimension with the most events in the time range
+    as a list of (value, count, first seen, last seen)
+    """
+    counts = self.get_counts(dimension, event_type=event_type, granularity=granularity, start=start, end=end)
+    return [ (value,) + stats for value, stats in heapq.nlargest(n, counts.items(), key=lambda item: item[1][0]) ]
+
+  def expire(self, before, granularity=None):
+    """
+    Drop the buckets that end before the specified time. Returns the number
+    of buckets dropped
+    """
+    before = events.get_event_time({ 'time': before })
+    with self._lock:
+      expired = [ key for key in self.buckets.keys() if (granularity is None or key[1] == granularity) and key[2] + GRANULARITIES[key[1]] <= before ]
+      for key in expired: del(self.buckets[key])
+
+    return len(expired)
+
+  def merge(self, other):
+    """
+    Add the counts from another rollup (e.g., one built by another worker)
+    """
+    with self._lock:
+      for key, other_bucket in other.buckets.items():
+        bucket = self.buckets.setdefault(key, { 'stats': [0, None, None] })
+        for name, stats in other_bucket.items():
+          if name == 'stats':
+            _merge_stats(bucket['stats'], *stats)
+            continue
+          values = bucket.setdefault(name, {})
+          for value, value_stats in stats.items():
+            _merge_stats(values.setdefault(value, [0, None, None]), *value_stats)
+      self.skipped += other.skipped
+
+    return self
+
+  def to_dict(self):
+    """
+    Convert the rollup to a dict that can be serialized as JSON
+    """
+    return {
+      'granularities': self.granularities,
+      'skipped': self.skipped,
+      'buckets': [ [list(key), dict([ (name, stats if name == 'stats' else [ [value, value_stats] for value, value_stats in stats.items() ]) for name, stats in bucket.items() ])] for key, bucket in self.buckets.items() ],
+      }
+
+  @classmethod
+  def from_dict(self, d, dimensions=None):
+    """
+    Create a rollup from the output of .to_dict()
+    """
+    result = EventRollup(granularities=d.get('granularities'), dimensions=dimensions)
+    result.skipped = d.get('skipped', 0)
+    for key, bucket in d.get('buckets', []):
+      result.buckets[tuple(key)] = dict([ (name, stats if name == 'stats' else dict([ (value, value_stats) for value, value_stats in stats ])) for name, stats in bucket.items() ])
+
+    return result
+
+  def save(self, path):
+    """
+    Save the rollup to the specified path
+    """
+    with self._lock:
+      d = self.to_dict()
+
+    core._atomic_write(path, lambda fh: json.dump(d, fh))
+
+  @classmethod
+  def load(self, path, dimensions=None):
+    """
+    Load a rollup previously saved to the specified path
+    """
+    with open(path, 'r') as fh:
+      return EventRollup.from_dict(json.load(fh), dimensions=dimensions)
@@ -0,0 +1,242 @@
+# standard library
+import csv
+import gzip
+import json
+import os
+import Queue
+import threading
+import time
+import traceback
+
+# 3rd party libraries
+
+# project libraries
+import core
+import translation
+
+def event_to_dict(event, translate=False):
+  """
+  Map an event to a dict of its fields without building an object
+
+  Gives the same fields as CoreObject.to_dict() would for the event: nil
+  values become None and keys are normalized to their API names. If
+  translate is True, the keys are the property names used on event objects
+  instead (e.g., computer_id rather than hostID). Events can be the dicts
+  yielded by a collection's .iterate() or the objects in a collection
+  """
+  if isinstance(event, core.CoreProxy): event = event.raw if not event.hydrated else event.hydrate()
+  if not isinstance(event, dict):
+    event = dict([ (k, v) for k, v in vars(event).items() if k not in ['manager', 'log'] and not k.startswith('_') ])
+
+  result = {}
+  for k, v in event.items():
+    if isinstance(v, dict) and v.get(u'@xsi:nil') == u'true': v = None
+    new_key = translation.Terms.get(k)
+    result[new_key if translate else translation.Terms.get_reverse(new_key)] = v
+
+  return result
+
+class _Sink(object):
+  """
+  Base class for the streaming event sinks
+
+  Events are mapped and serialized in batches of batch_size by a writer
+  thread. At most max_pending batches are queued for the writer; once
+  they're waiting, .write() blocks until the writer catches up so events
+  are never fetched faster than they can be written
+
+  path
+    The file to write. Can include {sequence} and {time} (the time the file
+    was opened as YYYYmmddHHMMSS) placeholders. If the sink rotates files
+    and the path has neither, -{sequence} is added before the extension
+
+  compress
+    Write gzip files. .gz is added to the path if it's not there
+
+  rotate_bytes / rotate_seconds
+    Start a new file once the current one is this size (as written to disk)
+    or this old. Checked between batches so a file can run over by up to one
+    batch
+
+  translate
+    Use the property names of event objects as field names instead of the
+    API keys
+
+  type_field
+    The field the event type is stored in when events are written through
+    .handler()
+  """
+  def __init__(self, path, compress=False, rotate_bytes=None, rotate_seconds=None, batch_size=1000, max_pending=4, translate=False, type_field='eventType', log_func=None):
+    self.compress = compress
+    self.rotate_bytes = rotate_bytes
+    self.rotate_seconds = rotate_seconds
+    self.batch_size = max(1, batch_size)
+    self.translate = translate
+    self.type_field = type_field
+    self.log = log_func if log_func else lambda *args, **kwargs: None
+    self.path = self._get_path_template(path)
+    self.files = [] # every file written, in order
+    self.written = 0
+
+    self._queue = Queue.Queue(maxsize=max(1, max_pending))
+    self._lock = threading.Lock()
+    self._thread = None
+    self._err = None
+    self._raw = None
+    self._fh = None
+    self._opened = None
+    self._sequence = 0
+
+  def __enter__(self): return self
+
+  def __exit__(self, *args): self.close()
+
+  def _get_path_template(self, path):
+    if self.compress and not path.endswith('.gz'): path = '{}.gz'.format(path)
+    if (self.rotate_bytes or self.rotate_seconds) and not '{sequence' in path and not '{time' in path:
+      base = path[:-3] if path.endswith('.gz') else path
+      base, ext = os.path.splitext(base)
+      path = '{}-{{sequence:05d}}{}{}'.format(base, ext, '.gz' if path.endswith('.gz') else '')
+    return path
+
+  def _open(self):
+    self._sequence += 1
+    self._opened = time.time()
+    path = self.path.format(sequence=self._sequence, time=time.strftime('%Y%m%d%H%M%S', time.gmtime(self._opened)))
+    self._raw = open(path, 'wb')
+    self._fh = gzip.GzipFile(fileobj=self._raw, mode='wb') if self.compress else self._raw
+    self.files.append(path)
+    self._start_file()
+
+  def _close_file(self):
+    if self._fh:
+      self._fh.close()
+      if self._raw is not self._fh: self._raw.close()
+      self._fh = self._raw = None
+
+  def _should_rotate(self):
+    if self.rotate_bytes and self._raw.tell() >= self.rotate_bytes: return True
+    if self.rotate_seconds and time.time() - self._opened >= self.rotate_seconds: return True
+    return False
+
+  def _start_file(self): pass
+
+  def _write_batch(self, records): raise NotImplementedError()
+
+  def _writer(self):
+    while True:
+      batch = self._queue.get()
+      try:
+        if batch is None: return
+        if self._err: continue # drain the queue so producers aren't blocked
+        try:
+          if self._fh and self._should_rotate(): self._close_file()
+          if not self._fh: self._open()
+          self._write_batch([ self._map(event_type, event) for event_type, event in batch ])
+          self.written += len(batch)
+        except Exception:
+          self._err = traceback.format_exc()
+          self.log("Could not write events to {}".format(self.files[-1] if self.files else self.path), err=self._err)
+      finally:
+        self._queue.task_done()
+
+  def _map(self, event_type, event):
+    record = event_to_dict(event, translate=self.translate)
+    if event_type is not None and self.type_field: record[self.type_field] = event_type
+    return record
+
+  def _check(self):
+    if self._err: raise IOError("Event sink failed: {}".format(self._err))
+
+  def _put(self, batch):
+    self._check()
+    with self._lock:
+      if not self._thread:
+        self._thread = threading.Thread(target=self._writer)
+        self._thread.daemon = True
+        self._thread.start()
+    # blocks while max_pending batches are waiting
+    self._queue.put(batch)
+
+  def write(self, events, event_type=None):
+    """
+    Write a stream of events. Returns the number of events queued
+    """
+    count = 0
+    batch = []
+    for event in events:
+      batch.append((event_type, event))
+      if len(batch) >= self.batch_size:
+        self._put(batch)
+        count += len(batch)
+        batch = []
+    if batch:
+      self._put(batch)
+      count += len(batch)
+
+    return count
+
+  def handler(self, event_type, events):
+    """
+    Write events as they're retrieved. Can be passed as a handler to
+    Manager.collect_events()
+    """
+    return self.write(events, event_type=event_type)
+
+  def flush(self):
+    """
+    Wait for the queued events to be written
+    """
+    if self._thread: self._queue.join()
+    if self._fh: self._fh.flush()
+    self._check()
+
+  def close(self):
+    """
+    Write the queued events and close the current file
+    """
+    if self._thread:
+      self._queue.put(None)
+      self._thread.join()
+      self._thread = None
+    self._close_file()
+    self._check()
+
+class JSONLinesSink(_Sink):
+  """
+  Write events as one JSON object per line
+  """
+  def _write_batch(self, records):
+    self._fh.write(''.join([ '{}\n'.format(json.dumps(record, default=str, sort_keys=True)) for record in records ]))
+
+class CSVSink(_Sink):
+  """
+  Write events as CSV
+
+  fields
+    The columns to write. Defaults to every field in the first batch of
+    events. Fields that aren't in the columns are dropped and dict or list
+    values are written as JSON. A header row starts every file
+  """
+  def __init__(self, path, fields=None, **kwargs):
+    _Sink.__init__(self, path, **kwargs)
+    self.fields = fields
+
+  def _start_file(self):
+    self._csv = None
+
+  def _format(self, value):
+    if value is None: return ''
+    if isinstance(value, unicode): return value.encode('utf-8')
+    if isinstance(value, (dict, list)): return json.dumps(value, default=str)
+    return value
+
+  def _write_batch(self, records):
+    if not self.fields:
+      fields = set()
+      for record in records: fields.update(record.keys())
+      self.fields = sorted(fields)
+    if not self._csv:
+      self._csv = csv.DictWriter(self._fh, fieldnames=self.fields, extrasaction='ignore')
+      self._csv.writeheader()
+    self._csv.writerows([ dict([ (k, self._format(v)) for k, v in record.items() ]) for record in records ])
@@ -0,0 +1,43 @@
+# standard library
+import unittest
+
+# 3rd party libraries
+
+# project libraries
+from deepsecurity import actions
+from deepsecurity import computers
+from deepsecurity import dsm
+
+class TestActionScheduler(unittest.TestCase):
+  def setUp(self):
+    self.manager = dsm.Manager(username='user', password='password')
+    for i in range(20):
+      self.manager.computers[i] = computers.Computer(None, { 'ID': str(i), 'hostGroupID': str(i % 2 if i < 18 else 5) })
+
+  def test_caps_and_priority(self):
+    scheduler = actions.ActionScheduler(self.manager, lambda computer_ids: True, range(20), rate=1000, batch_size=5, max_per_group=3, priority=lambda computer_id: -computer_id)
+    self.assertEqual(scheduler.pending[:3], [19, 18, 17])
+    self.assertEqual(scheduler._next_batch(0), [19, 18, 17, 16, 15])
+    self.assertEqual(scheduler._next_batch(1), [14, 13, 12]) # one more from group 1, two from group 0
+    self.assertEqual(scheduler._next_batch(2), [])
+    self.assertEqual(len(scheduler.pending), 12)
+    self.assertEqual(scheduler._next_batch(1000), [11, 10, 9, 8, 7])
+
+  def test_small_sets_are_spread_across_the_window(self):
+    scheduler = actions.ActionScheduler(self.manager, lambda computer_ids: True, range(5), window=3600)
+    self.assertEqual(scheduler._next_batch(0), [0])
+    self.assertEqual(scheduler._next_batch(0), [1])
+
+    scheduler = actions.ActionScheduler(self.manager, lambda computer_ids: True, range(20), rate=2.5, batch_size=10)
+    self.assertEqual(scheduler._next_batch(0), [0, 1])
+
+  def test_run(self):
+    dispatched = []
+    scheduler = actions.ActionScheduler(self.manager, lambda computer_ids: dispatched.extend(computer_ids) or True, range(20), rate=10000, batch_size=5, max_per_group=3, hold=0.01)
+    result = scheduler.run()
+    self.assertEqual(sorted(dispatched), range(20))
+    self.assertTrue(result)
+    self.assertEqual(scheduler.pending, [])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,78 @@
+# standard library
+import glob
+import os
+import shutil
+import tempfile
+import unittest
+
+# 3rd party libraries
+
+# project libraries
+from deepsecurity import archive
+
+def make_events(event_ids, hosts=3):
+  # logged in the reverse order of their IDs so the segments aren't in time order
+  return [ { 'firewallEventID': i, 'logDate': 1000 * (100 - i), 'hostID': i % hosts, 'action': 'Deny' } for i in event_ids ]
+
+class TestEventArchive(unittest.TestCase):
+  def setUp(self):
+    self.path = tempfile.mkdtemp()
+    self.archive = archive.EventArchive(self.path, max_segment_bytes=300)
+
+  def tearDown(self):
+    self.archive.close()
+    shutil.rmtree(self.path)
+
+  def query(self, **kwargs):
+    return [ event for event_type, event in self.archive.query(**kwargs) ]
+
+  def test_query_reads_the_open_segment_without_sealing_it(self):
+    single = archive.EventArchive(self.path) # one large segment
+    single.append('firewall_events', make_events(range(1, 11)))
+    self.assertEqual(len([ event for event_type, event in single.query() ]), 10)
+    self.assertTrue(single._active.has_key('firewall_events'))
+    self.assertEqual(single.segments(), [])
+
+    single.append('firewall_events', make_events(range(11, 16)))
+    self.assertEqual(len([ event for event_type, event in single.query(hosts=[1]) ]), 5)
+    single.close()
+
+  def test_query_by_time(self):
+    self.archive.append('firewall_events', make_events(range(1, 41)))
+    events = self.query(start=1000 * 90, end=1000 * 95)
+    self.assertEqual(sorted([ event['firewallEventID'] for event in events ]), range(5, 11))
+
+  def test_compact_merges_in_time_order_and_drops_duplicates(self):
+    self.archive.append('firewall_events', make_events(range(1, 40)))
+    self.archive.append('firewall_events', make_events(range(1, 11))) # archived again
+    self.archive.close()
+    segments = len(self.archive.segments())
+    self.assertTrue(segments > 2)
+
+    self.assertEqual(self.archive.compact(), segments)
+    events = self.query()
+    self.assertEqual(sorted([ event['firewallEventID'] for event in events ]), range(1, 40))
+    times = [ event['logDate'] for event in events ]
+    self.assertEqual(times, sorted(times))
+    self.assertEqual(glob.glob(os.path.join(self.path, '*.tmp')), [])
+
+    # the compacted segments are in time order and can be reloaded
+    reloaded = archive.EventArchive(self.path)
+    self.assertTrue(all([ segment['sorted'] for segment in reloaded.segments() ]))
+    self.assertEqual(len([ event for event_type, event in reloaded.query(start=1000 * 90) ]), 10)
+
+  def test_compact_drops_events_before_retain_after(self):
+    self.archive.append('firewall_events', make_events(range(1, 21)))
+    self.archive.close()
+    self.archive.compact(retain_after=1000 * 90)
+    self.assertEqual(sorted([ event['firewallEventID'] for event in self.query() ]), range(1, 11))
+
+  def test_compact_keeps_events_with_the_same_time_and_different_ids(self):
+    self.archive.append('firewall_events', [ { 'firewallEventID': i, 'logDate': 5000 } for i in range(1, 31) ])
+    self.archive.append('firewall_events', [ { 'firewallEventID': i, 'logDate': 5000 } for i in range(20, 31) ])
+    self.archive.close()
+    self.archive.compact()
+    self.assertEqual(sorted([ event['firewallEventID'] for event in self.query() ]), range(1, 31))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,245 @@
+# standard library
+import threading
+import unittest
+
+# 3rd party libraries
+
+# project libraries
+from deepsecurity import computers
+from deepsecurity import core
+from deepsecurity import dsm
+
+NIL = { '@xsi:nil': 'true' }
+
+class FakeManager(object):
+  """
+  Answers hostDetailRetrieve calls for ten computers in two computer groups.
+  LOW detail leaves the platform empty, as the Manager does
+  """
+  def __init__(self, missing=None, count=10):
+    self.calls = []
+    self.missing = missing or []
+    self.count = count
+    self.statuses = {}
+
+  def computer(self, computer_id, detail_level):
+    result = { 'ID': str(computer_id), 'name': 'host{}'.format(computer_id), 'hostGroupID': str(computer_id % 2 + 1), 'overallStatus': self.statuses.get(computer_id, 'Managed (Online)'), 'platform': NIL }
+    if detail_level != 'LOW': result.update({ 'platform': 'Linux', 'overallVersion': '10.0' })
+    return result
+
+  def request(self, call, auth_required=True):
+    detail_level = call['data']['hostDetailLevel']
+    host_filter = call['data'].get('hostFilter', { 'type': 'BY_NAME' })
+    self.calls.append((detail_level, host_filter['type']))
+    computer_ids = range(self.count)
+    if host_filter['type'] == 'BY_NAME':
+      computer_ids = [ i for i in computer_ids if 'host{}'.format(i) == call['data']['hostname'] ]
+    elif host_filter['type'] == 'SPECIFIC_HOST':
+      computer_ids = [ i for i in computer_ids if i == int(host_filter['hostID']) ]
+    elif host_filter['type'] == 'HOSTS_IN_GROUP':
+      computer_ids = [ i for i in computer_ids if i % 2 + 1 == int(host_filter['hostGroupID']) ]
+    if detail_level != 'LOW': computer_ids = [ i for i in computer_ids if not i in self.missing ]
+    return { 'status': 200, 'data': [ self.computer(i, detail_level) for i in computer_ids ] }
+
+class TestUpgradeOnAccess(unittest.TestCase):
+  def setUp(self):
+    self.fake = FakeManager(missing=[9])
+    self.manager = dsm.Manager(username='user', password='password')
+    self.manager._request = self.fake.request
+    self.computers = self.manager.computers
+
+  def test_loaded_properties_dont_upgrade(self):
+    self.computers.get(detail_level='LOW', upgrade_to='HIGH')
+    self.assertEqual(self.computers[3].name, 'host3')
+    self.assertEqual(len(self.fake.calls), 1)
+
+  def test_missing_property_upgrades_the_computer_group(self):
+    self.computers.get(detail_level='LOW', upgrade_to='HIGH')
+    self.assertEqual(self.computers[3].overall_version, '10.0')
+    self.assertEqual(self.fake.calls[-1], ('HIGH', 'HOSTS_IN_GROUP'))
+
+    # the rest of the group came back in the same call
+    self.assertEqual(self.computers[5].overall_version, '10.0')
+    self.assertEqual(len(self.fake.calls), 2)
+    self.assertEqual(sorted(self.computers._upgrades.keys()), [0, 2, 4, 6, 8])
+
+  def test_empty_property_upgrades(self):
+    self.computers.get(detail_level='LOW', upgrade_to='HIGH')
+    self.assertEqual(self.computers[4].platform, 'Linux')
+    self.assertEqual(len(self.fake.calls), 2)
+
+  def test_empty_property_reads_none_if_the_upgrade_misses(self):
+    self.computers.get(detail_level='LOW', upgrade_to='HIGH')
+    self.assertEqual(self.computers[9].platform, None)
+    calls = len(self.fake.calls)
+    self.assertEqual(self.computers[9].platform, None)
+    self.assertEqual(len(self.fake.calls), calls)
+
+  def test_unknown_attributes_dont_upgrade(self):
+    self.computers.get(detail_level='LOW', upgrade_to='HIGH')
+    self.assertRaises(AttributeError, getattr, self.computers[3], 'not_a_property')
+    self.assertEqual(len(self.fake.calls), 1)
+
+  def test_lazy_computers_upgrade_through_get_property(self):
+    self.computers.get(detail_level='LOW', upgrade_to='MEDIUM', lazy=True)
+    self.assertFalse(self.computers[4].hydrated)
+    self.assertEqual(core.get_property(self.computers[4], 'platform'), 'Linux')
+    self.assertEqual(self.fake.calls[-1], ('MEDIUM', 'HOSTS_IN_GROUP'))
+    self.assertEqual(core.get_property(self.computers[6], 'platform'), 'Linux')
+    self.assertEqual(len(self.fake.calls), 2)
+
+  def test_upgrade_all(self):
+    self.computers.get(detail_level='LOW', upgrade_to='HIGH')
+    self.assertEqual(self.computers.upgrade(), range(9))
+    self.assertEqual(self.computers._upgrades, {})
+
+  def test_lock_isnt_held_during_the_upgrade_call(self):
+    self.computers.get(detail_level='LOW', upgrade_to='HIGH')
+    in_call = threading.Event()
+    release = threading.Event()
+    request = self.fake.request
+    def slow_request(call, auth_required=True):
+      in_call.set()
+      release.wait(5)
+      return request(call, auth_required)
+    self.manager._request = slow_request
+
+    results = {}
+    def read(computer_id): results[computer_id] = self.computers[computer_id].platform
+    threads = [ threading.Thread(target=read, args=(2,)), threading.Thread(target=read, args=(4,)) ]
+    threads[0].start()
+    in_call.wait(5)
+    self.assertTrue(self.computers._upgrade_lock.acquire(False))
+    self.computers._upgrade_lock.release()
+
+    # a second reader in the same group waits for the call in flight
+    threads[1].start()
+    release.set()
+    for thread in threads: thread.join(5)
+    self.assertEqual(results, { 2: 'Linux', 4: 'Linux' })
+    self.assertEqual(len(self.fake.calls), 2)
+
+class TestInternStrings(unittest.TestCase):
+  def setUp(self):
+    self.fake = FakeManager()
+    self.manager = dsm.Manager(username='user', password='password')
+    self.manager._request = self.fake.request
+    self.computers = self.manager.computers
+
+  def test_computers_added_later_are_interned(self):
+    self.computers.intern_strings()
+    self.computers.get(detail_level='LOW', lazy=True)
+    self.computers.get(detail_level='HIGH')
+    self.assertTrue(self.computers[2].platform is self.computers[7].platform)
+    report = self.computers.strings.report()
+    self.assertEqual(report['fields']['hostGroupID']['references'], 20)
+    self.assertEqual(report['fields']['platform']['values'], 1)
+
+class TestSync(unittest.TestCase):
+  def setUp(self):
+    self.fake = FakeManager()
+    self.manager = dsm.Manager(username='user', password='password')
+    self.manager._request = self.fake.request
+    self.computers = self.manager.computers
+
+  def test_first_sync_after_get_doesnt_refresh(self):
+    self.computers.get()
+    results = self.computers.sync()
+    self.assertEqual(results, { 'added': set(), 'changed': set(), 'removed': set() })
+    self.assertEqual(self.fake.calls, [('HIGH', 'ALL_HOSTS'), ('LOW', 'ALL_HOSTS')])
+
+  def test_only_changed_computers_are_refreshed(self):
+    self.computers.get()
+    self.computers.sync()
+    self.fake.statuses[3] = 'Offline'
+    self.fake.count = 11
+    self.fake.calls = []
+    results = self.computers.sync()
+    self.assertEqual(results, { 'added': set([10]), 'changed': set([3]), 'removed': set() })
+    self.assertEqual(sorted(self.fake.calls), [('HIGH', 'SPECIFIC_HOST'), ('HIGH', 'SPECIFIC_HOST'), ('LOW', 'ALL_HOSTS')])
+    self.assertEqual(self.computers[3].overall_status, 'Offline')
+    self.assertEqual(self.computers[10].platform, 'Linux')
+
+  def test_most_computers_changed_refreshes_all(self):
+    self.computers.sync()
+    self.assertEqual(self.fake.calls, [('LOW', 'ALL_HOSTS'), ('HIGH', 'ALL_HOSTS')])
+    self.assertEqual(len(self.computers), 10)
+
+  def test_removed_computers_are_unlinked(self):
+    self.computers.get(detail_level='LOW', upgrade_to='HIGH', lazy=True)
+    self.fake.count = 8
+    results = self.computers.sync(detail_level='LOW')
+    self.assertEqual(results['removed'], set([8, 9]))
+    self.assertFalse(self.computers.has_key(9))
+    self.assertFalse(self.computers._upgrades.has_key(9))
+    self.assertFalse([ computer for computer in self.computers.values() if computer.hydrated ])
+
+class TestPlanGetMany(unittest.TestCase):
+  def setUp(self):
+    self.fake = FakeManager()
+    self.manager = dsm.Manager(username='user', password='password')
+    self.manager._request = self.fake.request
+    self.computers = self.manager.computers
+
+  def test_plans_by_group(self):
+    self.computers.get()
+    self.computers._fleet_size = 1000
+    self.assertEqual(self.computers.plan_get_many(computer_ids=[0, 2, 4, 6]), [{ 'computer_group_id': '1', 'detail_level': 'HIGH' }])
+    self.assertEqual(sorted([ call['computer_id'] for call in self.computers.plan_get_many(computer_ids=[1, 2]) ]), [1, 2])
+
+  def test_resolves_names(self):
+    self.computers.get()
+    self.computers._fleet_size = 1000
+    self.assertEqual(self.computers.plan_get_many(computer_names=['host3', 'missing']), [{ 'computer_id': 3, 'detail_level': 'HIGH' }, { 'computer_name': 'missing', 'detail_level': 'HIGH' }])
+
+  def test_lazy_computers_arent_built_or_upgraded(self):
+    self.computers.get(detail_level='LOW', upgrade_to='HIGH', lazy=True)
+    self.computers.plan_get_many(computer_ids=[0, 2, 4], computer_names=['host3'])
+    self.assertFalse([ computer for computer in self.computers.values() if computer.hydrated ])
+    self.assertEqual(len(self.fake.calls), 1)
+
+  def test_get_many(self):
+    self.assertEqual(self.computers.get_many(computer_ids=[1, 3], computer_names=['host4']), [1, 3, 4])
+    self.assertEqual(sorted(self.computers.keys()), [1, 3, 4])
+
+class TestComputerStatusWatcher(unittest.TestCase):
+  def setUp(self):
+    self.manager = dsm.Manager(username='user', password='password')
+    self.logs = []
+    self.manager.log = lambda message, err=None, level=None: self.logs.append(message)
+    self.manager._request = lambda call, auth_required=True: { 'status': 200, 'data': [ { 'ID': '1', 'overallStatus': 'Managed (Online)' }, { 'ID': '2', 'overallStatus': 'Offline' } ] }
+
+  def test_failing_callback_doesnt_stop_the_watcher(self):
+    watcher = computers.ComputerStatusWatcher(self.manager, [1, 2], interval=0.01, timeout=0.1)
+    statuses = []
+    watcher.futures[1].add_done_callback(lambda future: 1 / 0)
+    watcher.futures[1].add_done_callback(lambda future: statuses.append(future.status))
+    watcher.run()
+    self.assertEqual(statuses, ['Managed (Online)'])
+    self.assertTrue(watcher.futures[2].timed_out)
+    self.assertTrue([ message for message in self.logs if 'Callback' in message ])
+
+  def test_low_detail_polls_only_merge_status(self):
+    fake = FakeManager()
+    self.manager._request = fake.request
+    self.manager.computers.get(computer_id=2)
+    self.manager.computers[2].overall_status = 'Offline'
+
+    watcher = computers.ComputerStatusWatcher(self.manager, [2, 4], interval=0.01, timeout=1, all_hosts_threshold=0)
+    watcher.run()
+    self.assertEqual(watcher.futures[2].result(), 'Managed (Online)')
+    self.assertEqual(self.manager.computers[2].overall_status, 'Managed (Online)')
+    self.assertEqual(self.manager.computers[2].platform, 'Linux')
+
+    # the rest of the fleet returned by the ALL_HOSTS call isn't added
+    self.assertEqual(self.manager.computers.keys(), [2])
+    self.assertEqual(watcher.futures[4].computer.platform, None)
+
+  def test_failing_target_status(self):
+    watcher = computers.ComputerStatusWatcher(self.manager, [1], interval=0.01, timeout=0.05, target_status=lambda computer: computer.no_such_property)
+    watcher.run()
+    self.assertTrue(watcher.futures[1].timed_out)
+    self.assertTrue([ message for message in self.logs if 'target_status' in message ])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,175 @@
+# standard library
+import threading
+import unittest
+
+# 3rd party libraries
+
+# project libraries
+from deepsecurity import core
+from deepsecurity.libs import xmltodict
+
+SOAP_RESPONSE = """<?xml version="1.0" encoding="UTF-8"?>
+<soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">
+<soapenv:Body><firewallEventRetrieve2Response><firewallEventRetrieve2Return><firewallEvents>
+<item><action>Deny</action><firewallEventID>1</firewallEventID><hostID>5</hostID><flags><flag>SYN</flag></flags><sourceIP>10.0.0.1</sourceIP></item>
+<item><action>Allow</action><firewallEventID>2</firewallEventID><hostID xsi:nil="true"/><flags><flag>ACK</flag></flags><sourceIP>10.0.0.2</sourceIP></item>
+</firewallEvents></firewallEventRetrieve2Return></firewallEventRetrieve2Response></soapenv:Body></soapenv:Envelope>"""
+
+class TestCoreFuture(unittest.TestCase):
+  def test_callbacks_added_while_resolving_run_once(self):
+    for attempt in range(50):
+      future = core.CoreFuture()
+      calls = []
+      threads = [ threading.Thread(target=future.add_done_callback, args=(lambda f: calls.append(f.value),)) for i in range(8) ]
+      for thread in threads: thread.start()
+      future._resolve(5)
+      for thread in threads: thread.join()
+      self.assertEqual(calls, [5] * 8)
+
+  def test_callback_after_resolving_runs_immediately(self):
+    future = core.CoreFuture()
+    future._resolve('value')
+    calls = []
+    future.add_done_callback(lambda f: calls.append(f.result()))
+    self.assertEqual(calls, ['value'])
+
+class TestProjection(unittest.TestCase):
+  def setUp(self):
+    self.api = core.CoreApi()
+    self.fields = self.api._get_projection(['hostID', 'source_ip'])
+
+  def get_items(self, data):
+    return data['soapenv:Envelope']['soapenv:Body']['firewallEventRetrieve2Response']['firewallEventRetrieve2Return']['firewallEvents']['item']
+
+  def test_property_names_are_translated(self):
+    self.assertEqual(self.fields, set(['hostID', 'sourceIP', 'source_ip']))
+
+  def test_elements_are_dropped_while_parsing(self):
+    items = self.get_items(xmltodict.parse(SOAP_RESPONSE, expat=core._ProjectedExpat(self.fields)))
+
+    # the elements of the first record before a projected one can't be recognized yet
+    self.assertEqual(items[0].keys(), ['action', 'firewallEventID', 'hostID', 'sourceIP'])
+    self.assertEqual(items[1].keys(), ['firewallEventID', 'hostID', 'sourceIP'])
+    self.assertEqual(items[1]['hostID'], { '@xsi:nil': 'true' })
+
+  def test_same_result_as_projecting_the_full_response(self):
+    projected = core.project(xmltodict.parse(SOAP_RESPONSE, expat=core._ProjectedExpat(self.fields)), self.fields)
+    self.assertEqual(projected, core.project(xmltodict.parse(SOAP_RESPONSE), self.fields))
+    self.assertEqual([ item.keys() for item in self.get_items(projected) ], [['firewallEventID', 'hostID', 'sourceIP']] * 2)
+
+  def test_project_json(self):
+    data = { 'events': [ { 'eventID': 1, 'hostID': 5, 'payload': 'x' * 100 }, { 'eventID': 2, 'hostID': 6, 'tags': ['a'] } ] }
+    self.assertEqual(core.project(data, self.fields), { 'events': [ { 'eventID': 1, 'hostID': 5 }, { 'eventID': 2, 'hostID': 6 } ] })
+
+  def test_projection_applies_to_this_thread_until_the_block_ends(self):
+    seen = []
+    with self.api.projection(['hostID']):
+      self.assertEqual(self.api._projections.fields, set(['hostID']))
+      thread = threading.Thread(target=lambda: seen.append(getattr(self.api._projections, 'fields', None)))
+      thread.start()
+      thread.join()
+    self.assertEqual(seen, [None])
+    self.assertEqual(self.api._projections.fields, None)
+
+class Built(core.CoreObject):
+  def __init__(self, api_response): self._set_properties(api_response, None)
+
+class TestCoreProxy(unittest.TestCase):
+  def setUp(self):
+    self.built = []
+    self.collection = core.CoreDict()
+    for i in range(5):
+      self.collection[i] = core.CoreProxy({ 'ID': str(i), 'hostGroupID': str(i % 2), 'name': 'host{}'.format(i) }, self.build)
+
+  def build(self, api_response):
+    self.built.append(api_response['ID'])
+    return Built(api_response)
+
+  def test_counting_and_finding_dont_build(self):
+    self.assertEqual(len(self.collection), 5)
+    self.assertEqual(sorted(self.collection.find(computer_group_id='1')), [1, 3])
+    self.assertEqual(core.get_property(self.collection[2], 'name'), 'host2')
+    self.assertEqual(core.get_property(self.collection[2], 'platform', 'unknown'), 'unknown')
+    self.assertEqual(self.built, [])
+
+  def test_built_once_on_first_use(self):
+    proxy = self.collection[3]
+    self.assertEqual(proxy.name, 'host3')
+    self.assertEqual(proxy.id, 3)
+    self.assertTrue(proxy.hydrated)
+    self.assertEqual(proxy.raw, None)
+    self.assertEqual(self.built, ['3'])
+
+    # reads after building come from the object
+    proxy.name = 'renamed'
+    self.assertEqual(core.get_property(proxy, 'name'), 'renamed')
+    self.assertEqual(self.collection.find(name='renamed'), [3])
+    self.assertEqual(self.built, ['3'])
+
+  def test_on_missing(self):
+    missing = []
+    def on_missing(proxy, name):
+      missing.append(name)
+      proxy.raw['platform'] = 'Linux'
+      return True
+    proxy = core.CoreProxy({ 'ID': '1', 'platform': { '@xsi:nil': 'true' } }, self.build, on_missing)
+    self.assertEqual(core.get_property(proxy, 'id'), 1)
+    self.assertEqual(core.get_property(proxy, 'platform'), 'Linux')
+    self.assertEqual(missing, ['platform'])
+
+class TestCoreStringPool(unittest.TestCase):
+  def record(self, i):
+    return { 'ID': str(1000 + i), 'platform': ''.join(['Lin', 'ux']), 'hostGroupID': str(100 + i % 2) }
+
+  def test_repeated_values_are_shared(self):
+    pool = core.CoreStringPool()
+    records = [ pool.intern_record(self.record(i)) for i in range(10) ]
+    self.assertTrue(all([ record['platform'] is records[0]['platform'] for record in records ]))
+    self.assertTrue(records[2]['hostGroupID'] is records[4]['hostGroupID'])
+    self.assertFalse(records[1]['hostGroupID'] is records[2]['hostGroupID'])
+
+    report = pool.report()
+    self.assertEqual(report['fields']['platform']['values'], 1)
+    self.assertEqual(report['fields']['platform']['references'], 10)
+    self.assertTrue(report['fields']['platform']['bytes_saved'] > 0)
+    self.assertEqual(report['bytes_saved'], sum([ stats['bytes_saved'] for stats in report['fields'].values() ]))
+
+  def test_high_cardinality_fields_are_left_alone(self):
+    pool = core.CoreStringPool(max_values=5)
+    for i in range(10): pool.intern_record(self.record(i))
+    first, second = self.record(1), self.record(1)
+    pool.intern_record(first)
+    pool.intern_record(second)
+    self.assertFalse(first['ID'] is second['ID'])
+    self.assertTrue(first['platform'] is second['platform'])
+
+    report = pool.report()
+    self.assertTrue(report['fields']['ID']['high_cardinality'])
+    self.assertEqual(report['fields']['ID']['values'], 0)
+    self.assertFalse(report['fields']['platform']['high_cardinality'])
+
+  def test_str_and_unicode_are_kept_apart(self):
+    pool = core.CoreStringPool()
+    pool.intern_record({ 'platform': 'Linux' })
+    record = pool.intern_record({ 'platform': u'Linux' })
+    self.assertTrue(isinstance(record['platform'], unicode))
+
+  def test_long_values_arent_pooled(self):
+    pool = core.CoreStringPool(max_length=4)
+    first, second = pool.intern_record({ 'platform': ''.join(['Lin', 'ux']) }), pool.intern_record({ 'platform': ''.join(['Lin', 'ux']) })
+    self.assertFalse(first['platform'] is second['platform'])
+    self.assertEqual(pool.report()['fields'], {})
+
+  def test_collection_interns_objects_and_proxies(self):
+    collection = core.CoreDict()
+    collection[1] = Built(self.record(1))
+    collection[3] = core.CoreProxy(self.record(3), Built)
+    collection[5] = core.CoreProxy(self.record(5), Built)
+    collection[5].hydrate()
+    collection.intern_strings()
+    self.assertTrue(collection[1].platform is core.get_property(collection[3], 'platform'))
+    self.assertTrue(collection[1].platform is collection[5].platform)
+    self.assertFalse(collection[3].hydrated)
+
+if __name__ == '__main__':
+  unittest.main()
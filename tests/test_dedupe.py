@@ -0,0 +1,98 @@
+# standard library
+import os
+import shutil
+import tempfile
+import unittest
+
+# 3rd party libraries
+
+# project libraries
+from deepsecurity import dedupe
+from deepsecurity import dsm
+
+class TestSeenIDSet(unittest.TestCase):
+  def setUp(self):
+    self.path = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.path)
+
+  def test_save_and_load(self):
+    seen = dedupe.SeenIDSet()
+    for event_id in [1, 2, 5, 70000, 'x']: seen.add(event_id)
+    path = os.path.join(self.path, 'test.seen')
+    seen.save(path)
+    loaded = dedupe.SeenIDSet.load(path)
+    self.assertEqual([ event_id in loaded for event_id in [1, 3, 5, 70000, 'x'] ], [True, False, True, True, True])
+    self.assertFalse(os.path.exists('{}.tmp'.format(path)))
+
+class TestEventDeduplicator(unittest.TestCase):
+  def setUp(self):
+    self.path = tempfile.mkdtemp()
+    self.deduplicator = dedupe.EventDeduplicator(self.path)
+    self.events = [ { 'firewallEventID': str(i) } for i in range(1, 6) ]
+
+  def tearDown(self):
+    shutil.rmtree(self.path)
+
+  def test_filter_drops_repeats_within_a_batch(self):
+    results = self.deduplicator.filter('firewall_events', self.events + self.events[:2], commit=False)
+    self.assertEqual(len(results), 5)
+    self.assertEqual(self.deduplicator.duplicates['firewall_events'], 2)
+
+  def test_filter_without_commit_doesnt_mark_seen(self):
+    self.deduplicator.filter('firewall_events', self.events, commit=False)
+    self.assertEqual(len(self.deduplicator.filter('firewall_events', self.events, commit=False)), 5)
+
+    self.deduplicator.commit('firewall_events', self.events)
+    self.assertEqual(self.deduplicator.filter('firewall_events', self.events), [])
+
+  def test_wrap_only_commits_after_the_handler_succeeds(self):
+    def failing_handler(event_type, events): raise ValueError("handler failed")
+    handler = self.deduplicator.wrap(failing_handler)
+    self.assertRaises(ValueError, handler, 'firewall_events', self.events)
+
+    received = []
+    handler = self.deduplicator.wrap(lambda event_type, events: received.extend(events))
+    handler('firewall_events', self.events)
+    handler('firewall_events', self.events)
+    self.assertEqual(len(received), 5)
+
+class TestCollectEventsDedupe(unittest.TestCase):
+  def setUp(self):
+    self.path = tempfile.mkdtemp()
+    self.deduplicator = dedupe.EventDeduplicator(self.path)
+    self.manager = dsm.Manager(username='user', password='password')
+    events = [ { 'firewallEventID': str(i) } for i in range(1, 6) ]
+    self.manager._request = lambda call, auth_required=True: { 'status': 200, 'data': [ { 'firewallEvents': { 'item': events } } ] }
+
+  def tearDown(self):
+    shutil.rmtree(self.path)
+
+  def collect(self, handler):
+    return self.manager.collect_events(['firewall_events'], handlers=handler, deduplicator=self.deduplicator, store=False)
+
+  def test_failed_handler_leaves_events_unseen(self):
+    def failing_handler(event_type, events): raise ValueError("handler failed")
+    summary = self.collect(failing_handler)
+    self.assertTrue(summary['firewall_events']['error'])
+    self.assertEqual(len(self.deduplicator.get_set('firewall_events')), 0)
+
+    # the events are delivered on the next run
+    received = []
+    summary = self.collect(lambda event_type, events: received.extend(events))
+    self.assertEqual(len(received), 5)
+    self.assertEqual(summary['firewall_events']['duplicates'], 0)
+
+  def test_delivered_events_are_dropped_next_time(self):
+    self.collect(lambda event_type, events: None)
+    summary = self.collect(lambda event_type, events: None)
+    self.assertEqual(summary['firewall_events']['count'], 0)
+    self.assertEqual(summary['firewall_events']['duplicates'], 5)
+
+    # and across runs
+    deduplicator = dedupe.EventDeduplicator(self.path)
+    self.assertEqual(deduplicator.filter('firewall_events', [ { 'firewallEventID': '3' } ]), [])
+
+if __name__ == '__main__':
+  unittest.main()
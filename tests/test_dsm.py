@@ -0,0 +1,93 @@
+# standard library
+import unittest
+
+# 3rd party libraries
+
+# project libraries
+from deepsecurity import dsm
+
+class TestBulkActions(unittest.TestCase):
+  def setUp(self):
+    self.manager = dsm.Manager(username='user', password='password')
+    self.manager.bulk_action_chunk_size = 250
+    self.manager.bulk_action_max_workers = 1
+    self.calls = []
+
+  def test_outage_fails_fast(self):
+    def request(call, auth_required=True):
+      self.calls.append(call['data']['hostIDs'])
+      return { 'status': None, 'data': None }
+    self.manager._request = request
+    result = self.manager.scan_computers_for_malware(range(1000))
+    self.assertEqual(len(self.calls), 1)
+    self.assertEqual(len(result.failed), 1000)
+    self.assertFalse(result)
+
+  def test_rejected_chunks_are_split(self):
+    def request(call, auth_required=True):
+      self.calls.append(call['data']['hostIDs'])
+      return { 'status': 500 if 7 in call['data']['hostIDs'] else 200, 'data': None }
+    self.manager._request = request
+    result = self.manager.scan_computers_for_malware(range(1000))
+    self.assertTrue(len(self.calls) > 4)
+    self.assertTrue(7 in result.failed)
+    self.assertTrue(len(result.succeeded) > 900)
+
+    # the outcome for each computer
+    self.assertEqual(result.get(7), False)
+    self.assertEqual(result.get(999), True)
+    self.assertEqual(result.get(1000), None)
+    self.assertEqual(result.get(1000, False), False)
+
+  def test_no_computers_no_calls(self):
+    self.manager._request = lambda call, auth_required=True: self.calls.append(call)
+    self.assertTrue(self.manager.scan_computers_for_malware([]))
+    self.assertEqual(self.calls, [])
+
+class TestCollectEvents(unittest.TestCase):
+  def setUp(self):
+    self.manager = dsm.Manager(username='user', password='password')
+    self.manager._request = self.request
+    self.calls = {}
+
+  def request(self, call, auth_required=True):
+    self.calls[call['call']] = call
+    if call['call'] == 'DPIEventRetrieve2': raise IOError("connection reset")
+    if call['call'] == 'events/appcontrol':
+      return { 'status': 200, 'data': { 'ListEventsResponse': { 'events': [ { 'eventID': 7 } ] } } }
+    return { 'status': 200, 'data': [ { 'firewallEvents': { 'item': [ { 'firewallEventID': str(i) } for i in range(1, 4) ] } } ] }
+
+  def test_each_type_is_handled_and_stored(self):
+    received = {}
+    def handler(event_type, events): received[event_type] = events
+    summary = self.manager.collect_events(['firewall_events', 'application_control_events'], handlers={ 'firewall_events': handler })
+    self.assertEqual(received.keys(), ['firewall_events'])
+    self.assertEqual(len(received['firewall_events']), 3)
+    self.assertEqual(sorted(self.manager.firewall_events.keys()), ['1', '2', '3'])
+    self.assertEqual(len(self.manager.application_control_events), 1)
+    self.assertEqual(summary['total'], 4)
+    self.assertEqual(summary['application_control_events']['count'], 1)
+
+  def test_store_false_leaves_the_collections_empty(self):
+    received = []
+    summary = self.manager.collect_events(['firewall_events'], handlers=lambda event_type, events: received.extend(events), store=False)
+    self.assertEqual(len(received), 3)
+    self.assertEqual(len(self.manager.firewall_events), 0)
+    self.assertEqual(summary['firewall_events']['count'], 3)
+
+  def test_filters_are_only_passed_where_supported(self):
+    id_filter = { 'id': 10, 'operator': 'GREATER_THAN' }
+    rest_filter = { 'maxItems': 5 }
+    self.manager.collect_events(['firewall_events', 'application_control_events'], id_filter=id_filter, rest_filter=rest_filter)
+    self.assertEqual(self.calls['firewallEventRetrieve2']['data']['eventIdFilter']['id'], 10)
+    self.assertEqual(self.calls['events/appcontrol']['query']['maxItems'], 5)
+
+  def test_a_failed_type_doesnt_stop_the_others(self):
+    summary = self.manager.collect_events(['firewall_events', 'intrusionprevention_events'])
+    self.assertTrue(summary['intrusionprevention_events']['error'])
+    self.assertEqual(summary['intrusionprevention_events']['count'], 0)
+    self.assertEqual(summary['firewall_events']['error'], None)
+    self.assertEqual(summary['total'], 3)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,72 @@
+# standard library
+import unittest
+
+# 3rd party libraries
+
+# project libraries
+from deepsecurity import core
+from deepsecurity import dsm
+from deepsecurity import enrichment
+
+NIL = { '@xsi:nil': 'true' }
+
+class FakeManager(object):
+  """
+  Answers hostDetailRetrieve calls for three computers. LOW detail leaves 
+  the display name empty, as the Manager does
+  """
+  def __init__(self):
+    self.calls = []
+
+  def request(self, call, auth_required=True):
+    detail_level = call['data']['hostDetailLevel']
+    self.calls.append(detail_level)
+    computers = []
+    for i in range(1, 4):
+      computer = { 'ID': str(i), 'name': 'host{}'.format(i), 'hostGroupID': '10', 'securityProfileID': str(20 + i % 2), 'displayName': NIL }
+      if detail_level != 'LOW': computer['displayName'] = 'Host {}'.format(i)
+      computers.append(computer)
+    return { 'status': 200, 'data': computers }
+
+class Named(object):
+  def __init__(self, name):
+    self.name = name
+    self.computers = {}
+
+class TestEnrichment(unittest.TestCase):
+  def setUp(self):
+    self.fake = FakeManager()
+    self.manager = dsm.Manager(username='user', password='password')
+    self.manager._request = self.fake.request
+    self.manager.computer_groups[10] = Named('Web')
+    self.manager.policies[21] = Named('Linux Server')
+
+  def test_index_reads_lazy_computers_without_building_or_upgrading_them(self):
+    self.manager.computers.get(detail_level='LOW', upgrade_to='HIGH', lazy=True)
+    index = enrichment.InventoryIndex(self.manager)
+    self.assertFalse([ computer for computer in self.manager.computers.values() if computer.hydrated ])
+    self.assertEqual(self.fake.calls, ['LOW'])
+    self.assertEqual(index.computers[1], { 'hostName': 'host1', 'displayName': None, 'hostGroupID': 10, 'securityProfileID': 21 })
+
+  def test_enrich(self):
+    self.manager.computers.get()
+    rule_key = enrichment.InventoryIndex(self.manager).rule_keys['DPIRuleID']
+    self.manager.rules[rule_key] = { 5: core.CoreProxy({ 'name': 'Block SMB' }, lambda api_response: self.fail('built the rule')) }
+
+    enricher = enrichment.EventEnricher(self.manager, batch_size=2)
+    records = list(enricher.enrich([
+      { 'hostID': '1', 'DPIRuleID': '5' },
+      { 'hostName': 'host3', 'displayName': 'keep' },
+      { 'hostID': '99' },
+      ]))
+    self.assertEqual(records[0]['hostGroupName'], 'Web')
+    self.assertEqual(records[0]['securityProfileName'], 'Linux Server')
+    self.assertEqual(records[0]['ruleName'], 'Block SMB')
+    self.assertEqual(records[1]['hostID'], 3)
+    self.assertEqual(records[1]['displayName'], 'keep')
+    self.assertEqual(records[1]['securityProfileID'], 21)
+    self.assertEqual(enricher.enriched, 3)
+    self.assertEqual(enricher.unmatched, 1)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,285 @@
+# standard library
+import unittest
+
+# 3rd party libraries
+
+# project libraries
+from deepsecurity import core
+from deepsecurity import dsm
+from deepsecurity import events
+
+class Event(object):
+  def __init__(self, event_id, log_date=None):
+    self.eventID = event_id
+    if log_date: self.logDate = log_date
+
+class FakeEventManager(object):
+  """
+  Answers firewall (SOAP) and anti-malware (REST) event calls for events 
+  1 to count. Like the Manager, a SOAP call returns at most max_items events
+  """
+  def __init__(self, count=25, max_items=10):
+    self.events = [ { 'firewallEventID': str(i), 'hostID': str(i % 3), 'logDate': '2016-08-01T00:00:{:02d}.000Z'.format(i) } for i in range(1, count + 1) ]
+    self.max_items = max_items
+    self.calls = []
+
+  def request(self, call, auth_required=True):
+    if call['api'] == 'REST':
+      rest_filter = call['query']
+      after = 0
+      if rest_filter['eventIdOp'] == 'GT': after = rest_filter['eventId']
+      if rest_filter['eventIdOp'] == 'GE': after = rest_filter['eventId'] - 1
+      found = [ dict(event, antiMalwareEventID=event['firewallEventID']) for event in self.events if long(event['firewallEventID']) > after ][:rest_filter['maxItems']]
+      self.calls.append(len(found))
+      return { 'status': 200, 'data': { 'antiMalwareEventListing': { 'events': found } } }
+
+    id_filter = call['data']['eventIdFilter']
+    found = [ event for event in self.events if id_filter['operator'] != 'GREATER_THAN' or long(event['firewallEventID']) > id_filter['id'] ]
+    if id_filter['operator'] == 'EQUAL': found = [ event for event in self.events if long(event['firewallEventID']) == id_filter['id'] ]
+    found = found[:self.max_items]
+    self.calls.append(len(found))
+    return { 'status': 200, 'data': { 'firewallEvents': { 'item': found } if found else None } }
+
+class TestIterate(unittest.TestCase):
+  def setUp(self):
+    self.fake = FakeEventManager()
+    self.manager = dsm.Manager(username='user', password='password')
+    self.manager._request = self.fake.request
+
+  def event_ids(self, events, key='firewallEventID'):
+    return [ int(event[key]) for event in events ]
+
+  def test_soap_pages_past_the_manager_limit(self):
+    self.assertEqual(self.event_ids(self.manager.firewall_events.iterate()), range(1, 26))
+    self.assertEqual(self.fake.calls, [10, 10, 5, 0])
+
+  def test_one_page_is_retrieved_at_a_time(self):
+    iterator = self.manager.firewall_events.iterate()
+    next(iterator)
+    self.assertEqual(self.fake.calls, [10])
+
+  def test_rest_pages_by_page_size(self):
+    self.assertEqual(self.event_ids(self.manager.antimalware_events.iterate(REST_API=True, page_size=7), 'antiMalwareEventID'), range(1, 26))
+    self.assertEqual(self.fake.calls, [7, 7, 7, 4])
+
+  def test_rest_max_items_caps_the_total(self):
+    rest_filter = events.filters.create_rest_event_filter(eventId=3, eventIdOp='GE', maxItems=12)
+    self.assertEqual(self.event_ids(self.manager.antimalware_events.iterate(rest_filter=rest_filter, REST_API=True, page_size=5), 'antiMalwareEventID'), range(3, 15))
+
+  def test_other_id_comparisons_are_retrieved_once(self):
+    id_filter = events.filters.create_id_filter(4, operator='EQUAL')
+    self.assertEqual(self.event_ids(self.manager.firewall_events.iterate(id_filter=id_filter)), [4])
+    self.assertEqual(len(self.fake.calls), 1)
+
+class TestLazyEvents(unittest.TestCase):
+  def setUp(self):
+    self.fake = FakeEventManager()
+    self.manager = dsm.Manager(username='user', password='password')
+    self.manager._request = self.fake.request
+
+  def test_events_are_built_on_first_use(self):
+    collection = self.manager.firewall_events
+    collection.get(lazy=True)
+    self.assertEqual(len(collection), 10)
+    self.assertEqual(sorted(collection.find(computer_id='2')), ['2', '5', '8'])
+    self.assertFalse([ event for event in collection.values() if event.hydrated ])
+    self.assertEqual(collection['5'].computer_id, '2')
+    self.assertEqual([ event_id for event_id, event in collection.items() if event.hydrated ], ['5'])
+
+class FakeIntegrityManager(object):
+  """
+  Answers REST integrity event calls for events 1 to count. The extended 
+  description and change details are only returned with extendedDesc. The
+  missing events are only returned without them
+  """
+  def __init__(self, count=400, missing=None):
+    self.count = count
+    self.missing = missing or []
+    self.calls = []
+
+  def request(self, call, auth_required=True):
+    query = call['query']
+    self.calls.append((query['eventId'], query.get('maxItems'), query['extendedDesc']))
+    after = query['eventId'] if query['eventIdOp'] == 'GT' else query['eventId'] - 1
+    found = []
+    for event_id in range(after + 1, self.count + 1)[:query.get('maxItems')]:
+      if event_id in self.missing and query['extendedDesc']: continue
+      event = { 'eventID': event_id, 'hostID': event_id % 3, 'key': '/etc/file{}'.format(event_id) }
+      if query['extendedDesc']: event.update({ 'extendedDescription': 'changed {}'.format(event_id), 'changeType': 'updated' })
+      found.append(event)
+    return { 'status': 200, 'data': { 'ListEventsResponse': { 'events': found } } }
+
+class TestIntegritySummaries(unittest.TestCase):
+  def setUp(self):
+    self.fake = FakeIntegrityManager(missing=[7])
+    self.manager = dsm.Manager(username='user', password='password')
+    self.manager._request = self.fake.request
+    self.collection = self.manager.integritymonitoring_events
+
+  def test_summaries_leave_out_the_description(self):
+    self.assertEqual(self.collection.get_summaries(), 400)
+    self.assertEqual(self.fake.calls, [(0, None, False)])
+    self.assertEqual(self.collection[5].key, '/etc/file5')
+    self.assertFalse(self.collection[5].details_loaded)
+    self.assertFalse('extendedDescription' in vars(self.collection[5]))
+
+  def test_details_are_retrieved_in_runs(self):
+    details = self.collection.retrieve_details([3, 5, 7, 40, 300, 310], max_span=500, max_gap=16)
+    self.assertEqual(sorted(details.keys()), ['3', '300', '310', '40', '5'])
+    self.assertEqual(self.fake.calls, [(3, 5, True), (40, 1, True), (300, 11, True)])
+    self.assertEqual(details['40']['extendedDescription'], 'changed 40')
+
+    self.fake.calls = []
+    self.collection.retrieve_details([1, 9, 17], max_span=10)
+    self.assertEqual([ call[:2] for call in self.fake.calls ], [(1, 9), (17, 1)])
+
+  def test_load_details(self):
+    self.collection.get_summaries(rest_filter={ 'eventId': 0, 'eventIdOp': 'GT', 'maxItems': 10 })
+    self.fake.calls = []
+    self.assertEqual(self.collection.load_details(), 9)
+    self.assertEqual(self.fake.calls, [(1, 10, True)])
+    self.assertEqual(self.collection[4].extendedDescription, 'changed 4')
+    self.assertTrue(all([ event.details_loaded for event in self.collection.values() ]))
+
+    # nothing left to load
+    self.assertEqual(self.collection.load_details(), 0)
+    self.assertEqual(len(self.fake.calls), 1)
+
+  def test_reading_the_description_loads_it(self):
+    self.collection.get_summaries()
+    self.fake.calls = []
+    self.assertEqual(self.collection[42].extendedDescription, 'changed 42')
+    self.assertEqual(self.fake.calls, [(42, 1, True)])
+    self.assertTrue(self.collection[42].details_loaded)
+    self.assertFalse(self.collection[43].details_loaded)
+
+    # other missing properties don't make a call
+    self.assertFalse(hasattr(self.collection[43], 'no_such_property'))
+    self.assertEqual(len(self.fake.calls), 1)
+
+    # fields learned from the first description load the rest lazily too
+    self.assertEqual(self.collection[43].changeType, 'updated')
+    self.assertEqual(len(self.fake.calls), 2)
+
+  def test_events_that_arent_returned_arent_retried(self):
+    self.collection.get_summaries()
+    self.assertRaises(AttributeError, getattr, self.collection[7], 'extendedDescription')
+    self.assertTrue(self.collection[7].details_loaded)
+    calls = len(self.fake.calls)
+    self.assertRaises(AttributeError, getattr, self.collection[7], 'extendedDescription')
+    self.assertEqual(len(self.fake.calls), calls)
+
+class TestPlanQuery(unittest.TestCase):
+  def setUp(self):
+    self.fake = FakeEventManager()
+    self.manager = dsm.Manager(username='user', password='password')
+    self.manager._request = self.fake.request
+
+  def test_soap_wins_a_tie(self):
+    self.assertEqual(self.manager.antimalware_events.plan_query()['api'], 'SOAP')
+    self.assertEqual(self.manager.antimalware_events.plan_query(min_event_id=5)['api'], 'SOAP')
+
+  def test_soap_pushes_down_computers_and_the_end(self):
+    self.assertEqual(self.manager.antimalware_events.plan_query(computer_ids=[1, 2], min_event_id=5, max_event_id=9)['api'], 'SOAP')
+    self.assertEqual(self.manager.antimalware_events.plan_query(end=1470000000000, min_event_id=5, max_event_id=9)['api'], 'SOAP')
+
+  def test_rest_bounds_an_event_id_range(self):
+    plan = self.manager.antimalware_events.plan_query(min_event_id=5, max_event_id=9)
+    self.assertEqual(plan['api'], 'REST')
+    self.assertEqual(plan['calls'][0]['rest_filter']['maxItems'], 3)
+    self.assertEqual(plan['local'], ['max_event_id'])
+    self.assertEqual(self.manager.antimalware_events.plan_query(event_ids=[4, 6])['api'], 'REST')
+
+  def test_rest_range_query(self):
+    found = self.manager.antimalware_events.iterate_query(min_event_id=5, max_event_id=9)
+    self.assertEqual([ int(event['antiMalwareEventID']) for event in found ], [6, 7, 8])
+    self.assertEqual(self.fake.calls, [3])
+
+  def test_soap_only_collections_use_soap(self):
+    self.assertEqual(self.manager.firewall_events.plan_query(min_event_id=5, max_event_id=9)['api'], 'SOAP')
+    self.assertRaises(ValueError, self.manager.firewall_events.plan_query, api='REST')
+
+  def test_names_are_resolved_without_building_lazy_computers(self):
+    self.manager.computers[3] = core.CoreProxy({ 'ID': '3', 'name': 'web01' }, lambda api_response: self.fail('built the computer'))
+    plan = self.manager.firewall_events.plan_query(computer_names='web01')
+    self.assertEqual(plan['predicates']['computer_ids'], set([3]))
+    self.assertFalse(self.manager.computers[3].hydrated)
+
+class TestMergeEvents(unittest.TestCase):
+  def stream(self, times, host='1'):
+    return [ { 'eventTime': t, 'hostID': host } for t in times ]
+
+  def test_merges_in_time_order(self):
+    merged = events.merge_events({ 'a': self.stream([1, 4, 6]), 'b': self.stream([2, 3, 5]) })
+    self.assertEqual([ (event_type, event['eventTime']) for event_type, event in merged ], [('a', 1), ('b', 2), ('b', 3), ('a', 4), ('b', 5), ('a', 6)])
+
+  def test_reorders_streams_by_default(self):
+    merged = events.merge_events([ self.stream([3, 1, 2]), self.stream([4]) ])
+    self.assertEqual([ event['eventTime'] for event_type, event in merged ], [1, 2, 3, 4])
+
+    merged = events.merge_events([ self.stream([3, 1, 2]), self.stream([4]) ], reorder_window=0)
+    self.assertEqual([ event['eventTime'] for event_type, event in merged ], [3, 1, 2, 4])
+
+  def test_streams_are_read_a_page_at_a_time(self):
+    fake = FakeEventManager(count=25, max_items=10)
+    manager = dsm.Manager(username='user', password='password')
+    manager._request = fake.request
+    merged = events.merge_events({ 'firewall': manager.firewall_events.iterate() }, reorder_window=5)
+    next(merged)
+    self.assertEqual(fake.calls, [10])
+
+  def test_correlates_bursts_by_host(self):
+    merged = events.merge_events({ 'a': self.stream([0, 100000], host='1'), 'b': self.stream([1000, 2000], host='2') + self.stream([900000], host='1') })
+    groups = [ (key, [ event['eventTime'] for event_type, event in group ]) for key, group in events.correlate_events(merged, window=300) ]
+    self.assertEqual(groups, [('2', [1000, 2000]), ('1', [0, 100000]), ('1', [900000])])
+
+class TestEventEviction(unittest.TestCase):
+  def setUp(self):
+    self.events = events.FirewallEvents()
+
+  def test_fifo_keeps_the_newest(self):
+    evicted = []
+    self.events.set_capacity(max_events=3, on_evict=lambda event_id, event: evicted.append(event_id))
+    for i in range(1, 6): self.events[i] = Event(i)
+    self.assertEqual(sorted(self.events.keys()), [3, 4, 5])
+    self.assertEqual(evicted, [1, 2])
+    self.assertEqual(self.events.evicted, 2)
+
+  def test_lru_keeps_recently_read(self):
+    self.events.set_capacity(max_events=3, policy='LRU')
+    for i in range(1, 4): self.events[i] = Event(i)
+    self.events[1]
+    self.events[4] = Event(4)
+    self.assertEqual(sorted(self.events.keys()), [1, 3, 4])
+
+  def test_event_id_evicts_the_lowest(self):
+    self.events.set_capacity(max_events=3, policy='EVENT_ID')
+    for i in [5, 1, 4, 2, 3]: self.events[i] = Event(i)
+    self.assertEqual(sorted(self.events.keys()), [3, 4, 5])
+
+  def test_heap_stays_bounded_when_events_are_replaced(self):
+    self.events.set_capacity(max_events=10, policy='EVENT_ID')
+    for round in range(100):
+      for i in range(1, 11): self.events[i] = Event(i)
+    self.assertEqual(len(self.events), 10)
+    self.assertEqual(self.events.evicted, 0)
+    self.assertTrue(len(self.events._heap) <= 2 * len(self.events))
+
+    # replaced events are still evicted in order
+    for i in range(11, 16): self.events[i] = Event(i)
+    self.assertEqual(sorted(self.events.keys()), range(6, 16))
+
+  def test_removing_events_doesnt_leave_stale_entries(self):
+    self.events.set_capacity(max_events=100, policy='EVENT_ID')
+    for i in range(1, 101): self.events[i] = Event(i)
+    for i in range(1, 91): del(self.events[i])
+    self.assertTrue(len(self.events._heap) <= 2 * len(self.events))
+
+  def test_unbounded_again_without_limits(self):
+    self.events.set_capacity(max_events=2)
+    self.events.set_capacity()
+    for i in range(1, 6): self.events[i] = Event(i)
+    self.assertEqual(len(self.events), 5)
+
+if __name__ == '__main__':
+  unittest.main()
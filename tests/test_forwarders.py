@@ -0,0 +1,76 @@
+# standard library
+import unittest
+
+# 3rd party libraries
+
+# project libraries
+from deepsecurity import forwarders
+
+class FakeSocket(object):
+  """
+  Writes at most chunk bytes per call and fails once after fail_after bytes
+  """
+  def __init__(self, received, chunk=37, fail_after=None):
+    self.received = received
+    self.chunk = chunk
+    self.fail_after = fail_after
+    self.data = ''
+
+  def send(self, data):
+    if self.fail_after is not None and len(self.data) >= self.fail_after:
+      self.fail_after = None
+      raise IOError("connection reset")
+    sent = data[:self.chunk]
+    self.data += sent
+    return len(sent)
+
+  def close(self):
+    self.received.append(self.data)
+
+def split_frames(data):
+  """
+  Split octet counted frames, dropping a partial frame at the end
+  """
+  messages = []
+  while data:
+    length, rest = data.split(' ', 1)
+    if len(rest) < int(length): break
+    messages.append(rest[:int(length)])
+    data = rest[int(length):]
+  return messages
+
+class TestSyslogForwarder(unittest.TestCase):
+  def setUp(self):
+    self.received = []
+    self.forwarder = forwarders.SyslogForwarder('localhost', protocol='TCP', batch_size=5)
+    self.fail_after = [100]
+    def connect():
+      self.forwarder._sock = FakeSocket(self.received, fail_after=self.fail_after.pop() if self.fail_after else None)
+      self.forwarder.stats['connections'] += 1
+    self.forwarder._connect = connect
+    self.sleep = forwarders.time.sleep
+    forwarders.time.sleep = lambda seconds: None
+
+  def tearDown(self):
+    forwarders.time.sleep = self.sleep
+
+  def test_retry_resumes_after_a_partial_write(self):
+    events = ( { 'firewallEventID': i, 'hostName': 'host{}'.format(i) } for i in range(12) )
+    self.assertEqual(self.forwarder.send(events, event_type='firewall_events'), 12)
+    self.forwarder.close()
+
+    messages = [ message for data in self.received for message in split_frames(data) ]
+    self.assertEqual(len(messages), 12)
+    self.assertEqual(len(set(messages)), 12)
+    self.assertEqual(self.forwarder.stats['sent'], 12)
+    self.assertEqual(self.forwarder.stats['failed'], 0)
+    self.assertEqual(self.forwarder.stats['connections'], 2)
+
+  def test_drop_when_the_queue_is_full(self):
+    forwarder = forwarders.SyslogForwarder('localhost', protocol='TCP', max_queue=3, queue_policy='DROP')
+    forwarder._thread = True # don't start the sender
+    self.assertEqual(forwarder.send([ {} for i in range(5) ]), 3)
+    self.assertEqual(forwarder.stats['dropped'], 2)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,45 @@
+# standard library
+import unittest
+
+# 3rd party libraries
+
+# project libraries
+from deepsecurity import policies
+
+class TestIPListIndex(unittest.TestCase):
+  def setUp(self):
+    self.logs = []
+    self.ip_lists = [
+      policies.IPList(None, { 'ID': '1', 'items': '10.0.0.0/8\n192.168.1.0/255.255.255.0 # office' }),
+      policies.IPList(None, { 'ID': '2', 'items': '10.1.0.1-10.1.0.50\n2001:db8::/32' }),
+      policies.IPList(None, { 'ID': '3', 'items': '10.1.0.7\n172.16.0.0/255.0.255.0' }, log_func=lambda message, level=None: self.logs.append(message)),
+      ]
+    self.index = policies.IPListIndex(self.ip_lists)
+
+  def test_lookup(self):
+    self.assertEqual(self.index.lookup('10.1.0.7'), frozenset([1, 2, 3]))
+    self.assertEqual(self.index.lookup('10.1.0.51'), frozenset([1]))
+    self.assertEqual(self.index.lookup('192.168.1.255'), frozenset([1]))
+    self.assertEqual(self.index.lookup('192.168.2.0'), frozenset())
+    self.assertEqual(self.index.lookup('2001:db8:0:1::1'), frozenset([2]))
+    self.assertEqual(self.index.lookup('2001:db9::1'), frozenset())
+    self.assertEqual(self.index.lookup('not an address'), frozenset())
+
+  def test_lookup_many_matches_lookup(self):
+    addresses = ['10.1.0.7', '10.1.0.7', '10.200.0.1', '2001:db8::ffff', '::ffff:10.1.0.2', 'bad']
+    results = self.index.lookup_many(addresses)
+    self.assertEqual(sorted(results.keys()), sorted(set(addresses)))
+    for address in addresses: self.assertEqual(results[address], self.index.lookup(address))
+
+  def test_contains(self):
+    self.assertTrue(self.ip_lists[0].contains('10.255.255.255'))
+    self.assertFalse(self.ip_lists[0].contains('11.0.0.0'))
+
+  def test_non_contiguous_netmasks_are_rejected(self):
+    self.assertEqual(self.ip_lists[2].ranges, [(4, 167837703, 167837703)])
+    self.assertEqual(len(self.logs), 1)
+    self.assertEqual(self.index.lookup('172.16.0.1'), frozenset())
+    self.assertEqual(policies._parse_ip_list_entry('10.0.0.0/255.255.128.0'), (4, 167772160, 167804927))
+
+if __name__ == '__main__':
+  unittest.main()
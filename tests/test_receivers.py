@@ -0,0 +1,62 @@
+# standard library
+import unittest
+
+# 3rd party libraries
+
+# project libraries
+from deepsecurity import receivers
+
+class TestParseCef(unittest.TestCase):
+  def test_firewall_event_by_category(self):
+    event_type, event = receivers.parse_message('<134>Oct 18 10:00:00 dsm CEF:0|Trend Micro|Deep Security Agent|10.0|20|Log for TCP Port 80|0|cat=Firewall cn1=1 cn1Label=Host ID dvchost=web01 src=10.0.0.1 spt=1234 act=Log')
+    self.assertEqual(event_type, 'firewall_events')
+    self.assertEqual(event['hostID'], '1')
+    self.assertEqual(event['hostName'], 'web01')
+    self.assertEqual(event['sourceIP'], '10.0.0.1')
+    self.assertEqual(event['sourcePort'], '1234')
+    self.assertEqual(event['action'], 'Log')
+    self.assertEqual(event['reason'], 'Log for TCP Port 80')
+
+  def test_agent_events_by_signature_id(self):
+    messages = {
+      'CEF:0|Trend Micro|Deep Security Agent|10.0|21|Deny|5|dvchost=web01': 'firewall_events',
+      'CEF:0|Trend Micro|Deep Security Agent|10.0|1001111|Test Intrusion Prevention Rule|3|dvchost=web01': 'intrusionprevention_events',
+      'CEF:0|Trend Micro|Deep Security Agent|10.0|2002779|Windows System Files|6|dvchost=web01': 'integritymonitoring_events',
+      'CEF:0|Trend Micro|Deep Security Agent|10.0|3002795|Windows Events|8|dvchost=web01': 'loginspection_events',
+      'CEF:0|Trend Micro|Deep Security Agent|10.0|4000000|Eicar_test_file|6|dvchost=web01': 'antimalware_events',
+      'CEF:0|Trend Micro|Deep Security Agent|10.0|5000000|WebReputation|6|dvchost=web01': 'webreputation_events',
+      }
+    for message, expected in messages.items():
+      self.assertEqual(receivers.parse_message(message)[0], expected, message)
+
+  def test_signature_field(self):
+    event_type, event = receivers.parse_message('CEF:0|Trend Micro|Deep Security Agent|10.0|1001111|Test Intrusion Prevention Rule|3|dvchost=web01')
+    self.assertEqual(event['DPIRuleID'], '1001111')
+    self.assertEqual(event['severity'], '3')
+
+  def test_low_signature_ids_need_the_agent_product(self):
+    self.assertEqual(receivers.parse_message('CEF:0|Trend Micro|Other Product|1.0|20|Deny|5|dvchost=web01')[0], None)
+    self.assertEqual(receivers.parse_message('CEF:0|Trend Micro|Other Product|1.0|1001111|Rule|5|dvchost=web01')[0], 'intrusionprevention_events')
+
+  def test_manager_events_are_system_events(self):
+    event_type, event = receivers.parse_message('CEF:0|Trend Micro|Deep Security Manager|10.0|600|User Signed In|3|src=10.0.0.5 suser=admin')
+    self.assertEqual(event_type, 'system_events')
+    self.assertEqual(event['eventID'], '600')
+
+  def test_escapes(self):
+    event_type, event = receivers.parse_message(r'CEF:0|Trend Micro|Deep Security Agent|10.0|3002795|Pipe \| in name|8|dvchost=web01 msg=a\=b\\c\nd')
+    self.assertEqual(event['reason'], 'Pipe | in name')
+    self.assertEqual(event['description'], 'a=b\\c\nd')
+
+  def test_not_cef_or_leef(self):
+    self.assertEqual(receivers.parse_message('just a syslog line'), (None, None))
+
+class TestParseLeef(unittest.TestCase):
+  def test_leef_event(self):
+    event_type, event = receivers.parse_message('LEEF:1.0|Trend Micro|Deep Security Agent|10.0|1001111|cat=Intrusion Prevention\tsev=6\tdvchost=web01')
+    self.assertEqual(event_type, 'intrusionprevention_events')
+    self.assertEqual(event['DPIRuleID'], '1001111')
+    self.assertEqual(event['severity'], '6')
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,72 @@
+# standard library
+import os
+import shutil
+import tempfile
+import unittest
+
+# 3rd party libraries
+
+# project libraries
+from deepsecurity import dsm
+from deepsecurity import recommendations
+
+class FakeManager(object):
+  """
+  Answers hostRecommendationRuleIDsRetrieve calls. Computer 13 can't be 
+  reached until .recovered is set
+  """
+  def __init__(self):
+    self.calls = []
+    self.recovered = False
+
+  def request(self, call, auth_required=True):
+    computer_id = call['data']['hostID']
+    self.calls.append((computer_id, call['data']['type']))
+    if computer_id == 13 and not self.recovered: return { 'status': 500, 'data': None }
+    return { 'status': 200, 'data': [ str(computer_id * 10 + call['data']['type']), '7' ] }
+
+class TestRuleRecommendations(unittest.TestCase):
+  def setUp(self):
+    self.fake = FakeManager()
+    self.manager = dsm.Manager(username='user', password='password')
+    self.manager._request = self.fake.request
+    self.path = tempfile.mkdtemp()
+    self.state_path = os.path.join(self.path, 'state.json')
+
+  def tearDown(self):
+    shutil.rmtree(self.path)
+
+  def test_matrix(self):
+    matrix = recommendations.RuleRecommendations()
+    matrix.add(1, 'firewall', ['5', '7'])
+    matrix.add(2, 'firewall', ['7'])
+    self.assertEqual(matrix.get_computers_for_rule('firewall', '7'), [1, 2])
+    self.assertEqual(matrix.get_rule_counts(), { ('firewall', '5'): 1, ('firewall', '7'): 2 })
+    self.assertEqual(matrix.get_rules_for_computer(2), { 'firewall': ['7'], 'total_recommedations': 1 })
+    self.assertEqual(len(matrix.columns), 2)
+
+  def test_resume_retries_failed_calls(self):
+    harvester = recommendations.RuleRecommendationHarvester(self.manager, max_workers=1, state_path=self.state_path)
+    result = harvester.harvest([12, 13])
+    self.assertEqual(len(result.failed), 5)
+    self.assertEqual(recommendations.RuleRecommendations.load(self.state_path).failed, result.failed)
+
+    self.fake.recovered = True
+    self.fake.calls = []
+    result = harvester.harvest([12, 13])
+    self.assertEqual(sorted(set([ computer_id for computer_id, rule_type in self.fake.calls ])), [13])
+    self.assertEqual(len(self.fake.calls), 5)
+    self.assertEqual(result.failed, set())
+    self.assertEqual(result.get_rules_for_computer(13)['total_recommedations'], 10)
+
+  def test_resume_only_keeps_the_requested_computers(self):
+    harvester = recommendations.RuleRecommendationHarvester(self.manager, max_workers=1, state_path=self.state_path)
+    harvester.harvest([11, 12])
+    result = harvester.harvest([12, 14])
+    self.assertEqual(sorted(result.rows.keys()), [12, 14])
+    self.assertFalse([ pair for pair in result.completed if pair[0] == 11 ])
+    self.assertEqual(result.get_computers_for_rule('firewall', '113'), [])
+    self.assertEqual(result.get_rule_counts()[('firewall', '7')], 2)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,90 @@
+# standard library
+import os
+import shutil
+import tempfile
+import unittest
+
+# 3rd party libraries
+
+# project libraries
+from deepsecurity import rollups
+
+HOUR = rollups.GRANULARITIES['hour']
+START = 1470009600000 # 2016-08-01T00:00:00Z
+
+def make_event(minutes, host, rule):
+  return { 'DPIRuleID': rule, 'hostID': host, 'logDate': START + minutes * 60 * 1000 }
+
+# three hours of events. Host 1 logs the most, rule 7 fires the most
+EVENTS = [
+  make_event(5, '1', '7'),
+  make_event(10, '1', '7'),
+  make_event(50, '2', '8'),
+  make_event(70, '1', '7'),
+  make_event(130, '3', '7'),
+  make_event(150, '1', '9'),
+  ]
+
+class TestEventRollup(unittest.TestCase):
+  def setUp(self):
+    self.rollup = rollups.EventRollup()
+    self.rollup.add_many('intrusionprevention_events', EVENTS)
+
+  def test_series_by_hour_and_day(self):
+    self.assertEqual(self.rollup.get_series(), [
+      (START, 3, START + 5 * 60000, START + 50 * 60000),
+      (START + HOUR, 1, START + 70 * 60000, START + 70 * 60000),
+      (START + 2 * HOUR, 2, START + 130 * 60000, START + 150 * 60000),
+      ])
+    self.assertEqual([ stats[1] for stats in self.rollup.get_series(granularity='day') ], [6])
+
+  def test_series_for_a_dimension_value(self):
+    self.assertEqual([ (bucket_start, count) for bucket_start, count, first, last in self.rollup.get_series(dimension='host', value='1') ], [(START, 2), (START + HOUR, 1), (START + 2 * HOUR, 1)])
+
+  def test_time_range_includes_overlapping_buckets(self):
+    series = self.rollup.get_series(start=START + 90 * 60000, end='2016-08-01T02:00:00Z')
+    self.assertEqual([ stats[0] for stats in series ], [START + HOUR, START + 2 * HOUR])
+
+  def test_counts_and_top(self):
+    self.assertEqual(self.rollup.get_counts('rule')['7'], (4, START + 5 * 60000, START + 130 * 60000))
+    self.assertEqual(self.rollup.top('host', n=1), [('1', 4, START + 5 * 60000, START + 150 * 60000)])
+    self.assertEqual(sorted([ (count, value) for value, count, first, last in self.rollup.top('rule') ]), [(1, '8'), (1, '9'), (4, '7')])
+
+  def test_event_types_are_kept_apart(self):
+    self.rollup.add('firewall_events', { 'firewallRuleID': '3', 'hostID': '1', 'logDate': '2016-08-01T00:30:00Z' })
+    self.assertEqual(self.rollup.get_series(event_type='firewall_events'), [(START, 1, START + 30 * 60000, START + 30 * 60000)])
+    self.assertEqual(self.rollup.get_series()[0][1], 4)
+
+  def test_events_without_a_time_are_skipped(self):
+    self.rollup.handler('intrusionprevention_events', [ { 'DPIRuleID': '7', 'hostID': '1' } ])
+    self.assertEqual(self.rollup.skipped, 1)
+    self.assertEqual(self.rollup.get_counts('rule')['7'][0], 4)
+
+  def test_expire(self):
+    self.assertEqual(self.rollup.expire(START + 2 * HOUR, granularity='hour'), 2)
+    self.assertEqual([ stats[0] for stats in self.rollup.get_series() ], [START + 2 * HOUR])
+    self.assertEqual(self.rollup.get_series(granularity='day')[0][1], 6)
+
+  def test_merge_matches_a_single_rollup(self):
+    first, second = rollups.EventRollup(), rollups.EventRollup()
+    first.add_many('intrusionprevention_events', EVENTS[:3])
+    second.add_many('intrusionprevention_events', EVENTS[3:])
+    merged = first.merge(second)
+    self.assertEqual(merged.get_series(), self.rollup.get_series())
+    self.assertEqual(merged.get_counts('host'), self.rollup.get_counts('host'))
+
+  def test_save_and_load(self):
+    path = tempfile.mkdtemp()
+    try:
+      self.rollup.save(os.path.join(path, 'rollup.json'))
+      loaded = rollups.EventRollup.load(os.path.join(path, 'rollup.json'))
+    finally:
+      shutil.rmtree(path)
+    self.assertEqual(loaded.get_series(), self.rollup.get_series())
+    self.assertEqual(loaded.get_counts('rule'), self.rollup.get_counts('rule'))
+
+  def test_invalid_granularity(self):
+    self.assertRaises(ValueError, rollups.EventRollup, granularities=['week'])
+
+if __name__ == '__main__':
+  unittest.main()
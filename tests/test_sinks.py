@@ -0,0 +1,115 @@
+# standard library
+import csv
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+# 3rd party libraries
+
+# project libraries
+from deepsecurity import core
+from deepsecurity import sinks
+
+NIL = { u'@xsi:nil': u'true' }
+
+def make_events(count):
+  return [ { 'firewallEventID': str(i), 'hostID': str(i % 3), 'action': u'Deny', 'flags': NIL } for i in range(1, count + 1) ]
+
+class TestEventToDict(unittest.TestCase):
+  def test_nil_values_become_none(self):
+    record = sinks.event_to_dict(make_events(1)[0])
+    self.assertEqual(record['flags'], None)
+    self.assertEqual(record['hostID'], '1')
+
+  def test_translated_keys(self):
+    record = sinks.event_to_dict(make_events(1)[0], translate=True)
+    self.assertEqual(record['computer_id'], '1')
+    self.assertFalse('hostID' in record)
+
+  def test_proxies_arent_built(self):
+    built = []
+    proxy = core.CoreProxy(make_events(1)[0], lambda api_response: built.append(api_response))
+    self.assertEqual(sinks.event_to_dict(proxy)['firewallEventID'], '1')
+    self.assertEqual(built, [])
+
+class TestSinks(unittest.TestCase):
+  def setUp(self):
+    self.path = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.path)
+
+  def read_lines(self, path):
+    fh = gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')
+    try:
+      return [ json.loads(line) for line in fh.read().splitlines() ]
+    finally:
+      fh.close()
+
+  def test_jsonl_in_batches(self):
+    with sinks.JSONLinesSink(os.path.join(self.path, 'events.jsonl'), batch_size=4) as sink:
+      self.assertEqual(sink.write(iter(make_events(10)), event_type='firewall_events'), 10)
+    self.assertEqual(sink.written, 10)
+    records = self.read_lines(sink.files[0])
+    self.assertEqual([ record['firewallEventID'] for record in records ], [ str(i) for i in range(1, 11) ])
+    self.assertEqual(records[0]['eventType'], 'firewall_events')
+    self.assertEqual(records[0]['flags'], None)
+
+  def test_handler_for_collect_events(self):
+    sink = sinks.JSONLinesSink(os.path.join(self.path, 'events.jsonl'), type_field='type')
+    sink.handler('firewall_events', make_events(2))
+    sink.handler('system_events', [ { 'systemEventID': '9' } ])
+    sink.close()
+    self.assertEqual([ record['type'] for record in self.read_lines(sink.files[0]) ], ['firewall_events', 'firewall_events', 'system_events'])
+
+  def test_gzip_and_rotation(self):
+    sink = sinks.JSONLinesSink(os.path.join(self.path, 'events.jsonl'), compress=True, rotate_bytes=1, batch_size=3)
+    sink.write(make_events(7))
+    sink.close()
+    self.assertEqual([ os.path.basename(path) for path in sink.files ], ['events-00001.jsonl.gz', 'events-00002.jsonl.gz', 'events-00003.jsonl.gz'])
+    self.assertEqual([ len(self.read_lines(path)) for path in sink.files ], [3, 3, 1])
+
+  def test_csv(self):
+    sink = sinks.CSVSink(os.path.join(self.path, 'events.csv'), fields=['firewallEventID', 'action', 'flags'])
+    sink.write(make_events(2) + [ { 'firewallEventID': '3', 'action': u'D\xe9ny', 'extra': 'dropped' } ])
+    sink.close()
+    with open(sink.files[0], 'rb') as fh: rows = list(csv.reader(fh))
+    self.assertEqual(rows[0], ['firewallEventID', 'action', 'flags'])
+    self.assertEqual(rows[1], ['1', 'Deny', ''])
+    self.assertEqual(rows[3], ['3', u'D\xe9ny'.encode('utf-8'), ''])
+
+  def test_write_blocks_while_the_writer_is_behind(self):
+    sink = sinks.JSONLinesSink(os.path.join(self.path, 'events.jsonl'), batch_size=1, max_pending=1)
+    release = threading.Event()
+    write_batch = sink._write_batch
+    def slow_write_batch(records):
+      release.wait()
+      write_batch(records)
+    sink._write_batch = slow_write_batch
+
+    producer = threading.Thread(target=sink.write, args=(make_events(5),))
+    producer.daemon = True
+    producer.start()
+    producer.join(0.2)
+    # one batch being written, one waiting and the producer blocked on the next
+    self.assertTrue(producer.is_alive())
+    self.assertEqual(sink.written, 0)
+
+    release.set()
+    producer.join(5)
+    self.assertFalse(producer.is_alive())
+    sink.close()
+    self.assertEqual(sink.written, 5)
+
+  def test_write_errors_are_raised(self):
+    sink = sinks.JSONLinesSink(os.path.join(self.path, 'missing', 'events.jsonl'))
+    sink.write(make_events(1))
+    self.assertRaises(IOError, sink.flush)
+    self.assertRaises(IOError, sink.write, make_events(1))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,60 @@
+# standard library
+import json
+import unittest
+
+# 3rd party libraries
+
+# project libraries
+from deepsecurity import sketches
+
+class TestHyperLogLog(unittest.TestCase):
+  def test_sparse_matches_dense(self):
+    for n in [10, 1000, 20000]:
+      dense = sketches.HyperLogLog()
+      sparse = sketches.HyperLogLog(sparse=True)
+      for i in range(n):
+        dense.add(i)
+        sparse.add(i)
+      self.assertEqual(dense.count(), sparse.count())
+      self.assertTrue(abs(dense.count() - n) <= n * 0.05)
+
+  def test_sparse_switches_to_dense(self):
+    sketch = sketches.HyperLogLog(sparse=True)
+    for i in range(10): sketch.add(i)
+    self.assertTrue(sketch.sparse is not None)
+    for i in range(1000): sketch.add(i)
+    self.assertTrue(sketch.sparse is None)
+
+  def test_merge_and_serialize_sparse(self):
+    a = sketches.HyperLogLog(sparse=True)
+    b = sketches.HyperLogLog()
+    a.update(range(0, 20))
+    b.update(range(10, 3000))
+    copy = sketches.HyperLogLog.from_dict(json.loads(json.dumps(a.to_dict())))
+    self.assertEqual(copy.sparse, a.sparse)
+    self.assertEqual(copy.merge(b).count(), sketches.HyperLogLog().merge(b).merge(a).count())
+
+class TestEventSketches(unittest.TestCase):
+  def setUp(self):
+    self.events = [ { 'DPIRuleID': i % 5, 'sourceIP': '10.0.0.{}'.format(i % 7) } for i in range(100) ]
+
+  def test_distinct_by_group(self):
+    sketch = sketches.EventSketches(distinct_fields=['sourceIP'], group_by='DPIRuleID')
+    sketch.add_many('intrusionprevention_events', self.events)
+    self.assertEqual(sketch.count_distinct('sourceIP'), 7)
+    self.assertEqual(sketch.count_distinct('sourceIP', group=0), 7)
+    self.assertEqual(sketch.count_distinct('sourceIP', group=99), 0)
+
+  def test_max_groups(self):
+    sketch = sketches.EventSketches(distinct_fields=['sourceIP'], group_by='DPIRuleID', max_groups=3)
+    sketch.add_many('intrusionprevention_events', self.events)
+    self.assertEqual(sorted(sketch.distinct_by_group['sourceIP'].keys()), [0, 1, 2])
+    self.assertEqual(sketch.groups_dropped, 40)
+    self.assertEqual(sketch.count_distinct('sourceIP'), 7)
+
+    copy = sketches.EventSketches.from_dict(json.loads(json.dumps(sketch.to_dict())))
+    self.assertEqual(copy.max_groups, 3)
+    self.assertEqual(copy.count_distinct('sourceIP', group=1), 7)
+
+if __name__ == '__main__':
+  unittest.main()